@@ -35,7 +35,14 @@ def c_ext():
 
 
 def cython_ext():
-    return cythonize("**/*.pyx")
+    extensions = cythonize("**/*.pyx")
+    if os.name == 'nt' or sys.platform == 'darwin':
+        # the parallel loops run serially without openmp
+        return extensions
+    for ext in extensions:
+        ext.extra_compile_args.append('-fopenmp')
+        ext.extra_link_args.append('-lgomp')
+    return extensions
 
 
 setup(
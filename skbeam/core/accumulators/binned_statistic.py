@@ -39,7 +39,75 @@ from __future__ import division, print_function, absolute_import
 import warnings
 
 import numpy as np
-from ..utils import radial_grid, angle_grid, bin_edges_to_centers
+import scipy.sparse
+import six
+from ..utils import (radial_grid, angle_grid, bin_edges_to_centers,
+                     radial_extent, pixel_extent, split_pixel_weights)
+
+
+def _empty_statistic(statistic):
+    """
+    Value of a user-defined statistic for an empty bin: ``statistic([])``,
+    or NaN if this returns an error.
+    """
+    with warnings.catch_warnings():
+        # Numpy generates a warnings for mean/std/... with empty list
+        warnings.filterwarnings('ignore', category=RuntimeWarning)
+        old = np.seterr(invalid='ignore')
+        try:
+            null = statistic([])
+        except:
+            null = np.nan
+        np.seterr(**old)
+    return null
+
+
+def _subpixel_grid(origin, shape, subpixels):
+    """
+    Origin, shape and pixel size of the grid dividing every pixel of an
+    image into ``subpixels x subpixels`` sub-pixels, along with the index of
+    the (flattened) pixel each (flattened) sub-pixel belongs to.
+    """
+    n = subpixels
+    sub_origin = (n * origin[0] + (n - 1) / 2., n * origin[1] + (n - 1) / 2.)
+    sub_shape = (n * shape[0], n * shape[1])
+    pixels = np.arange(shape[0] * shape[1]).reshape(shape)
+    pixels = pixels.repeat(n, axis=0).repeat(n, axis=1)
+    return sub_origin, sub_shape, (1. / n, 1. / n), pixels.reshape(-1)
+
+
+def _bin_indices(x, edges):
+    """
+    Index of the bin each value of `x` falls into, as ``np.digitize(x,
+    edges)`` except that values equal to the rightmost edge are counted in
+    the last bin and not as outliers.
+
+    Uniform bins are computed directly from the bin width, and only
+    corrected against the edges for rounding.
+    """
+    nedges = len(edges)
+    width = (edges[-1] - edges[0]) / (nedges - 1)
+    if width > 0 and np.allclose(np.diff(edges), width, rtol=1e-10, atol=0):
+        with np.errstate(invalid='ignore'):
+            idx = np.floor((x - edges[0]) / width)
+            idx += 1
+            np.clip(idx, 0, nedges, out=idx)
+        idx[np.isnan(idx)] = nedges
+        idx = idx.astype(np.intp)
+        # Shift by one bin the values rounded into the wrong bin, so that
+        # edges[idx - 1] <= x < edges[idx] as with digitize.
+        padded = np.concatenate(([np.nan], edges, [np.nan]))
+        idx -= x < padded[idx]
+        idx += x >= padded[idx + 1]
+    else:
+        idx = np.digitize(x, edges)
+
+    # Using digitize, values that fall on an edge are put in the
+    # right bin.  For the rightmost bin, we want values equal to
+    # the right edge to be counted in the last bin, and not as an
+    # outlier.
+    idx[x == edges[-1]] -= 1
+    return idx
 
 
 class BinnedStatisticDD(object):
@@ -95,8 +163,9 @@ class BinnedStatisticDD(object):
             for `sample`). Values with mask==0 will be ignored.
 
         Note: If using numpy versions < 1.10.0, you may notice slow behavior of
-        this constructor. This has to do with digitize, which was optimized
-        from 1.10.0 onwards.
+        this constructor for non-uniform bins. This has to do with digitize,
+        which was optimized from 1.10.0 onwards.  Uniform bins are computed
+        directly from the bin width.
         """
 
         # This code is based on np.histogramdd
@@ -111,7 +180,6 @@ class BinnedStatisticDD(object):
         self.nbin = np.empty(self.D, int)
         self.edges = self.D * [None]
         self._centers = self.D * [None]
-        dedges = self.D * [None]
 
         try:
             M = len(bins)
@@ -147,35 +215,13 @@ class BinnedStatisticDD(object):
                 self.edges[i] = np.asarray(bins[i], float)
                 self.nbin[i] = len(self.edges[i]) + 1  # +1 for outlier bins
             self._centers[i] = bin_edges_to_centers(self.edges[i])
-            dedges[i] = np.diff(self.edges[i])
 
         self.nbin = np.asarray(self.nbin)
 
         # Compute the bin number each sample falls into.
         Ncount = {}
         for i in np.arange(self.D):
-            # Apply mask in a non-ideal way by setting value outside range.
-            # Would be better to do this using bincount "weights", perhaps.
-            thissample = sample[:, i]
-            if mask is not None:
-                thissample[mask == 0] = (self.edges[i][0] -
-                                         0.01 * (
-                                         1 + np.fabs(self.edges[i][0])))
-            Ncount[i] = np.digitize(thissample, self.edges[i])
-
-        # Using digitize, values that fall on an edge are put in the
-        # right bin.  For the rightmost bin, we want values equal to
-        # the right edge to be counted in the last bin, and not as an
-        # outlier.
-
-        for i in np.arange(self.D):
-            # Rounding precision
-            decimal = int(-np.log10(dedges[i].min())) + 6
-            # Find which points are on the rightmost edge.
-            on_edge = np.where(np.around(sample[:, i], decimal) ==
-                               np.around(self.edges[i][-1], decimal))[0]
-            # Shift these points one bin to the left.
-            Ncount[i][on_edge] -= 1
+            Ncount[i] = _bin_indices(sample[:, i], self.edges[i])
 
         # Compute the sample indices in the flattened statistic matrix.
         self.ni = self.nbin.argsort()
@@ -183,7 +229,17 @@ class BinnedStatisticDD(object):
         for i in np.arange(0, self.D - 1):
             self.xy += Ncount[self.ni[i]] * self.nbin[self.ni[i + 1:]].prod()
         self.xy += Ncount[self.ni[-1]]
+        if mask is not None:
+            # Masked samples go to the (discarded) outlier bin, leaving the
+            # sample itself untouched.
+            self.xy[np.ravel(mask) == 0] = 0
+        # axis permutation taking the flattened (sorted) layout back to the
+        # order of the input dimensions
+        self._axes = np.argsort(self.ni)
         self._flatcount = None  # will be computed if needed
+        self._flatmatrix = None  # will be computed if needed
+        # evaluate 'mean', 'std', 'count' and 'sum' through flatmatrix
+        self.sparse = False
         self.statistic = statistic
 
     @property
@@ -191,9 +247,128 @@ class BinnedStatisticDD(object):
         # Compute flatcount the first time it is accessed. Some statistics
         # never access it.
         if self._flatcount is None:
-            self._flatcount = np.bincount(self.xy, None)
+            if self.sparse:
+                # with pixel splitting the counts are fractional
+                self._flatcount = np.asarray(
+                    self.flatmatrix.sum(axis=1)).ravel()
+            else:
+                self._flatcount = np.bincount(self.xy,
+                                              minlength=self.nbin.prod())
         return self._flatcount
 
+    @property
+    def flatmatrix(self):
+        """
+        flatmatrix : scipy.sparse.csr_matrix
+        Sparse ``(nbin.prod(), N)`` matrix of ones assigning each sample to
+        its bin in the flattened statistic matrix.
+        """
+        # Compute flatmatrix the first time it is accessed. Only the stacked
+        # statistics use it.
+        if self._flatmatrix is None:
+            N = len(self.xy)
+            self._flatmatrix = scipy.sparse.csr_matrix(
+                (np.ones(N), (self.xy, np.arange(N))),
+                shape=(self.nbin.prod(), N))
+        return self._flatmatrix
+
+    def _split_pixels(self, subsample, pixels, mask=None):
+        """
+        Replace `flatmatrix` by one which splits every sample over the bins
+        of its sub-samples.
+
+        Parameters
+        ----------
+        subsample : array_like
+            Sub-sample positions, in the same format as `sample` in the
+            constructor.
+        pixels : array_like
+            Index of the sample each sub-sample belongs to.  Every sample is
+            given a total weight of one, shared evenly between its
+            sub-samples.
+        mask : array_like, optional
+            Ones and zeros with the same length as `pixels`.  Sub-samples
+            with mask==0 will be ignored.
+        """
+        N = len(self.xy)
+        pixels = np.asarray(pixels)
+        # bin the sub-samples with exactly the same edges
+        sub = BinnedStatisticDD(subsample, bins=self.edges, mask=mask)
+        nsub = np.bincount(pixels, minlength=N)
+        self._flatmatrix = scipy.sparse.csr_matrix(
+            (1. / nsub[pixels], (sub.xy, pixels)),
+            shape=(self.nbin.prod(), N))
+        self._flatcount = None
+        self.sparse = True
+
+    def save(self, fname):
+        """
+        Save the binning (edges, bin assignment and `flatmatrix`) to a
+        ``.npz`` file, so that it can be restored with `load` without
+        recomputing it.
+
+        Parameters
+        ----------
+        fname : str or file
+            File name or open file the binning is written to.
+
+        Notes
+        -----
+        A user-defined statistic is not saved.
+        """
+        flatmatrix = self.flatmatrix
+        state = dict(nbin=self.nbin, xy=self.xy, sparse=self.sparse,
+                     data=flatmatrix.data, indices=flatmatrix.indices,
+                     indptr=flatmatrix.indptr)
+        for i, edges in enumerate(self.edges):
+            state['edges_%d' % i] = edges
+        if not callable(self.statistic):
+            state['statistic'] = self.statistic
+        if hasattr(self, 'expected_shape'):
+            state['expected_shape'] = self.expected_shape
+        np.savez(fname, **state)
+
+    @classmethod
+    def load(cls, fname, statistic=None):
+        """
+        Restore a binning saved with `save`.
+
+        Parameters
+        ----------
+        fname : str or file
+            File name or open file the binning was saved to.
+        statistic : string or callable, optional
+            The statistic to compute (default is the saved one, or 'mean'
+            if a user-defined statistic was used).
+
+        Returns
+        -------
+        binned_statistic : BinnedStatisticDD
+            Instance of the class `load` is called on.
+        """
+        with np.load(fname) as state:
+            self = cls.__new__(cls)
+            self.nbin = state['nbin']
+            self.D = len(self.nbin)
+            self.edges = [state['edges_%d' % i] for i in np.arange(self.D)]
+            self._centers = [bin_edges_to_centers(edges)
+                             for edges in self.edges]
+            self.xy = state['xy']
+            self.ni = self.nbin.argsort()
+            self._axes = np.argsort(self.ni)
+            self._flatcount = None
+            self._flatmatrix = scipy.sparse.csr_matrix(
+                (state['data'], state['indices'], state['indptr']),
+                shape=(self.nbin.prod(), len(self.xy)))
+            self.sparse = bool(state['sparse'])
+            if 'expected_shape' in state:
+                self.expected_shape = tuple(state['expected_shape'])
+            if statistic is None:
+                statistic = (str(state['statistic']) if 'statistic' in state
+                             else 'mean')
+        self.statistic = statistic
+        return self
+
     @property
     def bin_edges(self):
         """
@@ -255,6 +430,11 @@ class BinnedStatisticDD(object):
         if statistic is None:
             statistic = self.statistic
 
+        if self.sparse and statistic in ('mean', 'std', 'count', 'sum'):
+            values = np.asarray(values, dtype=float).reshape(1, -1)
+            self.result = self._stack(values, [statistic])[0][0]
+            return self.result
+
         self.result = np.empty(self.nbin.prod(), float)
         if statistic == 'mean':
             self.result.fill(np.nan)
@@ -282,36 +462,216 @@ class BinnedStatisticDD(object):
             for i in np.unique(self.xy):
                 self.result[i] = np.median(values[self.xy == i])
         elif callable(statistic):
-            with warnings.catch_warnings():
-                # Numpy generates a warnings for mean/std/... with empty list
-                warnings.filterwarnings('ignore', category=RuntimeWarning)
-                old = np.seterr(invalid='ignore')
-                try:
-                    null = statistic([])
-                except:
-                    null = np.nan
-                np.seterr(**old)
-            self.result.fill(null)
+            self.result.fill(_empty_statistic(statistic))
             for i in np.unique(self.xy):
                 self.result[i] = statistic(values[self.xy == i])
 
-        # Shape into a proper matrix
-        self.result = self.result.reshape(np.sort(self.nbin))
-        ni = np.copy(self.ni)
-        for i in np.arange(self.nbin.size):
-            j = ni.argsort()[i]
-            self.result = self.result.swapaxes(i, j)
-            ni[i], ni[j] = ni[j], ni[i]
-
-        # Remove outliers (indices 0 and -1 for each dimension).
-        core = self.D * [slice(1, -1)]
-        self.result = self.result[core]
+        self.result = self._unflatten(self.result)
 
         if (self.result.shape != self.nbin - 2).any():
             raise RuntimeError('Internal Shape Error')
 
         return self.result
 
+    def events(self, pixels, weights=1, statistic=None):
+        """
+        Compute the statistic from a list of events.
+
+        The result is the same as calling this object with the dense values
+        ``np.bincount(pixels, weights, minlength=N)``, but the dense values
+        are never built: the events are mapped straight to their bins.
+
+        Parameters
+        ----------
+        pixels : array_like
+            Index (into the flattened `sample`) of the sample hit by each
+            event.  The same sample may be hit more than once.
+        weights : float or array_like, optional
+            Value of each event (default is 1, i.e. counting events).
+        statistic : string, optional
+            The statistic to compute (default is whatever was passed in when
+            this object was instantiated).  Only 'mean', 'std', 'count' and
+            'sum' are available in event mode, all samples which were not
+            hit count as zeros.
+
+        Returns
+        -------
+        statistic_values : array
+            The values of the selected statistic in each bin.
+        """
+        if statistic is None:
+            statistic = self.statistic
+        if callable(statistic) or statistic not in ('mean', 'std', 'count',
+                                                    'sum'):
+            raise ValueError("Only 'mean', 'std', 'count' and 'sum' can be "
+                             "computed from events, not {}".format(statistic))
+        N = len(self.xy)
+        nflat = self.nbin.prod()
+        pixels = np.asarray(pixels, dtype=np.intp).ravel()
+        weights = np.broadcast_to(np.asarray(weights, dtype=float).ravel(),
+                                  pixels.shape)
+        if len(pixels) and (pixels.min() < 0 or pixels.max() >= N):
+            raise ValueError("Pixel indices must be between 0 and {}"
+                             "".format(N - 1))
+        flatmatrix, flatcount = self._event_tables()
+
+        if statistic == 'std' or flatmatrix is not None:
+            # sum up events hitting the same sample
+            hit, inverse = np.unique(pixels, return_inverse=True)
+            values = np.bincount(inverse, weights, minlength=len(hit))
+            if flatmatrix is not None:
+                flatsum = flatmatrix[:, hit].dot(values)
+                flatsum2 = flatmatrix[:, hit].dot(values ** 2)
+            else:
+                flatsum = np.bincount(self.xy[hit], values, minlength=nflat)
+                flatsum2 = np.bincount(self.xy[hit], values ** 2,
+                                       minlength=nflat)
+        else:
+            flatsum = np.bincount(self.xy[pixels], weights, minlength=nflat)
+
+        a = flatcount.nonzero()
+        self.result = np.empty(nflat, float)
+        if statistic == 'mean':
+            self.result.fill(np.nan)
+            self.result[a] = flatsum[a] / flatcount[a]
+        elif statistic == 'std':
+            self.result.fill(0)
+            self.result[a] = np.sqrt(flatsum2[a] / flatcount[a] -
+                                     (flatsum[a] / flatcount[a]) ** 2)
+        elif statistic == 'count':
+            self.result.fill(0)
+            self.result[:len(flatcount)] = flatcount
+        elif statistic == 'sum':
+            self.result[:] = flatsum
+        self.result = self._unflatten(self.result)
+        return self.result
+
+    def _event_tables(self):
+        """
+        Tables mapping samples to bins for `events`: the column-indexable
+        `flatmatrix` (None when every sample falls in a single bin and `xy`
+        is used instead) and the (weighted) number of samples in each bin.
+        They are cached until `flatmatrix` is replaced.
+        """
+        if not self.sparse:
+            return None, self.flatcount
+        cached = getattr(self, '_events_cache', None)
+        if cached is None or cached[0] is not self._flatmatrix:
+            flatmatrix = self.flatmatrix
+            cached = (flatmatrix, flatmatrix.tocsc())
+            self._events_cache = cached
+        return cached[1], self.flatcount
+
+    def _unflatten(self, flat):
+        """
+        Shape flattened statistics of shape ``(..., nbin.prod())`` into a
+        proper matrix of shape ``(..., nbin[0] - 2, nbin[1] - 2, ...)``.
+        """
+        lead = flat.shape[:-1]
+        result = flat.reshape(lead + tuple(self.nbin[self.ni]))
+        result = result.transpose(tuple(np.arange(len(lead))) +
+                                  tuple(len(lead) + self._axes))
+
+        # Remove outliers (indices 0 and -1 for each dimension).
+        core = (Ellipsis,) + self.D * (slice(1, -1),)
+        return result[core]
+
+    def stack(self, values, statistics=None):
+        """
+        Compute one or more statistics for a stack of frames at once.
+
+        The sums over each bin are computed for all frames in a single
+        sparse matrix product (see `flatmatrix`), and shared between the
+        'mean', 'std' and 'sum' statistics.
+
+        Parameters
+        ----------
+        values : array_like
+            The values on which the statistics will be computed, with shape
+            ``(frames, N)`` where each frame must be the same shape as
+            `sample` in the constructor.
+        statistics : string, callable or sequence of those, optional
+            The statistic(s) to compute (default is whatever was passed in
+            when this object was instantiated).  See `__call__` for the
+            available statistics.  'median' and callables are evaluated
+            frame by frame.
+
+        Returns
+        -------
+        statistic_values : array or list of arrays
+            The values of the selected statistic in each bin, with shape
+            ``(frames,) + bin shape``.  A list with one such array per
+            statistic is returned if `statistics` is a sequence.
+        """
+        if statistics is None:
+            statistics = self.statistic
+        single = (callable(statistics) or
+                  isinstance(statistics, six.string_types))
+        if single:
+            statistics = [statistics]
+        for statistic in statistics:
+            if not callable(statistic) and statistic not in self.std_:
+                raise ValueError('invalid statistic %r' % (statistic,))
+
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        if values.ndim != 2 or values.shape[1] != len(self.xy):
+            raise ValueError('"values" has incorrect shape. '
+                             ' Expected: (frames, ' + str(len(self.xy)) +
+                             ') Received: ' + str(values.shape))
+
+        results = self._stack(values, statistics)
+        if single:
+            return results[0]
+        return results
+
+    def _stack(self, values, statistics):
+        """
+        Compute the list of `statistics` for the ``(frames, N)`` array
+        `values`, returning a list of ``(frames,) + bin shape`` arrays.
+        """
+        nframes = values.shape[0]
+        nflat = self.nbin.prod()
+
+        flatcount = self.flatcount
+        a = flatcount.nonzero()[0]
+        flatsum = flatsum2 = None
+        if any(s in ('mean', 'std', 'sum') for s in statistics
+               if not callable(s)):
+            flatsum = self.flatmatrix.dot(values.T).T
+        if 'std' in statistics:
+            flatsum2 = self.flatmatrix.dot((values ** 2).T).T
+
+        results = []
+        for statistic in statistics:
+            result = np.empty((nframes, nflat), float)
+            if callable(statistic) or statistic == 'median':
+                if statistic == 'median':
+                    null, func = np.nan, np.median
+                else:
+                    null, func = _empty_statistic(statistic), statistic
+                result.fill(null)
+                # group the samples by bin once, keeping their order
+                order = np.argsort(self.xy, kind='mergesort')
+                bins, start = np.unique(self.xy[order], return_index=True)
+                stop = np.append(start[1:], len(order))
+                for f in np.arange(nframes):
+                    frame = values[f, order]
+                    for i, j, k in zip(bins, start, stop):
+                        result[f, i] = func(frame[j:k])
+            elif statistic == 'mean':
+                result.fill(np.nan)
+                result[:, a] = flatsum[:, a] / flatcount[a]
+            elif statistic == 'std':
+                result.fill(0)
+                result[:, a] = np.sqrt(flatsum2[:, a] / flatcount[a] -
+                                       (flatsum[:, a] / flatcount[a]) ** 2)
+            elif statistic == 'count':
+                result[:] = flatcount
+            elif statistic == 'sum':
+                result[:] = flatsum
+            results.append(self._unflatten(result))
+        return results
+
 
 class BinnedStatistic1D(BinnedStatisticDD):
     def __init__(self, x, statistic='mean',
@@ -522,7 +882,8 @@ class RPhiBinnedStatistic(BinnedStatistic2D):
     """
 
     def __init__(self, shape, bins=10, range=None,
-                 origin=None, mask=None, statistic='mean'):
+                 origin=None, mask=None, statistic='mean', sparse=False,
+                 subpixels=1):
         """
         Parameters:
         -----------
@@ -565,6 +926,16 @@ class RPhiBinnedStatistic(BinnedStatistic2D):
                 values, and outputs a single numerical statistic. This function
                 will be called on the values in each bin.  Empty bins will be
                 represented by function([]), or NaN if this returns an error.
+        sparse : bool, optional
+            If True, build the sparse bin assignment matrix (see
+            `flatmatrix`) at construction and compute the 'mean', 'std',
+            'count' and 'sum' statistics as sparse matrix products.
+        subpixels : int, optional
+            Split every pixel into ``subpixels x subpixels`` sub-pixels,
+            each contributing a ``1 / subpixels**2`` share of the pixel to
+            the bin it falls in, for sub-pixel accuracy.  Implies
+            ``sparse=True``. 'median' and user-defined statistics still use
+            whole pixels.
         """
         if origin is None:
             origin = (shape[0] - 1) / 2., (shape[1] - 1) / 2.
@@ -587,6 +958,20 @@ class RPhiBinnedStatistic(BinnedStatistic2D):
                                                   mask=mask,
                                                   range=range)
 
+        if subpixels > 1:
+            sub_origin, sub_shape, sub_size, pixels = _subpixel_grid(
+                origin, shape, subpixels)
+            r_sub = radial_grid(sub_origin, sub_shape, sub_size)
+            phi_sub = angle_grid(sub_origin, sub_shape, sub_size)
+            if mask is not None:
+                mask = mask[pixels]
+            self._split_pixels([r_sub.reshape(-1), phi_sub.reshape(-1)],
+                               pixels, mask=mask)
+        elif sparse:
+            # build the matrix now rather than on first use
+            self.flatmatrix
+            self.sparse = True
+
     def __call__(self, values, statistic=None):
         """
         Parameters
@@ -627,6 +1012,34 @@ class RPhiBinnedStatistic(BinnedStatistic2D):
         return super(RPhiBinnedStatistic, self).__call__(values.reshape(-1),
                                                          statistic)
 
+    def stack(self, values, statistics=None):
+        """
+        Parameters
+        ----------
+        values : array_like
+            Stack of frames on which the statistics will be computed, with
+            shape ``(frames,) + shape`` where ``shape`` is the one passed in
+            when this object was instantiated.
+        statistics : string, callable or sequence of those, optional
+            The statistic(s) to compute (default is whatever was passed in
+            when this object was instantiated).
+
+        Returns
+        -------
+        statistic_values : array or list of arrays
+            The values of the selected statistic in each bin, with shape
+            ``(frames,) + bin shape``.  A list with one such array per
+            statistic is returned if `statistics` is a sequence.
+        """
+        values = np.asarray(values)
+        if values.shape[-2:] != self.expected_shape:
+            raise ValueError('"values" has incorrect shape.'
+                             ' Expected: (frames,) + ' +
+                             str(self.expected_shape) +
+                             ' Received: ' + str(values.shape))
+        return super(RPhiBinnedStatistic, self).stack(
+            values.reshape(-1, np.prod(self.expected_shape)), statistics)
+
 
 class RadialBinnedStatistic(BinnedStatistic1D):
     """
@@ -635,7 +1048,8 @@ class RadialBinnedStatistic(BinnedStatistic1D):
     """
 
     def __init__(self, shape, bins=10, range=None, origin=None, mask=None,
-                 r_map=None, statistic='mean'):
+                 r_map=None, statistic='mean', sparse=False, subpixels=1,
+                 split_pixels=False):
         """
         Parameters:
         -----------
@@ -681,12 +1095,41 @@ class RadialBinnedStatistic(BinnedStatistic1D):
                 values, and outputs a single numerical statistic. This function
                 will be called on the values in each bin.  Empty bins will be
                 represented by function([]), or NaN if this returns an error.
+        sparse : bool, optional
+            If True, build the sparse bin assignment matrix (see
+            `flatmatrix`) at construction and compute the 'mean', 'std',
+            'count' and 'sum' statistics as sparse matrix products.
+        subpixels : int, optional
+            Split every pixel into ``subpixels x subpixels`` sub-pixels,
+            each contributing a ``1 / subpixels**2`` share of the pixel to
+            the bin it falls in, for sub-pixel accuracy.  Implies
+            ``sparse=True``. 'median' and user-defined statistics still use
+            whole pixels.  Cannot be used
+            together with `r_map`.
+        split_pixels : bool, optional
+            If True, share each pixel between the bins overlapped by its
+            footprint, in proportion to the overlap, instead of assigning
+            it wholly to the bin of its center.  The footprint is exact for
+            radii computed from `origin`, and interpolated at the pixel
+            corners from `r_map` otherwise.  Implies ``sparse=True``.
+            'median' and user-defined statistics still use whole pixels.
         """
         if origin is None:
             origin = (shape[0] - 1) / 2, (shape[1] - 1) / 2
 
+        if split_pixels and subpixels > 1:
+            raise ValueError('"split_pixels" and "subpixels" are two '
+                             'alternative ways of splitting pixels, only '
+                             'one of them can be used')
         if r_map is None:
             r_map = radial_grid(origin, shape)
+            if split_pixels:
+                r_min, r_max = radial_extent(origin, shape)
+        elif subpixels > 1:
+            raise ValueError('"subpixels" requires the radii to be computed '
+                             'from "origin", it cannot be used with "r_map"')
+        elif split_pixels:
+            r_min, r_max = pixel_extent(r_map)
 
         self.expected_shape = tuple(shape)
         if mask is not None:
@@ -702,6 +1145,26 @@ class RadialBinnedStatistic(BinnedStatistic1D):
                                                     mask=mask,
                                                     range=range)
 
+        if subpixels > 1:
+            sub_origin, sub_shape, sub_size, pixels = _subpixel_grid(
+                origin, shape, subpixels)
+            r_sub = radial_grid(sub_origin, sub_shape, sub_size)
+            if mask is not None:
+                mask = mask[pixels]
+            self._split_pixels([r_sub.reshape(-1)], pixels, mask=mask)
+        elif split_pixels:
+            weights = split_pixel_weights(r_min, r_max, self.bin_edges,
+                                          mask=mask)
+            # add the empty outlier bins around the weights
+            outlier = scipy.sparse.csr_matrix((1, weights.shape[1]))
+            self._flatmatrix = scipy.sparse.vstack(
+                [outlier, weights, outlier], format='csr')
+            self.sparse = True
+        elif sparse:
+            # build the matrix now rather than on first use
+            self.flatmatrix
+            self.sparse = True
+
     def __call__(self, values, statistic=None):
         """
         Parameters
@@ -741,3 +1204,31 @@ class RadialBinnedStatistic(BinnedStatistic1D):
                              ' Received: ' + str(values.shape))
         return super(RadialBinnedStatistic, self).__call__(values.reshape(-1),
                                                            statistic)
+
+    def stack(self, values, statistics=None):
+        """
+        Parameters
+        ----------
+        values : array_like
+            Stack of frames on which the statistics will be computed, with
+            shape ``(frames,) + shape`` where ``shape`` is the one passed in
+            when this object was instantiated.
+        statistics : string, callable or sequence of those, optional
+            The statistic(s) to compute (default is whatever was passed in
+            when this object was instantiated).
+
+        Returns
+        -------
+        statistic_values : array or list of arrays
+            The values of the selected statistic in each bin, with shape
+            ``(frames,) + bin shape``.  A list with one such array per
+            statistic is returned if `statistics` is a sequence.
+        """
+        values = np.asarray(values)
+        if values.shape[-2:] != self.expected_shape:
+            raise ValueError('"values" has incorrect shape.'
+                             ' Expected: (frames,) + ' +
+                             str(self.expected_shape) +
+                             ' Received: ' + str(values.shape))
+        return super(RadialBinnedStatistic, self).stack(
+            values.reshape(-1, np.prod(self.expected_shape)), statistics)
@@ -5,6 +5,8 @@ Histogram
 General purpose histogram classes.
 """
 cimport cython
+from cython.parallel cimport parallel, prange, threadid
+from multiprocessing import cpu_count
 import numpy as np
 cimport numpy as np
 from ..utils import bin_edges_to_centers
@@ -13,38 +15,40 @@ import logging
 logger = logging.getLogger(__name__)
 
 DEF MAX_DIMENSIONS = 10
+# smallest number of entries worth handing to a separate thread
+DEF MIN_THREAD_ENTRIES = 65536
 
+# plain C types rather than the numpy typedefs, for which cython 0.29
+# cannot dispatch the const memoryviews of the fill loops
 ctypedef fused coordnumtype:
-    np.int8_t
-    np.int16_t
-    np.int32_t
-    np.int64_t
-    np.uint8_t
-    np.uint16_t
-    np.uint32_t
-    np.uint64_t
-    np.float32_t
-    np.float64_t
+    signed char
+    short
+    int
+    long long
+    unsigned char
+    unsigned short
+    unsigned int
+    unsigned long long
+    float
+    double
 
 ctypedef fused wnumtype:
-    np.int8_t
-    np.int16_t
-    np.int32_t
-    np.int64_t
-    np.uint8_t
-    np.uint16_t
-    np.uint32_t
-    np.uint64_t
-    np.float32_t
-    np.float64_t
-
-cdef void* _getarrayptr(np.ndarray a):
-    return <void*> a.data
-
+    signed char
+    short
+    int
+    long long
+    unsigned char
+    unsigned short
+    unsigned int
+    unsigned long long
+    float
+    double
 
 class Histogram:
 
     _always_use_fillnd = False      # FIXME remove this
+    # number of threads used by fill, None uses all available processors
+    num_threads = None
 
     def __init__(self, binlowhigh, *args):
         """
@@ -107,8 +111,9 @@ class Histogram:
         ----------
         coords : iterable of values.  Values can be np.ndarrays, integers,
             floats, or list/tuple of int/float. The length of coords is
-            equivalent to the dimensionality of the histogram.  The data
-            types of the coords must be the same.
+            equivalent to the dimensionality of the histogram.  Integer
+            and floating point arrays are binned in their own type,
+            without conversion.
         weights: int/float/np.ndarray, optional.  Defaults to 1.
             The amount each histogram bin (determined by coords) is
             to be incremented.
@@ -148,119 +153,186 @@ class Histogram:
         if len(coords) == 1:
             # compute a 1D histogram
             self._fill1d(coords[0], weights)
-        elif len(coords) == 2:
+        elif len(coords) == 2 and coords[0].dtype == coords[1].dtype:
             # compute a 2D histogram!
             self._fill2d(coords[0], coords[1], weights)
         else:
-            # do the generalized ND histogram
+            # do the generalized ND histogram, which also handles mixed
+            # coordinate types
             self._fillnd(coords, weights)
         return
 
 
-    def _fill1d(self, np.ndarray[coordnumtype, ndim=1] xval,
-                np.ndarray[wnumtype, ndim=1] weight):
-        cdef np.ndarray[np.float_t, ndim=1] data = self.values
-        cdef np.float_t low = self._lows[0]
-        cdef np.float_t high = self._highs[0]
-        cdef np.float_t binsize = self._binsizes[0]
-        cdef int i
-        cdef int wstride = 0 if weight.size == 1 else 1
-        cdef int xlen = len(xval)
-        for i in range(xlen):
-            xidx = find_indices(xval[i], low, high, binsize)
-            if xidx == -1:
-                continue
-            data[xidx] += weight[wstride * i]
+    def _fill_threads(self, Py_ssize_t nentries):
+        """Number of threads used to fill `nentries` coordinates.
+
+        Each thread accumulates into its own private copy of the histogram,
+        so threads are only used when there are many more entries than
+        bins to make the final reduction worthwhile.
+        """
+        nthreads = self.num_threads or cpu_count()
+        nchunk = max(MIN_THREAD_ENTRIES, self._values.size)
+        return max(1, min(nthreads, nentries // nchunk))
+
+
+    def _thread_buffers(self, int nthreads):
+        # a single thread accumulates straight into the histogram
+        if nthreads == 1:
+            return self._values.reshape(1, -1)
+        return np.zeros((nthreads, self._values.size),
+                        dtype=self._values.dtype)
+
+
+    def _reduce(self, buffers):
+        if buffers.base is not self._values:
+            self._values += buffers.sum(axis=0).reshape(self._values.shape)
+
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _fill1d(self, const coordnumtype[:] xval,
+                const wnumtype[:] weight):
+        cdef double low = self._lows[0]
+        cdef double high = self._highs[0]
+        cdef double binsize = self._binsizes[0]
+        cdef long nbin = self._nbins[0]
+        cdef Py_ssize_t i
+        cdef Py_ssize_t wstride = 0 if weight.shape[0] == 1 else 1
+        cdef Py_ssize_t xlen = xval.shape[0]
+        cdef long xidx
+        cdef int tid
+        cdef int nthreads = self._fill_threads(xlen)
+        buffers = self._thread_buffers(nthreads)
+        cdef double[:, ::1] data = buffers
+        with nogil, parallel(num_threads=nthreads):
+            tid = threadid()
+            for i in prange(xlen, schedule='static'):
+                xidx = find_indices(xval[i], low, high, binsize, nbin)
+                if xidx != -1:
+                    data[tid, xidx] += weight[wstride * i]
+        self._reduce(buffers)
         return
 
 
-    def _fill2d(self, np.ndarray[coordnumtype, ndim=1] xval,
-                np.ndarray[coordnumtype, ndim=1] yval,
-                np.ndarray[wnumtype, ndim=1] weight):
-        cdef np.float_t [:,:] data = self.values
-        cdef np.float_t [:] low = self._lows
-        cdef np.float_t [:] high = self._highs
-        cdef np.float_t [:] binsize = self._binsizes
-        cdef int i
-        cdef int xlen = len(xval)
-        cdef int ylen = len(yval)
-        cdef int wstride = 0 if weight.size == 1 else 1
-        for i in range(xlen):
-            xidx = find_indices(xval[i], low[0], high[0], binsize[0])
-            if xidx == -1:
-                continue
-            yidx = find_indices(yval[i], low[1], high[1], binsize[1])
-            if yidx == -1:
-                continue
-            data[xidx][yidx] += weight[wstride * i]
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _fill2d(self, const coordnumtype[:] xval,
+                const coordnumtype[:] yval,
+                const wnumtype[:] weight):
+        cdef double xlow = self._lows[0], ylow = self._lows[1]
+        cdef double xhigh = self._highs[0], yhigh = self._highs[1]
+        cdef double xbinsize = self._binsizes[0], ybinsize = self._binsizes[1]
+        cdef long xnbin = self._nbins[0], ynbin = self._nbins[1]
+        cdef Py_ssize_t i
+        cdef Py_ssize_t xlen = xval.shape[0]
+        cdef Py_ssize_t wstride = 0 if weight.shape[0] == 1 else 1
+        cdef long xidx, yidx
+        cdef int tid
+        cdef int nthreads = self._fill_threads(xlen)
+        buffers = self._thread_buffers(nthreads)
+        cdef double[:, ::1] data = buffers
+        with nogil, parallel(num_threads=nthreads):
+            tid = threadid()
+            for i in prange(xlen, schedule='static'):
+                xidx = find_indices(xval[i], xlow, xhigh, xbinsize, xnbin)
+                yidx = find_indices(yval[i], ylow, yhigh, ybinsize, ynbin)
+                if xidx != -1 and yidx != -1:
+                    data[tid, xidx * ynbin + yidx] += weight[wstride * i]
+        self._reduce(buffers)
+        return
+
+
+    def _fillnd(self, coords, weight):
+        self._fill_bins(self._bin_indices(coords), weight)
         return
 
 
-    def _fillnd(self, coords, np.ndarray[wnumtype, ndim=1] weight):
-        # allocate pointer arrays per each supported numerical types
-        cdef np.int_t* aint_ptr[MAX_DIMENSIONS]
-        cdef int aint_count = 0
-        cdef np.float_t* afloat_ptr[MAX_DIMENSIONS + 1]
-        cdef int afloat_count = 0
-        # determine order of coordinate arrays according to their
-        # numerical data type
-        numtypes = [np.dtype(int), np.dtype(float)]
-        numtypeindex = {tp : i for i, tp in enumerate(numtypes)}
-        ctypeindices = [numtypeindex.get(x.dtype, 999) for x in coords]
-        coordsorder = np.argsort(ctypeindices, kind='mergesort')
-        istrides = np.asarray(self._values.strides)[coordsorder]
-        istrides //= self._values.itemsize
-        cdef int dataindexstrides[MAX_DIMENSIONS]
-        cdef int i
-        for i in range(self.ndims):
-            dataindexstrides[i] = istrides[i]
-        mylows = self._lows[coordsorder]
-        myhighs = self._highs[coordsorder]
-        mybinsizes = self._binsizes[coordsorder]
-        cdef np.float_t [:] low = mylows
-        cdef np.float_t [:] high = myhighs
-        cdef np.float_t [:] binsize = mybinsizes
-        cdef np.float_t* data = <np.float_t*> _getarrayptr(self._values)
-        # distribute coordinates in each dimension according to their
-        # numerical type.  follow the same order as in numtypes.
+    def bin_indices(self, *coords):
+        """
+        Flat index of the bin each entry falls in.
+
+        Computing the indices once allows repeated fills of the same
+        coordinates (e.g. a per-pixel q map and a stream of detector
+        events) with `fill_bins`.
+
+        Parameters
+        ----------
+        coords : iterable of np.ndarrays
+            one array of coordinates per dimension of the histogram
+
+        Returns
+        -------
+        bins : np.ndarray
+            index of the bin in the flattened `values` for each entry, or
+            -1 if the entry falls outside the histogram
+        """
+        if len(coords) != self.ndims:
+            emsg = "Incorrect number of arguments.  Received {} expected {}."
+            raise ValueError(emsg.format(len(coords), self.ndims))
+        coords = tuple(np.ravel(c) for c in coords)
         for x in coords:
-            if x.dtype == np.int:
-                aint_ptr[aint_count] = <np.int_t*> _getarrayptr(x)
-                aint_count += 1
-            elif x.dtype == np.float:
-                afloat_ptr[afloat_count] = <np.float_t*> _getarrayptr(x)
-                afloat_count += 1
-            else:
-                emsg = "Numpy arrays of type {} are not supported."
-                raise TypeError(emsg.format(x.dtype))
-        cdef int j, k
-        cdef int wstride = 0 if weight.size == 1 else 1
-        cdef int xlen = len(coords[0])
-        cdef int xidx, widx, didx
-        for i in range(xlen):
-            didx = 0
-            for k in range(aint_count):
-                j = k
-                xidx = find_indices(aint_ptr[k][i],
-                                    low[j], high[j], binsize[j])
-                if xidx == -1:
-                    didx = -1
-                    break
-                didx += dataindexstrides[j] * xidx
-            if didx == -1:
-                continue
-            for k in range(afloat_count):
-                j = k + aint_count
-                xidx = find_indices(afloat_ptr[k][i],
-                                    low[j], high[j], binsize[j])
-                if xidx == -1:
-                    didx = -1
-                    break
-                didx += dataindexstrides[j] * xidx
-            if didx == -1:
-                continue
-            widx = wstride * i
-            data[didx] += weight[widx]
+            if len(x) != len(coords[0]):
+                emsg = "Coordinate arrays must have the same length."
+                raise ValueError(emsg)
+        return self._bin_indices(coords)
+
+
+    def fill_bins(self, bins, weights=1):
+        """
+        Increment bins given by their flat index.
+
+        Parameters
+        ----------
+        bins : np.ndarray
+            indices into the flattened `values`, as returned by
+            `bin_indices`.  Entries of -1 are skipped.
+        weights: int/float/np.ndarray, optional.  Defaults to 1.
+            The amount each bin is to be incremented.
+        """
+        bins = np.asarray(np.ravel(bins), dtype=np.intp)
+        weights = np.asarray(weights).reshape(-1)
+        if len(weights) != 1 and len(weights) != len(bins):
+            emsg = ("Weights must be scalar or have the same length "
+                    "as bins.")
+            raise ValueError(emsg)
+        if len(bins) and (bins.min() < -1 or bins.max() >= self._values.size):
+            raise ValueError("Bin indices out of range.")
+        self._fill_bins(bins, weights)
+
+
+    def _bin_indices(self, coords):
+        cdef Py_ssize_t xlen = len(coords[0])
+        # flat index into the histogram of every entry, -1 when any of its
+        # coordinates falls outside the histogram range.  Each dimension
+        # is handled separately so every coordinate array keeps its own
+        # numerical type.
+        flatindex = np.zeros(xlen, dtype=np.intp)
+        istrides = np.asarray(self._values.strides) // self._values.itemsize
+        cdef int nthreads = self._fill_threads(xlen)
+        for k, x in enumerate(coords):
+            _add_flat_indices(x, flatindex, self._lows[k], self._highs[k],
+                              self._binsizes[k], self._nbins[k],
+                              istrides[k], nthreads)
+        return flatindex
+
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _fill_bins(self, const np.intp_t[:] didx,
+                   const wnumtype[:] weight):
+        cdef Py_ssize_t i
+        cdef Py_ssize_t xlen = didx.shape[0]
+        cdef Py_ssize_t wstride = 0 if weight.shape[0] == 1 else 1
+        cdef int tid
+        cdef int nthreads = self._fill_threads(xlen)
+        buffers = self._thread_buffers(nthreads)
+        cdef double[:, ::1] data = buffers
+        with nogil, parallel(num_threads=nthreads):
+            tid = threadid()
+            for i in prange(xlen, schedule='static'):
+                if didx[i] != -1:
+                    data[tid, didx[i]] += weight[wstride * i]
+        self._reduce(buffers)
         return
 
 
@@ -278,24 +350,36 @@ class Histogram:
         return [bin_edges_to_centers(edge) for edge in self.edges]
 
 
-cdef long find_indices(coordnumtype pos, double low, double high, double binsize):
+cdef inline long find_indices(coordnumtype pos, double low, double high,
+                              double binsize, long nbin) nogil:
+    cdef long idx
     if not (low <= pos < high):
         return -1
-    return int((pos - low) / binsize)
-
-
-cdef void fillonecy(coordnumtype xval, wnumtype weight,
-                    np.float_t* pdata,
-                    double low, double high, double binsize):
-    iidx = find_indices(xval, low, high, binsize)
-    if iidx == -1:
-        return
-    pdata[iidx] += weight
-    return
+    idx = <long> ((pos - low) / binsize)
+    # guard against round-off just below the upper edge
+    return idx if idx < nbin else nbin - 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _add_flat_indices(const coordnumtype[:] xval, np.intp_t[:] flatindex,
+                      double low, double high, double binsize, long nbin,
+                      Py_ssize_t stride, int nthreads):
+    cdef Py_ssize_t i
+    cdef long xidx
+    with nogil:
+        for i in prange(xval.shape[0], schedule='static',
+                        num_threads=nthreads):
+            if flatindex[i] == -1:
+                continue
+            xidx = find_indices(xval[i], low, high, binsize, nbin)
+            if xidx == -1:
+                flatindex[i] = -1
+            else:
+                flatindex[i] += stride * xidx
 
 
 #TODO function interface
 #TODO generator interface
 #TODO docs!
 #TODO examples
-#TODO Can we support ND histogram for mixed coordinate types?
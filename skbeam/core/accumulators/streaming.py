@@ -0,0 +1,581 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+"""
+Streaming accumulators.
+
+Every accumulator follows the same protocol: ``update(chunk)`` folds a
+chunk of data in, ``merge(other)`` folds in an accumulator of the same
+kind that was filled elsewhere (another process, another detector module)
+and ``finalize()`` returns the result.  Merging is exact, so the result
+does not depend on how the data was split between accumulators.
+
+The windowed and exponentially decaying accumulators follow the most
+recent frames for live monitoring; they depend on the order of the frames
+and cannot be merged.
+"""
+from __future__ import absolute_import, division, print_function
+
+from collections import namedtuple
+
+import numpy as np
+
+from .histogram import Histogram
+
+
+moments = namedtuple('moments', ['count', 'sum', 'mean', 'var', 'std'])
+
+
+# why the moving window and average accumulators cannot be merged
+_WINDOW = "the window holds the last frames of a single, ordered stream"
+_DECAY = ("the weight of each frame depends on its position in a single, "
+          "ordered stream")
+
+
+class StreamingAccumulator(object):
+    """
+    Base class of the streaming accumulators.
+
+    Chunks are stacks of frames, of shape ``(M,) + frame_shape``; the
+    statistics are accumulated along the first axis, separately for every
+    element of the frame.  The frame shape is fixed by the first update.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget all data accumulated so far."""
+        self.count = 0
+        self.shape = None
+
+    def update(self, chunk):
+        """
+        Accumulate a chunk of frames.
+
+        Parameters
+        ----------
+        chunk : array_like
+            Stack of frames, shape ``(M,) + frame_shape``
+
+        Returns
+        -------
+        self
+        """
+        chunk = np.asarray(chunk)
+        if chunk.ndim == 0:
+            raise ValueError("chunk must be a stack of frames, "
+                             "got a scalar")
+        if self.shape is None:
+            self.shape = chunk.shape[1:]
+        elif chunk.shape[1:] != self.shape:
+            raise ValueError("frames of shape {} cannot be accumulated with "
+                             "frames of shape {}".format(chunk.shape[1:],
+                                                         self.shape))
+        if len(chunk):
+            self._update(chunk)
+            self.count += len(chunk)
+        return self
+
+    def merge(self, other):
+        """
+        Fold in the data accumulated by another accumulator.
+
+        Parameters
+        ----------
+        other : StreamingAccumulator
+            accumulator of the same type, it is left unchanged
+
+        Returns
+        -------
+        self
+        """
+        if type(other) is not type(self):
+            raise TypeError("cannot merge {} into {}".format(
+                type(other).__name__, type(self).__name__))
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            # only the data, the configuration (e.g. ddof) is kept
+            self.count, self.shape = other.count, other.shape
+            self._copy_state(other)
+            return self
+        if other.shape != self.shape:
+            raise ValueError("cannot merge accumulators of frame shapes {} "
+                             "and {}".format(other.shape, self.shape))
+        self._merge(other)
+        self.count += other.count
+        return self
+
+    def finalize(self):
+        """Return the accumulated result."""
+        raise NotImplementedError()
+
+    def _update(self, chunk):
+        pass
+
+    def _merge(self, other):
+        pass
+
+    def _copy_state(self, other):
+        # take the accumulated data of other, self being empty
+        pass
+
+
+class CountAccumulator(StreamingAccumulator):
+    """Count the frames."""
+    def finalize(self):
+        """
+        Returns
+        -------
+        count : int
+            number of frames accumulated
+        """
+        return self.count
+
+
+class MinMaxAccumulator(StreamingAccumulator):
+    """Per-element minimum and maximum over the frames."""
+    def reset(self):
+        super(MinMaxAccumulator, self).reset()
+        self.min = None
+        self.max = None
+
+    def _update(self, chunk):
+        cmin = chunk.min(axis=0)
+        cmax = chunk.max(axis=0)
+        if self.min is None:
+            self.min, self.max = cmin, cmax
+        else:
+            # not in place: frames may be scalars, and the type of the
+            # chunks may change, e.g. from int to float
+            self.min = np.minimum(self.min, cmin)
+            self.max = np.maximum(self.max, cmax)
+
+    def _merge(self, other):
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+
+    def _copy_state(self, other):
+        self.min, self.max = np.copy(other.min), np.copy(other.max)
+
+    def finalize(self):
+        """
+        Returns
+        -------
+        min, max : array
+            per-element extrema, shape ``frame_shape``
+        """
+        return self.min, self.max
+
+
+class MomentAccumulator(StreamingAccumulator):
+    """
+    Per-element sum, mean and variance over the frames.
+
+    The running mean and sum of squared deviations are updated with
+    Welford's algorithm, extended to chunks and to merging as in [1]_,
+    which avoids the catastrophic cancellation of accumulating sum and
+    sum of squares over long acquisitions.
+
+    Parameters
+    ----------
+    ddof : int, optional
+        delta degrees of freedom of the variance, see `numpy.var`
+
+    References
+    ----------
+    .. [1] T. F. Chan, G. H. Golub and R. J. LeVeque, "Algorithms for
+       computing the sample variance: analysis and recommendations,"
+       The American Statistician, vol 37, pp 242-247, 1983.
+    """
+    def __init__(self, ddof=0):
+        self.ddof = ddof
+        super(MomentAccumulator, self).__init__()
+
+    def reset(self):
+        super(MomentAccumulator, self).reset()
+        self.mean = None
+        self.m2 = None
+
+    def _combine(self, n, mean, m2):
+        # fold n samples of the given mean and sum of squared deviations
+        # into the running ones
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * (n / total)
+        self.m2 += m2 + delta ** 2 * (self.count * n / total)
+
+    def _update(self, chunk):
+        mean = chunk.mean(axis=0, dtype=float)
+        m2 = ((chunk - mean) ** 2).sum(axis=0)
+        if self.mean is None:
+            self.mean, self.m2 = mean, m2
+        else:
+            self._combine(len(chunk), mean, m2)
+
+    def _merge(self, other):
+        self._combine(other.count, other.mean, other.m2)
+
+    def _copy_state(self, other):
+        self.mean, self.m2 = np.copy(other.mean), np.copy(other.m2)
+
+    def finalize(self):
+        """
+        Returns
+        -------
+        moments : namedtuple
+            ``(count, sum, mean, var, std)``, the arrays have shape
+            ``frame_shape``
+        """
+        if self.count == 0:
+            return moments(0, None, None, None, None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = self.m2 / (self.count - self.ddof)
+        return moments(self.count, self.mean * self.count, self.mean.copy(),
+                       var, np.sqrt(var))
+
+
+class _RingSum(object):
+    """
+    Sum of the last `window` frames pushed, kept up to date by adding the
+    new frame and subtracting the one it evicts.  The sum is recomputed
+    from the stored frames once per turn of the ring, so round-off does
+    not build up.
+    """
+    def __init__(self, window, shape, dtype=float):
+        if window < 1:
+            raise ValueError("window must hold at least one frame")
+        self.frames = np.zeros((window,) + tuple(shape), dtype=dtype)
+        self.sum = np.zeros(shape, dtype=dtype)
+        self.pos = 0
+        self.count = 0
+
+    def push(self, frame):
+        self.sum -= self.frames[self.pos]
+        self.frames[self.pos] = frame
+        self.sum += self.frames[self.pos]
+        self.pos = (self.pos + 1) % len(self.frames)
+        self.count = min(self.count + 1, len(self.frames))
+        if self.pos == 0:
+            self.frames.sum(axis=0, out=self.sum)
+
+
+class WindowAccumulator(StreamingAccumulator):
+    """
+    Per-element mean over the last `window` frames.
+
+    Each frame costs one addition and one subtraction of a frame, whatever
+    the window length.  Feed it per-frame results, e.g. the output of
+    `BinnedStatisticDD.stack`, to follow them over a sliding window.
+
+    Unlike the other accumulators, it cannot be merged: the window holds
+    the last frames of a single, ordered stream, which accumulators fed
+    with separate parts of the data do not know.
+
+    Parameters
+    ----------
+    window : int
+        number of frames in the window
+    """
+    def __init__(self, window):
+        self.window = window
+        super(WindowAccumulator, self).__init__()
+
+    def reset(self):
+        super(WindowAccumulator, self).reset()
+        self.ring = None
+
+    def _update(self, chunk):
+        if self.ring is None:
+            self.ring = _RingSum(self.window, self.shape)
+        for frame in chunk:
+            self.ring.push(frame)
+
+    def merge(self, other):
+        """Not supported, see `WindowAccumulator`."""
+        raise TypeError("WindowAccumulator cannot be merged: " + _WINDOW)
+
+    def finalize(self):
+        """
+        Returns
+        -------
+        mean : array
+            per-element mean over the frames in the window, shape
+            ``frame_shape``
+        """
+        if self.ring is None:
+            return None
+        return self.ring.sum / self.ring.count
+
+
+class DecayingAccumulator(StreamingAccumulator):
+    """
+    Per-element exponentially weighted moving average over the frames.
+
+    Every new frame updates the average in place as
+    ``mean += alpha * (frame - mean)``.
+
+    Unlike the other accumulators, it cannot be merged: the weight of each
+    frame depends on its position in a single, ordered stream, which
+    accumulators fed with separate parts of the data do not know.
+
+    Parameters
+    ----------
+    alpha : float
+        weight of the newest frame, between 0 and 1
+    """
+    def __init__(self, alpha):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1], got {}".format(alpha))
+        self.alpha = alpha
+        super(DecayingAccumulator, self).__init__()
+
+    def reset(self):
+        super(DecayingAccumulator, self).reset()
+        self.mean = None
+
+    def _update(self, chunk):
+        start = 0
+        if self.mean is None:
+            self.mean = np.array(chunk[0], dtype=float)
+            start = 1
+        for frame in chunk[start:]:
+            self.mean += self.alpha * (frame - self.mean)
+
+    def merge(self, other):
+        """Not supported, see `DecayingAccumulator`."""
+        raise TypeError("DecayingAccumulator cannot be merged: " + _DECAY)
+
+    def finalize(self):
+        """
+        Returns
+        -------
+        mean : array
+            exponentially weighted per-element mean, shape ``frame_shape``
+        """
+        return None if self.mean is None else self.mean.copy()
+
+
+class HistogramAccumulator(Histogram):
+    """
+    Histogram following the streaming accumulator protocol.
+
+    Takes the same parameters as `Histogram`.  `update` takes the
+    coordinates as ``chunk``, an array for 1D histograms or a sequence
+    of ``ndims`` arrays otherwise, and accumulates them with `fill`.
+    """
+    def update(self, chunk, weights=1):
+        """
+        Accumulate a chunk of coordinates.
+
+        Parameters
+        ----------
+        chunk : array_like or sequence of array_like
+            coordinates; a sequence of ``ndims`` arrays for histograms of
+            more than one dimension
+        weights : int/float/np.ndarray, optional
+            see `Histogram.fill`
+
+        Returns
+        -------
+        self
+        """
+        if self.ndims == 1:
+            chunk = (chunk,)
+        self.fill(*chunk, weights=weights)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of a histogram with the same binning.
+
+        Parameters
+        ----------
+        other : Histogram
+            it is left unchanged
+
+        Returns
+        -------
+        self
+        """
+        if not (np.array_equal(self._nbins, other._nbins) and
+                np.array_equal(self._lows, other._lows) and
+                np.array_equal(self._highs, other._highs)):
+            raise ValueError("cannot merge histograms of different binning")
+        self._values += other._values
+        return self
+
+    def finalize(self):
+        """
+        Returns
+        -------
+        values : array
+            copy of the histogram values
+        """
+        return self._values.copy()
+
+
+class WindowedHistogram(HistogramAccumulator):
+    """
+    Histogram of the last `window` frames.
+
+    Every `update` is one frame.  The histogram of each frame is kept in a
+    ring buffer and subtracted again when the frame leaves the window, so
+    an update costs the fill of the frame plus two passes over the bins.
+    As `WindowAccumulator`, it cannot be merged.
+
+    Parameters
+    ----------
+    window : int
+        number of frames in the window
+    binlowhigh, args :
+        binning, see `Histogram`
+    """
+    def __init__(self, window, binlowhigh, *args):
+        super(WindowedHistogram, self).__init__(binlowhigh, *args)
+        # histogram of the current frame
+        self._frame = Histogram(binlowhigh, *args)
+        self.window = window
+        self._ring = _RingSum(window, self._values.shape)
+
+    def reset(self):
+        super(WindowedHistogram, self).reset()
+        self._ring = _RingSum(self.window, self._values.shape)
+
+    def update(self, chunk, weights=1):
+        """
+        Accumulate one frame of coordinates, and drop the oldest frame if
+        the window is full.  See `HistogramAccumulator.update`.
+        """
+        self._frame.reset()
+        if self.ndims == 1:
+            chunk = (chunk,)
+        self._frame.fill(*chunk, weights=weights)
+        self._ring.push(self._frame.values)
+        self._values[...] = self._ring.sum
+        return self
+
+    def merge(self, other):
+        """Not supported, see `WindowedHistogram`."""
+        raise TypeError("WindowedHistogram cannot be merged: " + _WINDOW)
+
+
+class DecayingHistogram(HistogramAccumulator):
+    """
+    Exponentially weighted moving average of per-frame histograms.
+
+    Every `update` is one frame: the histogram is scaled in place by
+    ``1 - alpha`` and the frame is filled in with weights scaled by
+    ``alpha``.  As for `DecayingAccumulator`, the average starts from the
+    first frame, and it cannot be merged.
+
+    Parameters
+    ----------
+    alpha : float
+        weight of the newest frame, between 0 and 1
+    binlowhigh, args :
+        binning, see `Histogram`
+    """
+    def __init__(self, alpha, binlowhigh, *args):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1], got {}".format(alpha))
+        super(DecayingHistogram, self).__init__(binlowhigh, *args)
+        self.alpha = alpha
+        self.nframes = 0
+
+    def reset(self):
+        super(DecayingHistogram, self).reset()
+        self.nframes = 0
+
+    def update(self, chunk, weights=1):
+        """
+        Decay the histogram and accumulate one frame of coordinates.  See
+        `HistogramAccumulator.update`.
+        """
+        if self.nframes:
+            self._values *= 1 - self.alpha
+            weights = self.alpha * np.asarray(weights, dtype=float)
+        self.nframes += 1
+        return super(DecayingHistogram, self).update(chunk, weights)
+
+    def merge(self, other):
+        """Not supported, see `DecayingHistogram`."""
+        raise TypeError("DecayingHistogram cannot be merged: " + _DECAY)
+
+
+class EventHistogram(HistogramAccumulator):
+    """
+    Histogram of detector events.
+
+    The bin of every pixel is looked up once from per-pixel coordinates
+    (e.g. a q map), after which events are accumulated from their pixel
+    index alone, without building dense frames.
+
+    Parameters
+    ----------
+    pixel_coords : array_like or sequence of array_like
+        coordinates of every pixel; a sequence of ``ndims`` arrays for
+        histograms of more than one dimension.  The arrays are flattened,
+        pixel indices refer to the flattened arrays.
+    binlowhigh, args :
+        binning, see `Histogram`
+    """
+    def __init__(self, pixel_coords, binlowhigh, *args):
+        super(EventHistogram, self).__init__(binlowhigh, *args)
+        if self.ndims == 1:
+            pixel_coords = (pixel_coords,)
+        self.pixel_bins = self.bin_indices(*pixel_coords)
+
+    def update(self, chunk, weights=1):
+        """
+        Accumulate a chunk of events.
+
+        Parameters
+        ----------
+        chunk : array_like
+            pixel index of each event
+        weights : int/float/np.ndarray, optional
+            value of each event, defaults to 1
+
+        Returns
+        -------
+        self
+        """
+        pixels = np.asarray(chunk, dtype=np.intp)
+        npixels = len(self.pixel_bins)
+        if pixels.size and (pixels.min() < 0 or pixels.max() >= npixels):
+            raise ValueError("Pixel indices must be between 0 and {}"
+                             "".format(npixels - 1))
+        self.fill_bins(self.pixel_bins[pixels], weights)
+        return self
@@ -1,11 +1,13 @@
 from skbeam.core.accumulators.binned_statistic import (RadialBinnedStatistic,
                                                        RPhiBinnedStatistic,
-                                                       BinnedStatistic1D)
+                                                       BinnedStatistic1D,
+                                                       BinnedStatisticDD)
 from nose.tools import assert_raises
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 import numpy as np
 import scipy.stats
-from ...utils import bin_edges_to_centers
+from ...utils import bin_edges_to_centers, radial_grid
+from ...roi import circular_average
 
 stats_list = [('mean', np.mean), ('median', np.median), ('count', len),
               ('sum', np.sum), ('std', np.std)]
@@ -217,3 +219,165 @@ def test_BinnedStatistics1D():
 
     # try with same shape, should be fine
     rbinstat(x)
+
+
+def test_stack():
+    shape = (31, 42)
+    frames = np.random.random((5, ) + shape)
+    mask = np.random.randint(2, size=shape)
+    statistics = [stat for stat, _ in stats_list] + [np.max]
+
+    for binstat in (RadialBinnedStatistic(shape, 20, mask=mask),
+                    RPhiBinnedStatistic(shape, (10, 4), mask=mask)):
+        stacked = binstat.stack(frames, statistics)
+        assert len(stacked) == len(statistics)
+        for stat, result in zip(statistics, stacked):
+            ref = np.array([binstat(frame, stat) for frame in frames])
+            assert result.shape == ref.shape
+            assert_array_almost_equal(result, ref)
+
+        # a single statistic gives back a single array
+        assert_array_almost_equal(binstat.stack(frames, 'sum'), stacked[3])
+        assert_array_almost_equal(binstat.stack(frames),
+                                  binstat.stack(frames, binstat.statistic))
+
+        with assert_raises(ValueError):
+            binstat.stack(frames[:, :10, :10])
+        with assert_raises(ValueError):
+            binstat.stack(frames, ['mean', 'mode'])
+
+    x = np.linspace(0, 2*np.pi, 100)
+    bs = BinnedStatistic1D(x, bins=10)
+    values = np.array([np.sin(x * 5), np.cos(x * 3)])
+    assert_array_almost_equal(bs.stack(values, 'std'),
+                              [bs(v, 'std') for v in values])
+
+
+def test_sparse(tmpdir):
+    shape = (41, 52)
+    image = np.random.random(shape)
+    mask = np.random.randint(2, size=shape)
+
+    for stat in ('mean', 'std', 'count', 'sum'):
+        ref = RadialBinnedStatistic(shape, 30, mask=mask, statistic=stat)
+        rbs = RadialBinnedStatistic(shape, 30, mask=mask, statistic=stat,
+                                    sparse=True)
+        assert_array_almost_equal(rbs(image), ref(image))
+        # other statistics do not go through the sparse matrix
+        assert_array_equal(rbs(image, 'median'), ref(image, 'median'))
+        ref = RPhiBinnedStatistic(shape, (10, 4), mask=mask, statistic=stat)
+        rphibs = RPhiBinnedStatistic(shape, (10, 4), mask=mask,
+                                     statistic=stat, sparse=True)
+        assert_array_almost_equal(rphibs(image), ref(image))
+
+    # sub-pixels share each pixel between bins, but all of it is counted
+    # when the range covers the whole image
+    for n in (2, 3):
+        rbs = RadialBinnedStatistic(shape, 10, statistic='count',
+                                    range=(0, 100), subpixels=n)
+        assert_array_almost_equal(rbs(image).sum(), image.size)
+        rphibs = RPhiBinnedStatistic(shape, (10, 4), statistic='count',
+                                     range=((0, 100), (-np.pi, np.pi)),
+                                     subpixels=n)
+        assert_array_almost_equal(rphibs(image).sum(), image.size)
+        assert_array_almost_equal(rphibs(np.ones(shape), 'sum'),
+                                  rphibs(image))
+    with assert_raises(ValueError):
+        RadialBinnedStatistic(shape, 10, r_map=np.ones(shape), subpixels=2)
+
+    # the binning survives a round trip through a file
+    fname = str(tmpdir.join('binning.npz'))
+    rbs = RadialBinnedStatistic(shape, 30, mask=mask, subpixels=2)
+    rbs.save(fname)
+    loaded = RadialBinnedStatistic.load(fname)
+    assert loaded.statistic == rbs.statistic
+    assert_array_equal(loaded(image), rbs(image))
+    assert_array_equal(loaded(image, 'median'), rbs(image, 'median'))
+    assert_array_equal(loaded.bin_centers, rbs.bin_centers)
+    with assert_raises(ValueError):
+        loaded(image[:10, :10])
+
+
+def test_split_pixels():
+    shape = (41, 52)
+    origin = (20.3, 25.7)
+    bins = np.linspace(2, 20, 37)
+    mask = np.random.randint(2, size=shape)
+    image = np.random.random(shape)
+
+    rbs = RadialBinnedStatistic(shape, bins, origin=origin, mask=mask,
+                                split_pixels=True)
+    assert_array_almost_equal(rbs(np.ones(shape)), np.ones(36))
+    # same as the split circular average
+    ref = circular_average(image, origin, min_x=2, max_x=20, nx=36,
+                           mask=mask, split_pixels=True)[1]
+    assert_array_almost_equal(rbs(image), ref)
+    assert_array_almost_equal(rbs.stack([image, 2 * image]),
+                              [ref, 2 * ref])
+
+    # pixel extents can also be interpolated from a map of radii
+    r_map = radial_grid(origin, shape)
+    rbs_map = RadialBinnedStatistic(shape, bins, r_map=r_map, mask=mask,
+                                    split_pixels=True)
+    assert_array_almost_equal(rbs_map(np.ones(shape)), np.ones(36))
+    assert_array_almost_equal(rbs_map(r_map), rbs(r_map), decimal=1)
+
+    with assert_raises(ValueError):
+        RadialBinnedStatistic(shape, 10, split_pixels=True, subpixels=2)
+
+
+def test_BinnedStatisticDD_edges():
+    sample = np.random.random((1000, 2)) * 10
+    sample[:11, 0] = np.arange(11)  # right on the edges
+    sample[11, 0] = np.nextafter(10, 0)
+    original = sample.copy()
+    mask = np.random.randint(2, size=1000)
+    values = np.random.random(1000)
+
+    # uniform bins are computed from the bin width
+    uniform = BinnedStatisticDD(sample, 'sum', bins=10,
+                                range=((0, 10), (0, 10)), mask=mask)
+    # the constructor leaves the sample alone
+    assert_array_equal(sample, original)
+    # np.histogramdd rather than scipy, which moves points within rounding
+    # of the last edge into the previous bin
+    ref, _ = np.histogramdd(sample, bins=10, range=((0, 10), (0, 10)),
+                            weights=values * mask)
+    assert_array_almost_equal(uniform(values), ref)
+
+    # non-uniform bins
+    edges = [np.linspace(0, 10, 11), np.linspace(0, 10, 11) ** 2 / 10]
+    explicit = BinnedStatisticDD(sample, 'sum', bins=edges, mask=mask)
+    ref, _ = np.histogramdd(sample, bins=edges, weights=values * mask)
+    assert_array_almost_equal(explicit(values), ref)
+
+
+def test_events():
+    shape = (41, 52)
+    mask = np.random.randint(2, size=shape)
+    # sparse events, with some pixels hit more than once
+    pixels = np.random.randint(shape[0] * shape[1], size=300)
+    weights = np.random.random(300)
+    image = np.bincount(pixels, weights,
+                        minlength=shape[0] * shape[1]).reshape(shape)
+    counts = np.bincount(pixels,
+                         minlength=shape[0] * shape[1]).reshape(shape)
+
+    for kwargs in ({}, {'sparse': True}, {'subpixels': 2},
+                   {'split_pixels': True}):
+        rbs = RadialBinnedStatistic(shape, 20, range=(2, 25), mask=mask,
+                                    **kwargs)
+        rphi = RPhiBinnedStatistic(shape, (10, 6), mask=mask,
+                                   sparse=kwargs.get('sparse', False))
+        for stat in ('mean', 'std', 'count', 'sum'):
+            assert_array_almost_equal(rbs.events(pixels, weights, stat),
+                                      rbs(image, stat))
+            assert_array_almost_equal(rbs.events(pixels, statistic=stat),
+                                      rbs(counts, stat))
+            assert_array_almost_equal(rphi.events(pixels, weights, stat),
+                                      rphi(image, stat))
+
+    with assert_raises(ValueError):
+        rbs.events(pixels, statistic='median')
+    with assert_raises(ValueError):
+        rbs.events([shape[0] * shape[1]])
@@ -2,7 +2,7 @@ from __future__ import division
 import numpy as np
 from numpy.testing import assert_array_almost_equal, assert_array_equal
 from numpy.testing import assert_almost_equal
-from nose.tools import raises
+from nose.tools import raises, assert_raises
 from skbeam.core.accumulators.histogram import Histogram
 from time import time
 import random
@@ -125,6 +125,65 @@ def test_simple_pass():
     assert_array_equal(h.values, np_res)
 
 
+def test_threaded_fill():
+    x = np.random.random(500000) * 12
+    y = np.random.random(500000) * 10
+    w = np.random.random(500000)
+    for fillnd in (False, True):
+        h1 = Histogram((10, 0, 10.01), (9, 0, 9.01))
+        h1._always_use_fillnd = fillnd
+        h1.num_threads = 1
+        h1.fill(x, y, weights=w)
+        h4 = Histogram((10, 0, 10.01), (9, 0, 9.01))
+        h4._always_use_fillnd = fillnd
+        h4.num_threads = 4
+        assert h4._fill_threads(len(x)) == 4
+        h4.fill(x, y, weights=w)
+        assert_array_almost_equal(h1.values, h4.values)
+        ynp = np.histogram2d(x, y, bins=h1.edges, weights=w)[0]
+        assert_array_almost_equal(ynp, h4.values)
+
+
+def test_coordinate_types():
+    x = np.random.random(10000) * 12
+    h = Histogram((12, 0, 12))
+    ynp = np.histogram(x.astype(np.float32), h.edges[0])[0]
+    for dtype in (np.float32, np.int16, np.uint8):
+        h.reset()
+        h.fill(x.astype(dtype))
+        assert_array_equal(np.histogram(x.astype(dtype), h.edges[0])[0],
+                           h.values)
+    # read-only arrays are accepted as well
+    xf = x.astype(np.float32)
+    xf.flags.writeable = False
+    h.reset()
+    h.fill(xf)
+    assert_array_equal(ynp, h.values)
+    # mixed coordinate types are binned by the N-dimensional fill
+    xi = x.astype(np.int32)
+    h = Histogram((12, 0, 12), (12, 0, 12), (12, 0, 12))
+    h.fill(xi, xf, x)
+    ynp = np.histogramdd(np.c_[xi, xf, x], bins=h.edges)[0]
+    assert_array_equal(ynp, h.values)
+
+
+def test_fill_bins():
+    x = np.random.random(1000) * 12
+    y = np.random.random(1000) * 10
+    w = np.random.random(1000)
+    h = Histogram((10, 0, 10), (5, 0, 10))
+    bins = h.bin_indices(x, y)
+    assert_array_equal(bins == -1, x >= 10)
+    h.fill_bins(bins, weights=w)
+    h.fill_bins(bins[:10])
+    ref = Histogram((10, 0, 10), (5, 0, 10))
+    ref.fill(x, y, weights=w)
+    ref.fill(x[:10], y[:10])
+    assert_array_almost_equal(h.values, ref.values)
+    assert_raises(ValueError, h.fill_bins, [50])
+    assert_raises(ValueError, h.fill_bins, bins, weights=w[:10])
+
+
 if __name__ == '__main__':
     import itertools
 
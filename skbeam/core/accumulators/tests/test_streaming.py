@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function
+
+import pickle
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from nose.tools import assert_equal, assert_raises
+
+from skbeam.core.accumulators.streaming import (CountAccumulator,
+                                                MinMaxAccumulator,
+                                                MomentAccumulator,
+                                                HistogramAccumulator,
+                                                EventHistogram,
+                                                WindowAccumulator,
+                                                DecayingAccumulator,
+                                                WindowedHistogram,
+                                                DecayingHistogram)
+from skbeam.core.accumulators.binned_statistic import RadialBinnedStatistic
+
+
+def _split_and_merge(acc_type, chunks, *args, **kwargs):
+    # accumulate every chunk separately and merge the results
+    accs = [acc_type(*args, **kwargs).update(c) for c in chunks]
+    total = acc_type(*args, **kwargs)
+    for acc in accs:
+        total.merge(pickle.loads(pickle.dumps(acc)))
+    return total
+
+
+def test_moments():
+    data = 1e6 + np.random.random((50, 4, 5))
+    chunks = [data[:3], data[3:4], data[4:4], data[4:31], data[31:]]
+    for ddof in (0, 1):
+        streamed = MomentAccumulator(ddof=ddof)
+        for c in chunks:
+            streamed.update(c)
+        merged = _split_and_merge(MomentAccumulator, chunks, ddof=ddof)
+        for acc in (streamed, merged):
+            res = acc.finalize()
+            assert_equal(res.count, 50)
+            assert_array_almost_equal(res.sum, data.sum(axis=0), decimal=4)
+            assert_array_almost_equal(res.mean, data.mean(axis=0))
+            assert_array_almost_equal(res.var, data.var(axis=0, ddof=ddof))
+            assert_array_almost_equal(res.std, data.std(axis=0, ddof=ddof))
+    assert_equal(MomentAccumulator().finalize().count, 0)
+
+    # merging into an empty accumulator keeps its own ddof
+    res = MomentAccumulator(ddof=1).merge(
+        MomentAccumulator().update(data)).finalize()
+    assert_array_almost_equal(res.var, data.var(axis=0, ddof=1))
+
+
+def test_minmax_count():
+    data = np.random.random((20, 3))
+    chunks = np.array_split(data, 4)
+    mn, mx = _split_and_merge(MinMaxAccumulator, chunks).finalize()
+    assert_array_equal(mn, data.min(axis=0))
+    assert_array_equal(mx, data.max(axis=0))
+    assert_equal(_split_and_merge(CountAccumulator, chunks).finalize(), 20)
+
+    acc = CountAccumulator().update(data)
+    assert_raises(ValueError, acc.update, data[:, :2])
+    assert_raises(TypeError, acc.merge, MinMaxAccumulator())
+
+
+def test_minmax_scalar_frames():
+    acc = MinMaxAccumulator().update(np.array([1, 5, 2]))
+    acc.update(np.array([0.5, 7.]))
+    other = MinMaxAccumulator().update(np.array([3., 8.]))
+    mn, mx = acc.merge(other).finalize()
+    assert_equal(mn, 0.5)
+    assert_equal(mx, 8.)
+    assert_equal(acc.count, 7)
+
+
+def test_histogram_accumulator():
+    x = np.random.random(1000) * 10
+    y = np.random.random(1000) * 10
+    h = _split_and_merge(HistogramAccumulator, [(x[:300], y[:300]),
+                                                (x[300:], y[300:])],
+                         (10, 0, 10), (8, 0, 10))
+    ref = HistogramAccumulator((10, 0, 10), (8, 0, 10)).update((x, y))
+    assert_array_almost_equal(h.finalize(), ref.finalize())
+
+    h1 = HistogramAccumulator((10, 0, 10)).update(x)
+    assert_array_equal(h1.finalize(), np.histogram(x, h1.edges[0])[0])
+    assert_raises(ValueError, h1.merge, HistogramAccumulator((5, 0, 10)))
+
+
+def test_event_histogram():
+    q_map = np.random.random((30, 40)) * 5
+    phi_map = np.random.random((30, 40)) * 3
+    pixels = np.random.randint(q_map.size, size=500)
+    weights = np.random.random(500)
+
+    h = EventHistogram(q_map, (10, 0, 5))
+    h.update(pixels[:200], weights[:200]).update(pixels[200:], weights[200:])
+    ref = np.histogram(q_map.ravel()[pixels], h.edges[0], weights=weights)[0]
+    assert_array_almost_equal(h.finalize(), ref)
+
+    h2 = EventHistogram((q_map, phi_map), (10, 0, 5), (6, 0, 3))
+    h2.update(pixels)
+    ref = np.histogram2d(q_map.ravel()[pixels], phi_map.ravel()[pixels],
+                         bins=h2.edges)[0]
+    assert_array_almost_equal(h2.finalize(), ref)
+    assert_raises(ValueError, h2.update, [-1, 0])
+    assert_raises(ValueError, h2.update, [q_map.size])
+    assert_array_almost_equal(h2.finalize(), ref)
+
+
+def test_window():
+    frames = np.random.random((25, 30, 40))
+    rbs = RadialBinnedStatistic((30, 40), 8)
+    binned = rbs.stack(frames)
+    acc = WindowAccumulator(10)
+    assert_equal(acc.finalize(), None)
+    acc.update(binned[:3])
+    assert_array_almost_equal(acc.finalize(), binned[:3].mean(axis=0))
+    for i in range(3, 25, 4):
+        acc.update(binned[i:i + 4])
+    assert_array_almost_equal(acc.finalize(), binned[-10:].mean(axis=0))
+    assert_raises(TypeError, acc.merge, WindowAccumulator(10))
+
+    x = np.random.random((25, 100)) * 10
+    h = WindowedHistogram(10, (10, 0, 10))
+    for frame in x:
+        h.update(frame)
+    ref = np.histogram(x[-10:], h.edges[0])[0]
+    assert_array_almost_equal(h.finalize(), ref)
+    h.reset()
+    h.update(x[0])
+    assert_array_almost_equal(h.finalize(), np.histogram(x[0], h.edges[0])[0])
+    assert_raises(TypeError, h.merge, WindowedHistogram(10, (10, 0, 10)))
+
+
+def test_decay():
+    alpha = 0.3
+    frames = np.random.random((20, 5))
+    acc = DecayingAccumulator(alpha).update(frames[:7]).update(frames[7:])
+    ref = frames[0]
+    for frame in frames[1:]:
+        ref = (1 - alpha) * ref + alpha * frame
+    assert_array_almost_equal(acc.finalize(), ref)
+    assert_raises(ValueError, DecayingAccumulator, 0)
+    assert_raises(TypeError, acc.merge, DecayingAccumulator(alpha))
+
+    x = np.random.random((20, 100)) * 10
+    h = DecayingHistogram(alpha, (10, 0, 10))
+    ref = np.histogram(x[0], h.edges[0])[0]
+    for frame in x:
+        h.update(frame)
+    for frame in x[1:]:
+        ref = (1 - alpha) * ref + alpha * np.histogram(frame, h.edges[0])[0]
+    assert_array_almost_equal(h.finalize(), ref)
+    assert_raises(TypeError, h.merge, DecayingHistogram(alpha, (10, 0, 10)))
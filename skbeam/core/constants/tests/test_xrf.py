@@ -36,14 +36,22 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+
 import six
 import numpy as np
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_raises)
-from nose.tools import assert_equal, assert_not_equal
+from nose.tools import assert_equal, assert_not_equal, assert_true
 
+from skbeam.core.constants import xrf
 from skbeam.core.constants.xrf import (XrfElement, emission_line_search,
-                                       XrayLibWrap, XrayLibWrap_Energy)
+                                       XrayLibWrap, XrayLibWrap_Energy,
+                                       XraylibCache, XRAYLIB_CACHE,
+                                       get_xrf_element, EmissionLineIndex)
+from skbeam.testing.decorators import known_fail_if
 from skbeam.core.utils import NotInstalledError
 from skbeam.core.constants.basic import basic
 
@@ -132,6 +140,72 @@ def test_cs_different_units():
         assert_array_almost_equal(cs1, cs2, decimal=10)
 
 
+@known_fail_if(xrf.xraylib is None)
+def test_xraylib_cache():
+    e = get_xrf_element('fe')
+    assert_true(e is get_xrf_element(26))
+    assert_true(e is get_xrf_element('Iron'))
+
+    XRAYLIB_CACHE.clear()
+    misses = XRAYLIB_CACHE.misses
+    energy = e.emission_line['Ka1']
+    cs = e.cs(12)['ka1']
+    assert_equal(XRAYLIB_CACHE.misses, misses + 2)
+    assert_equal(XrfElement('Fe').emission_line['ka1'], energy)
+    assert_equal(XrayLibWrap_Energy(26, 'cs', 12.0)['Ka1'], cs)
+    assert_equal(XRAYLIB_CACHE.misses, misses + 2)
+
+    cache = XraylibCache(maxsize=2)
+    for key in ('ka1', 'ka2', 'kb1'):
+        cache.lookup('lines', 26, key)
+    assert_equal(len(cache), 2)
+    cache.lookup('lines', 26, 'ka1')
+    assert_equal(cache.misses, 4)
+    cache.lookup('cs', 26, 'ka1', 12)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'xraylib.npz')
+        cache.save(fname)
+        table = XraylibCache()
+        table.load(fname)
+        assert_equal(len(table), 2)
+        assert_equal(table.lookup('lines', 26, 'Ka1'), energy)
+        assert_equal(table.lookup('cs', 26, 'ka1', 12.), cs)
+        assert_equal(table.misses, 0)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@known_fail_if(xrf.xraylib is None)
+def test_emission_line_index():
+    incident_energy = 10
+    index = EmissionLineIndex(incident_energy)
+    assert_true(np.all(np.diff(index.energy) >= 0))
+    assert_true(np.all(index.cs != 0))
+
+    energies = np.linspace(1, 10, 37)
+    found = emission_line_search(energies, 0.05, incident_energy)
+    assert_equal(len(found), len(energies))
+    for line_e, lines in zip(energies, found):
+        expected = dict()
+        for Z in range(1, 101):
+            e = XrfElement(Z)
+            cs = e.cs(incident_energy)
+            near = dict((k, v) for k, v in e.emission_line.all
+                        if cs[k] != 0 and np.abs(v - line_e) < 0.05)
+            if near:
+                expected[e.sym] = near
+        assert_equal(lines, expected)
+        assert_equal(index.search(line_e, 0.05), expected)
+
+    # restricted to some elements
+    lines = emission_line_search(8, 0.05, incident_energy,
+                                 element_list=['cu', 'Fe'])
+    assert_equal(list(lines), ['Cu'])
+    assert_equal(lines['Cu'], XrfElement('Cu').line_near(8, 0.05, 10))
+
+
 def smoke_test_element_creation():
     prev_element = None
     elements = [elm for abbrev, elm in six.iteritems(basic)
@@ -37,14 +37,16 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
-from collections import Mapping
+from collections import Mapping, OrderedDict
 import logging
+import threading
 
 import numpy as np
 import six
 
 from ..utils import NotInstalledError
-from ..constants.basic import (BasicElement, doc_params, doc_attrs, doc_ex)
+from ..constants.basic import (BasicElement, basic, doc_params, doc_attrs,
+                               doc_ex)
 from ..utils import verbosedict
 
 logger = logging.getLogger(__name__)
@@ -118,6 +120,125 @@ else:
         'yield': (shell_dict, xraylib.FluorYield),
         })
 
+    # sorted names of the lines and shells of each info type
+    XRAYLIB_KEYS = dict((info_type, sorted(mapping))
+                        for info_type, (mapping, _) in
+                        six.iteritems(XRAYLIB_MAP))
+
+
+class XraylibCache(object):
+    """Memo of the quantities computed by xraylib
+
+    The values are keyed on the info type, the atomic number, the line or
+    shell and, for the cross sections, the incident energy.  The least
+    ones stored first are dropped beyond `maxsize`.  The cache can be
+    used from several threads, and saved to and loaded from a table, to
+    avoid calling xraylib at all.
+
+    A single instance, `XRAYLIB_CACHE`, is shared by `XrayLibWrap` and
+    `XrayLibWrap_Energy`.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        maximum number of values kept
+
+    Attributes
+    ----------
+    hits, misses : int
+        number of values found, and not found, in the cache, only
+        approximate when used from several threads
+    """
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, info_type, element, key, energy=None):
+        """
+        The value of a quantity, computed by xraylib if not cached.
+
+        Parameters
+        ----------
+        info_type : str
+            one of the keys of `XRAYLIB_MAP`, e.g. 'lines' or 'cs'
+        element : int
+            atomic number
+        key : str
+            line or shell, e.g. 'ka1' or 'k'
+        energy : float, optional
+            incident energy in keV, for the cross sections
+        """
+        key = key.lower()
+        if energy is not None:
+            energy = float(energy)
+        cache_key = (info_type, element, key, energy)
+        # reading does not need the lock, xraylib is only called on a miss
+        value = self._values.get(cache_key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        if xraylib is None:
+            raise XraylibNotInstalledError(self.__class__)
+        mapping, func = XRAYLIB_MAP[info_type]
+        args = (element, mapping[key])
+        if energy is not None:
+            args += (energy,)
+        try:
+            value = func(*args)
+        except ValueError:
+            # xraylib 4 raises instead of returning 0 for the lines and
+            # shells which the element does not have
+            value = 0.
+        self._store([(cache_key, value)])
+        return value
+
+    def _store(self, items):
+        with self._lock:
+            for cache_key, value in items:
+                self._values.pop(cache_key, None)
+                self._values[cache_key] = value
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def save(self, filename):
+        """Save the cached values to a .npz table"""
+        with self._lock:
+            items = list(self._values.items())
+        keys = [k for k, _ in items]
+        np.savez(filename,
+                 info_type=np.array([k[0] for k in keys], dtype=str),
+                 element=np.array([k[1] for k in keys], dtype=int),
+                 key=np.array([k[2] for k in keys], dtype=str),
+                 energy=np.array([np.nan if k[3] is None else k[3]
+                                  for k in keys], dtype=float),
+                 value=np.array([v for _, v in items], dtype=float))
+
+    def load(self, filename):
+        """Add the values of a table written by `save`"""
+        with np.load(filename) as table:
+            energy = [None if np.isnan(e) else float(e)
+                      for e in table['energy']]
+            keys = zip(table['info_type'].tolist(),
+                       table['element'].tolist(),
+                       table['key'].tolist(), energy)
+            self._store(zip(keys, table['value'].tolist()))
+
+    def clear(self):
+        """Drop all the cached values"""
+        with self._lock:
+            self._values.clear()
+
+    def __len__(self):
+        return len(self._values)
+
+
+XRAYLIB_CACHE = XraylibCache()
+
 
 class XrayLibWrap(Mapping):
     """High-level interface to xraylib.
@@ -185,7 +306,7 @@ class XrayLibWrap(Mapping):
             raise XraylibNotInstalledError(self.__class__)
         self._element = element
         self._map, self._func = XRAYLIB_MAP[info_type]
-        self._keys = sorted(list(six.iterkeys(self._map)))
+        self._keys = XRAYLIB_KEYS[info_type]
         self._info_type = info_type
 
     @property
@@ -205,8 +326,7 @@ class XrayLibWrap(Mapping):
             Define which physics quantity to calculate.
         """
 
-        return self._func(self._element,
-                          self._map[key.lower()])
+        return XRAYLIB_CACHE.lookup(self._info_type, self._element, key)
 
     def __iter__(self):
         return iter(self._keys)
@@ -292,9 +412,8 @@ class XrayLibWrap_Energy(XrayLibWrap):
         key : str
             defines which physics quantity to calculate
         """
-        return self._func(self._element,
-                          self._map[key.lower()],
-                          self._incident_energy)
+        return XRAYLIB_CACHE.lookup(self._info_type, self._element, key,
+                                    self._incident_energy)
 
 # redefine the doc_title for xrf elements
 doc_title = """
@@ -508,13 +627,204 @@ class XrfElement(BasicElement):
         dict
             all possible emission lines
         """
-        out_dict = dict()
-        for k, v in six.iteritems(self.emission_line):
-            if self.cs(incident_energy)[k] == 0:
-                continue
-            if np.abs(v - energy) < delta_e:
-                out_dict[k] = v
-        return out_dict
+        index = get_emission_line_index(incident_energy)
+        return index.search(energy, delta_e).get(self.sym, dict())
+
+
+_xrf_elements = {}
+_xrf_elements_lock = threading.Lock()
+
+
+def get_xrf_element(element):
+    """The `XrfElement` of an element, shared by the whole process
+
+    Parameters
+    ----------
+    element : str or int
+        Element symbol, name or atomic number, in any case
+
+    Returns
+    -------
+    XrfElement
+    """
+    if isinstance(element, six.string_types):
+        element = element.lower()
+    Z = basic[element].Z
+    with _xrf_elements_lock:
+        if Z in _xrf_elements:
+            return _xrf_elements[Z]
+    e = XrfElement(Z)
+    with _xrf_elements_lock:
+        return _xrf_elements.setdefault(Z, e)
+
+
+class EmissionLineIndex(object):
+    """Emission lines of the elements, sorted by energy
+
+    All the lines which have a nonzero cross section at the incident
+    energy are kept in arrays sorted by energy, so that the lines near
+    many energies are found with `np.searchsorted`.
+
+    Parameters
+    ----------
+    incident_energy : float
+        incident x-ray energy in KeV
+    element_list : list, optional
+        elements to index, all of them (Z from 1 to 100) by default
+
+    Attributes
+    ----------
+    Z : array
+        atomic number of each line
+    sym : array
+        element symbol of each line
+    line : array
+        name of each line, e.g. 'ka1'
+    energy : array
+        energy of each line in KeV, sorted
+    cs : array
+        cross section of each line at the incident energy, in cm2/g
+    """
+    def __init__(self, incident_energy, element_list=None):
+        if xraylib is None:
+            raise XraylibNotInstalledError(self.__class__)
+        if element_list is None:
+            element_list = range(1, 101)
+        self.incident_energy = float(incident_energy)
+
+        rows = []
+        for item in element_list:
+            e = get_xrf_element(item)
+            cs = e.cs(self.incident_energy)
+            for line, energy in e.emission_line.all:
+                line_cs = cs[line]
+                if line_cs != 0:
+                    rows.append((e.Z, e.sym, line, energy, line_cs))
+
+        rows.sort(key=lambda row: row[3])
+        columns = list(zip(*rows)) or [()] * 5
+        self.Z = np.array(columns[0], dtype=int)
+        self.sym = np.array(columns[1], dtype=object)
+        self.line = np.array(columns[2], dtype=object)
+        self.energy = np.array(columns[3], dtype=float)
+        self.cs = np.array(columns[4], dtype=float)
+
+    def __len__(self):
+        return len(self.energy)
+
+    def find(self, line_e, delta_e):
+        """
+        Range of the lines within `delta_e` of each energy.
+
+        Parameters
+        ----------
+        line_e : float or array
+            energies to search for, in KeV
+        delta_e : float or array
+            half width of the search range, in KeV
+
+        Returns
+        -------
+        start, stop : array
+            the lines of the i-th energy are the items ``start[i]`` to
+            ``stop[i]`` of the attribute arrays
+        """
+        line_e, delta_e = np.broadcast_arrays(
+            np.asarray(line_e, dtype=float), np.asarray(delta_e, dtype=float))
+        if not len(self):
+            return np.zeros(line_e.shape, int), np.zeros(line_e.shape, int)
+        # the bounds are widened by the rounding error of the sums, and
+        # the lines at both ends are then checked with the exact condition
+        start = np.searchsorted(self.energy,
+                                np.nextafter(line_e - delta_e, -np.inf),
+                                side='left')
+        stop = np.searchsorted(self.energy,
+                               np.nextafter(line_e + delta_e, np.inf),
+                               side='right')
+
+        def outside(i):
+            energy = self.energy[np.minimum(i, len(self) - 1)]
+            return (start < stop) & ~(np.abs(energy - line_e) < delta_e)
+
+        while True:
+            step = outside(start)
+            if not step.any():
+                break
+            start = start + step
+        while True:
+            step = outside(stop - 1)
+            if not step.any():
+                break
+            stop = stop - step
+        return start, stop
+
+    def search(self, line_e, delta_e, element_list=None):
+        """
+        Lines within `delta_e` of an energy, or of each of many energies.
+
+        Parameters
+        ----------
+        line_e : float or array
+            energies to search for, in KeV
+        delta_e : float
+            half width of the search range, in KeV
+        element_list : list, optional
+            elements to restrict the search to
+
+        Returns
+        -------
+        lines_dict : dict or list
+            element symbol and its lines with their energies, one dict per
+            energy if `line_e` is an array
+        """
+        keep = None
+        if element_list is not None:
+            keep = set(get_xrf_element(item).Z for item in element_list)
+        start, stop = self.find(line_e, delta_e)
+
+        results = []
+        for i, j in zip(np.ravel(start), np.ravel(stop)):
+            out_dict = dict()
+            for k in range(i, j):
+                if keep is not None and self.Z[k] not in keep:
+                    continue
+                out_dict.setdefault(self.sym[k], dict())[self.line[k]] = \
+                    float(self.energy[k])
+            results.append(out_dict)
+        if np.ndim(line_e) == 0:
+            return results[0]
+        return results
+
+
+_line_indices = OrderedDict()
+_line_indices_lock = threading.Lock()
+
+
+def get_emission_line_index(incident_energy):
+    """The `EmissionLineIndex` of all the elements at an incident energy
+
+    The indices of the last few incident energies are kept, so that the
+    lines are only looked up once per incident energy.
+
+    Parameters
+    ----------
+    incident_energy : float
+        incident x-ray energy in KeV
+
+    Returns
+    -------
+    EmissionLineIndex
+    """
+    incident_energy = float(incident_energy)
+    with _line_indices_lock:
+        if incident_energy in _line_indices:
+            return _line_indices[incident_energy]
+    index = EmissionLineIndex(incident_energy)
+    with _line_indices_lock:
+        index = _line_indices.setdefault(incident_energy, index)
+        while len(_line_indices) > 8:
+            _line_indices.popitem(last=False)
+    return index
 
 
 def emission_line_search(line_e, delta_e, incident_energy,
@@ -527,8 +837,8 @@ def emission_line_search(line_e, delta_e, incident_energy,
 
     Parameters
     ----------
-    line_e : float
-         energy value to search for in KeV
+    line_e : float or array
+         energy value to search for in KeV, or many of them
     delta_e : float
          difference compared to energy in KeV
     incident_energy : float
@@ -542,23 +852,12 @@ def emission_line_search(line_e, delta_e, incident_energy,
     Returns
     -------
     lines_dict : dict
-        element and associate emission lines
+        element and associate emission lines, a list of them, one per
+        energy, if `line_e` is an array
 
     """
     if xraylib is None:
         raise XraylibNotInstalledError(__name__)
 
-    if element_list is None:
-        element_list = range(1, 101)
-
-    search_list = [XrfElement(item) for item in element_list]
-
-    cand_lines = [e.line_near(line_e, delta_e, incident_energy)
-                  for e in search_list]
-
-    out_dict = dict()
-    for e, lines in zip(search_list, cand_lines):
-        if lines:
-            out_dict[e.sym] = lines
-
-    return out_dict
+    index = get_emission_line_index(incident_energy)
+    return index.search(line_e, delta_e, element_list)
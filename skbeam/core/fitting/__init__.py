@@ -44,6 +44,8 @@ from .models import (Lorentzian2Model, ComptonModel, ElasticModel)
 
 from .lineshapes import (gaussian, lorentzian, lorentzian2, voigt, pvoigt,
                          gaussian_tail, gausssian_step, elastic, compton)
+from .lineshapes import (gaussian_jac, gaussian_tail_jac, gausssian_step_jac,
+                         elastic_jac, compton_jac)
 
 from .lineshapes import (gamma_dist, nbinom_dist, poisson_dist)
 
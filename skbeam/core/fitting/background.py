@@ -42,7 +42,6 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
-import scipy.signal
 import numpy as np
 
 _defaults = {'con_val_no_bin': 3,
@@ -65,7 +64,8 @@ def snip_method(spectrum,
     Parameters
     ----------
     spectrum : array
-        intensity spectrum
+        intensity spectrum, or spectra with energy along the last axis,
+        which are all processed at once
     e_off : float
         energy calibration, such as e_off + e_lin * energy + e_quad * energy^2
     e_lin : float
@@ -106,7 +106,7 @@ def snip_method(spectrum,
     Returns
     -------
     background : array
-        output results with peak removed
+        output results with peak removed, of the shape of `spectrum`
 
     References
     ----------
@@ -129,10 +129,94 @@ def snip_method(spectrum,
         else:
             iter_num = _defaults['iter_num_bin']
 
-    background = np.array(spectrum)
-    n_background = background.size
+    spectrum = np.asarray(spectrum, dtype=float)
+    n_background = spectrum.shape[-1]
+    spectra = spectrum.reshape(-1, n_background)
+
+    # the windows are the same for all the spectra
+    windows = _snip_windows(n_background, e_off, e_lin, e_quad, xmin, xmax,
+                            epsilon, width, decrease_factor, spectral_binning,
+                            iter_num, width_threshold)
+
+    background = np.empty_like(spectra)
+    for start in range(0, len(spectra), _SNIP_BLOCK):
+        # a few spectra at a time, with energy along the first axis, so
+        # that the neighbours of a channel are gathered from memory which
+        # is in cache
+        block = np.ascontiguousarray(spectra[start:start + _SNIP_BLOCK].T)
+
+        # smooth the background
+        # For background remove, we only care about the central parts
+        # where there are peaks. On the boundary part, we don't care
+        # the accuracy so much. But we need to pay attention to edge
+        # effects in general convolution.
+        block = _boxcar_same(block, con_val) / con_val
+
+        block = np.log(np.log(block + 1) + 1)
+
+        temp = np.empty_like(block)
+        other = np.empty_like(block)
+        below = np.empty(block.shape, dtype=bool)
+        for lo_index, hi_index in windows:
+            np.take(block, lo_index, axis=0, out=temp)
+            np.take(block, hi_index, axis=0, out=other)
+            temp += other
+            temp /= 2.
+            np.greater(block, temp, out=below)
+            np.copyto(block, temp, where=below)
+
+        background[start:start + _SNIP_BLOCK] = block.T
 
-    energy = np.arange(n_background, dtype=np.float)
+    background = np.exp(np.exp(background) - 1) - 1
+
+    background[~np.isfinite(background)] = 0.0
+
+    return background.reshape(spectrum.shape)
+
+
+# number of spectra processed together by snip_method
+_SNIP_BLOCK = 8
+
+
+def _boxcar_same(values, size):
+    """Sum of the values in a boxcar window along the first axis
+
+    Equal to ``scipy.signal.convolve(values, scipy.signal.boxcar(size),
+    mode='same')`` along the first axis, as a sum of shifted copies.
+    """
+    total = np.zeros_like(values)
+    num = len(values)
+    center = (size - 1) // 2
+    for shift in range(center - size + 1, center + 1):
+        if shift >= 0:
+            total[:num - shift] += values[shift:]
+        else:
+            total[-shift:] += values[:num + shift]
+    return total
+
+
+# windows of the last calls to snip_method, which only depend on the energy
+# calibration and the options
+_snip_window_cache = {}
+
+
+def _snip_windows(n_background, e_off, e_lin, e_quad, xmin, xmax, epsilon,
+                  width, decrease_factor, spectral_binning, iter_num,
+                  width_threshold):
+    """Indices of the neighbours averaged at each step of snip_method
+
+    Returns
+    -------
+    windows : list
+        (lo_index, hi_index) integer arrays of each step, the first
+        `iter_num` steps at full width and then with decreasing widths
+    """
+    key = (n_background, e_off, e_lin, e_quad, xmin, xmax, epsilon, width,
+           decrease_factor, spectral_binning, iter_num, width_threshold)
+    if key in _snip_window_cache:
+        return _snip_window_cache[key]
+
+    energy = np.arange(n_background, dtype=float)
 
     if spectral_binning is not None:
         energy = energy * spectral_binning
@@ -145,63 +229,32 @@ def snip_method(spectrum,
     tmp[tmp < 0] = 0
     fwhm = std_fwhm * np.sqrt(tmp)
 
-    # smooth the background
-    s = scipy.signal.boxcar(con_val)
-
-    # For background remove, we only care about the central parts
-    # where there are peaks. On the boundary part, we don't care
-    # the accuracy so much. But we need to pay attention to edge
-    # effects in general convolution.
-    A = s.sum()
-    background = scipy.signal.convolve(background, s, mode='same')/A
-
     window_p = width * fwhm / e_lin
     if spectral_binning is not None and spectral_binning > 0:
         window_p = window_p/2.
 
-    background = np.log(np.log(background + 1) + 1)
-
     index = np.arange(n_background)
+    low = np.max([xmin, 0])
+    high = np.min([xmax, n_background - 1])
 
-    # FIRST SNIPPING
-    for j in range(iter_num):
-        lo_index = np.clip(index - window_p,
-                           np.max([xmin, 0]),
-                           np.min([xmax, n_background - 1]))
-        hi_index = np.clip(index + window_p,
-                           np.max([xmin, 0]),
-                           np.min([xmax, n_background - 1]))
+    def neighbours(window):
+        return (np.clip(index - window, low, high).astype(int),
+                np.clip(index + window, low, high).astype(int))
 
-        temp = (background[lo_index.astype(np.int)] +
-                background[hi_index.astype(np.int)]) / 2.
-
-        bg_index = background > temp
-        background[bg_index] = temp[bg_index]
+    # FIRST SNIPPING
+    windows = [neighbours(window_p)] * iter_num
 
     current_width = window_p
     max_current_width = np.amax(current_width)
 
     while max_current_width >= width_threshold:
-        lo_index = np.clip(index - current_width,
-                           np.max([xmin, 0]),
-                           np.min([xmax, n_background - 1]))
-        hi_index = np.clip(index + current_width,
-                           np.max([xmin, 0]),
-                           np.min([xmax, n_background - 1]))
-
-        temp = (background[lo_index.astype(np.int)] +
-                background[hi_index.astype(np.int)]) / 2.
-
-        bg_index = background > temp
-        background[bg_index] = temp[bg_index]
+        windows.append(neighbours(current_width))
 
         # decrease the width and repeat
         current_width = current_width / decrease_factor
         max_current_width = np.amax(current_width)
 
-    background = np.exp(np.exp(background) - 1) - 1
-
-    inf_ind = np.where(~np.isfinite(background))
-    background[inf_ind] = 0.0
-
-    return background
+    if len(_snip_window_cache) >= 16:
+        _snip_window_cache.clear()
+    _snip_window_cache[key] = windows
+    return windows
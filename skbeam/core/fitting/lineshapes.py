@@ -382,6 +382,294 @@ def compton(x, compton_amplitude, coherent_sct_energy,
     return counts
 
 
+# analytic partial derivatives of the line shapes above, used to supply
+# the Jacobian to the least squares fit of a spectrum
+
+
+def gaussian_jac(x, area, center, sigma):
+    """Partial derivatives of `gaussian`
+
+    Parameters
+    ----------
+    x : array
+        independent variable
+    area : float
+        Area of the normally distributed peak
+    center : float
+        center position
+    sigma : float
+        standard deviation
+
+    Returns
+    -------
+    dict :
+        derivative with respect to each argument, including x
+    """
+    unit = gaussian(x, 1, center, sigma)
+    counts = area * unit
+    dx = 1.0 * x - center
+    return {'x': -counts * dx / sigma**2,
+            'area': unit,
+            'center': counts * dx / sigma**2,
+            'sigma': counts * (dx**2 / sigma**3 - 1 / sigma)}
+
+
+def _derfc(u):
+    """Derivative of erfc"""
+    return -2 / spi * np.exp(-u**2)
+
+
+def gausssian_step_jac(x, area, center, sigma, peak_e):
+    """Partial derivatives of `gausssian_step`
+
+    Parameters
+    ----------
+    x : array
+        data in x coordinate
+    area : float
+        area of gauss step function
+    center : float
+        center position
+    sigma : float
+        standard deviation
+    peak_e : float
+        emission energy
+
+    Returns
+    -------
+    dict :
+        derivative with respect to each argument, including x
+    """
+    u = (x - center) / (s2 * sigma)
+    unit = scipy.special.erfc(u) / (2. * peak_e)
+    slope = area * _derfc(u) / (2. * peak_e)
+    return {'x': slope / (s2 * sigma),
+            'area': unit,
+            'center': -slope / (s2 * sigma),
+            'sigma': -slope * u / sigma,
+            'peak_e': -area * unit / peak_e}
+
+
+def gaussian_tail_jac(x, area, center, sigma, gamma):
+    """Partial derivatives of `gaussian_tail`
+
+    Parameters
+    ----------
+    x : array
+        data in x coordinate
+    area : float
+        area of gauss tail function
+    center : float
+        center position
+    sigma : float
+        control peak width
+    gamma : float
+        normalization factor
+
+    Returns
+    -------
+    dict :
+        derivative with respect to each argument, including x
+    """
+    x = np.asarray(x, dtype=float)
+    low = x < center
+    dx_neg = np.where(low, x - center, 0)
+    u = (x - center) / (s2 * sigma) + 1 / (gamma * s2)
+
+    # counts = area * unit = envelope * erfc(u)
+    envelope = (np.exp(dx_neg / (gamma * sigma)) /
+                (2 * gamma * sigma * np.exp(-0.5 / gamma**2)))
+    unit = envelope * scipy.special.erfc(u)
+    counts = area * unit
+    slope = area * envelope * _derfc(u)
+    return {'x': counts * low / (gamma * sigma) + slope / (s2 * sigma),
+            'area': unit,
+            'center': -counts * low / (gamma * sigma) - slope / (s2 * sigma),
+            'sigma': (-counts * (dx_neg / (gamma * sigma**2) + 1 / sigma) -
+                      slope * (x - center) / (s2 * sigma**2)),
+            'gamma': (-counts * (dx_neg / (gamma**2 * sigma) + 1 / gamma +
+                                 1 / gamma**3) -
+                      slope / (s2 * gamma**2))}
+
+
+def _energy_jac(x, d_energy):
+    """Derivatives with respect to the energy calibration"""
+    return {'e_offset': d_energy,
+            'e_linear': d_energy * x,
+            'e_quadratic': d_energy * x**2}
+
+
+def _sigma_jac(fwhm_offset, fwhm_fanoprime, energy, epsilon, d_sigma):
+    """Derivatives of the peak width at `energy` with respect to its
+    parameters, given the derivative with respect to the width"""
+    temp_val = 2 * np.sqrt(2 * np.log(2))
+    sigma = np.sqrt((fwhm_offset / temp_val)**2 +
+                    energy * epsilon * fwhm_fanoprime)
+    return {'fwhm_offset': d_sigma * fwhm_offset / (temp_val**2 * sigma),
+            'fwhm_fanoprime': d_sigma * energy * epsilon / (2 * sigma),
+            'epsilon': d_sigma * energy * fwhm_fanoprime / (2 * sigma),
+            'energy': d_sigma * epsilon * fwhm_fanoprime / (2 * sigma)}
+
+
+def elastic_jac(x, coherent_sct_amplitude, coherent_sct_energy, fwhm_offset,
+                fwhm_fanoprime, e_offset, e_linear, e_quadratic, epsilon=2.96):
+    """Partial derivatives of `elastic`
+
+    Parameters
+    ----------
+    x : array
+        energy value
+    coherent_sct_amplitude : float
+        area of elastic peak
+    coherent_sct_energy : float
+        incident energy
+    fwhm_offset : float
+        global fitting parameter for peak width
+    fwhm_fanoprime : float
+        global fitting parameter for peak width
+    e_offset : float
+        offset of energy calibration
+    e_linear : float
+        linear coefficient in energy calibration
+    e_quadratic : float
+        quadratic coefficient in energy calibration
+    epsilon : float
+        energy to create a hole-electron pair
+
+    Returns
+    -------
+    dict :
+        derivative with respect to each parameter
+    """
+    energy = e_offset + x * e_linear + x**2 * e_quadratic
+
+    temp_val = 2 * np.sqrt(2 * np.log(2))
+    sigma = np.sqrt((fwhm_offset / temp_val)**2 +
+                    coherent_sct_energy * epsilon * fwhm_fanoprime)
+
+    peak = gaussian_jac(energy, coherent_sct_amplitude, coherent_sct_energy,
+                        sigma)
+    result = _sigma_jac(fwhm_offset, fwhm_fanoprime, coherent_sct_energy,
+                        epsilon, peak['sigma'])
+    result['coherent_sct_energy'] = peak['center'] + result.pop('energy')
+    result['coherent_sct_amplitude'] = peak['area']
+    result.update(_energy_jac(x, peak['x']))
+    return result
+
+
+def compton_jac(x, compton_amplitude, coherent_sct_energy,
+                fwhm_offset, fwhm_fanoprime,
+                e_offset, e_linear, e_quadratic,
+                compton_angle, compton_fwhm_corr,
+                compton_f_step, compton_f_tail, compton_gamma,
+                compton_hi_f_tail, compton_hi_gamma,
+                epsilon=2.96):
+    """Partial derivatives of `compton`
+
+    Parameters
+    ----------
+    x : array
+        energy value
+    compton_amplitude : float
+        area for gaussian peak, gaussian step and gaussian tail functions
+    coherent_sct_energy : float
+        incident energy
+    fwhm_offset : float
+        global fitting parameter for peak width
+    fwhm_fanoprime : float
+        global fitting parameter for peak width
+    e_offset : float
+        offset of energy calibration
+    e_linear : float
+        linear coefficient in energy calibration
+    e_quadratic : float
+        quadratic coefficient in energy calibration
+    compton_angle : float
+        compton angle in degree
+    compton_fwhm_corr : float
+        correction factor on peak width
+    compton_f_step : float
+        weight factor of the gaussian step function
+    compton_f_tail : float
+        weight factor of gaussian tail on lower side
+    compton_gamma : float
+        normalization factor of gaussian tail on lower side
+    compton_hi_f_tail : float
+        weight factor of gaussian tail on higher side
+    compton_hi_gamma : float
+        normalization factor of gaussian tail on higher side
+    epsilon : float
+        energy to create a hole-electron pair
+
+    Returns
+    -------
+    dict :
+        derivative with respect to each parameter
+    """
+    energy = e_offset + x * e_linear + x**2 * e_quadratic
+
+    mc2 = 511
+    comp_denom = (1 + coherent_sct_energy / mc2 *
+                  (1 - np.cos(np.deg2rad(compton_angle))))
+    compton_e = coherent_sct_energy / comp_denom
+
+    temp_val = 2 * np.sqrt(2 * np.log(2))
+    sigma = np.sqrt((fwhm_offset / temp_val)**2 +
+                    compton_e * epsilon * fwhm_fanoprime)
+
+    factor = 1 / (1 + compton_f_step + compton_f_tail + compton_hi_f_tail)
+    f_step = compton_f_step if compton_f_step > 0. else 0.
+
+    peak = gaussian_jac(energy, compton_amplitude, compton_e,
+                        sigma * compton_fwhm_corr)
+    step = gausssian_step_jac(energy, compton_amplitude, compton_e, sigma,
+                              compton_e)
+    tail = gaussian_tail_jac(energy, compton_amplitude, compton_e, sigma,
+                             compton_gamma)
+    # the tail on the high side is mirrored
+    hi_tail = gaussian_tail_jac(-1 * energy, compton_amplitude,
+                                -1 * compton_e, sigma, compton_hi_gamma)
+
+    counts = compton(x, compton_amplitude, coherent_sct_energy,
+                     fwhm_offset, fwhm_fanoprime,
+                     e_offset, e_linear, e_quadratic,
+                     compton_angle, compton_fwhm_corr,
+                     compton_f_step, compton_f_tail, compton_gamma,
+                     compton_hi_f_tail, compton_hi_gamma, epsilon)
+
+    def combine(d_peak, d_step, d_tail, d_hi_tail):
+        return factor * (d_peak + f_step * d_step +
+                         compton_f_tail * d_tail +
+                         compton_hi_f_tail * d_hi_tail)
+
+    d_energy = combine(peak['x'], step['x'], tail['x'], -hi_tail['x'])
+    d_compton_e = combine(peak['center'], step['center'] + step['peak_e'],
+                          tail['center'], -hi_tail['center'])
+    d_sigma = combine(peak['sigma'] * compton_fwhm_corr, step['sigma'],
+                      tail['sigma'], hi_tail['sigma'])
+
+    result = _sigma_jac(fwhm_offset, fwhm_fanoprime, compton_e, epsilon,
+                        d_sigma)
+    d_compton_e = d_compton_e + result.pop('energy')
+    result.update(_energy_jac(x, d_energy))
+    result['compton_amplitude'] = combine(peak['area'], step['area'],
+                                          tail['area'], hi_tail['area'])
+    result['coherent_sct_energy'] = d_compton_e / comp_denom**2
+    result['compton_angle'] = (-d_compton_e * compton_e**2 / mc2 *
+                               np.sin(np.deg2rad(compton_angle)) *
+                               np.pi / 180)
+    result['compton_fwhm_corr'] = factor * peak['sigma'] * sigma
+    result['compton_f_step'] = factor * (step['area'] * compton_amplitude *
+                                         (compton_f_step > 0.) - counts)
+    result['compton_f_tail'] = factor * (tail['area'] * compton_amplitude -
+                                         counts)
+    result['compton_gamma'] = factor * compton_f_tail * tail['gamma']
+    result['compton_hi_f_tail'] = factor * (hi_tail['area'] *
+                                            compton_amplitude - counts)
+    result['compton_hi_gamma'] = factor * compton_hi_f_tail * hi_tail['gamma']
+    return result
+
+
 def gamma_dist(bin_values, K, M):
     """Gamma distribution function
 
@@ -37,7 +37,7 @@
 ########################################################################
 from __future__ import absolute_import, division, print_function
 import numpy as np
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_equal
 
 from skbeam.core.fitting import snip_method
 
@@ -77,6 +77,25 @@ def test_snip_method():
     assert_allclose(bg_true_part, bg_cal_part, rtol=1e-3, atol=1e-1)
 
 
+def test_snip_method_spectra():
+    rng = np.random.RandomState(7)
+    xval = np.arange(1000)
+    centers = rng.randint(100, 900, size=(6, 1))
+    spectra = (1000 * np.exp(-(xval - centers) ** 2 / 20.) +
+               50 * np.exp(-xval / 300.) + rng.rand(6, 1000))
+    # negative values give NaN in the log-log transform
+    spectra[0, :5] = -2
+
+    for kwargs in (dict(width=0.5), dict(spectral_binning=2, con_val=4),
+                   dict(xmin=50, xmax=800, width=1)):
+        expected = [snip_method(y, 0.01, 0.01, 0.0, **kwargs)
+                    for y in spectra]
+        bg = snip_method(spectra.reshape(2, 3, 1000), 0.01, 0.01, 0.0,
+                         **kwargs)
+        assert_equal(bg.shape, (2, 3, 1000))
+        assert_allclose(bg.reshape(6, 1000), expected)
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
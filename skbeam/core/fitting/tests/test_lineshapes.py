@@ -42,6 +42,8 @@ from numpy.testing import (assert_array_almost_equal)
 from skbeam.core.fitting import (gaussian, gausssian_step, gaussian_tail,
                                  elastic, compton, lorentzian, lorentzian2,
                                  voigt, pvoigt)
+from skbeam.core.fitting import (gaussian_jac, gausssian_step_jac,
+                                 gaussian_tail_jac, elastic_jac, compton_jac)
 from skbeam.core.fitting import (ComptonModel, ElasticModel)
 from skbeam.core.fitting import (gamma_dist, nbinom_dist, poisson_dist)
 
@@ -355,6 +357,42 @@ def test_dist():
                                         0.18795214, 0.21260011]))
 
 
+def _check_jacobian(func, jac, x, **kwargs):
+    derivatives = jac(x, **kwargs)
+    for name, value in kwargs.items():
+        step = 1e-6 * (abs(value) or 1)
+        upper = dict(kwargs, **{name: value + step})
+        lower = dict(kwargs, **{name: value - step})
+        numerical = (func(x, **upper) - func(x, **lower)) / (2 * step)
+        scale = np.abs(numerical).max() + 1
+        assert_array_almost_equal(derivatives[name] / scale,
+                                  numerical / scale, decimal=5,
+                                  err_msg=name)
+
+
+def test_jacobians():
+    # avoid the kink of the tails at their center
+    x = np.linspace(0, 1000, 501) + 0.1
+    _check_jacobian(gaussian, gaussian_jac, x,
+                    area=3., center=400., sigma=30.)
+    _check_jacobian(gausssian_step, gausssian_step_jac, x,
+                    area=3., center=400., sigma=30., peak_e=4.)
+    _check_jacobian(gaussian_tail, gaussian_tail_jac, x,
+                    area=3., center=400., sigma=30., gamma=2.)
+
+    calibration = dict(fwhm_offset=0.1, fwhm_fanoprime=1e-4,
+                       e_offset=0.01, e_linear=0.01, e_quadratic=1e-6,
+                       epsilon=2.96)
+    _check_jacobian(elastic, elastic_jac, x, coherent_sct_amplitude=1e4,
+                    coherent_sct_energy=10., **calibration)
+    _check_jacobian(compton, compton_jac, x, compton_amplitude=1e4,
+                    coherent_sct_energy=10., compton_angle=90.,
+                    compton_fwhm_corr=1.5, compton_f_step=0.05,
+                    compton_f_tail=0.3, compton_gamma=2.,
+                    compton_hi_f_tail=0.1, compton_hi_gamma=1.5,
+                    **calibration)
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
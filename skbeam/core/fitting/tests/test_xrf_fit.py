@@ -1,19 +1,28 @@
 from __future__ import absolute_import, division, print_function
 import copy
 import logging
+import os
+import shutil
+import tempfile
 
 import six
 import numpy as np
 from numpy.testing import (assert_equal, assert_array_almost_equal,
-                           assert_array_equal)
+                           assert_array_equal, assert_almost_equal)
 from nose.tools import assert_true, raises, assert_raises
 
+from skbeam.testing.decorators import skip_if
+from skbeam.core.constants.xrf import xraylib
+
 from skbeam.core.fitting.base.parameter_data import get_para, e_calibration
 from skbeam.core.fitting.xrf_model import (
     ModelSpectrum, ParamController, linear_spectrum_fitting,
     construct_linear_model, trim, sum_area, compute_escape_peak,
     register_strategy,  update_parameter_dict, _set_parameter_hint,
-    fit_pixel_multiprocess_nnls, _STRATEGY_REGISTRY, calculate_area
+    fit_pixel_multiprocess_nnls, _STRATEGY_REGISTRY, calculate_area,
+    nnls_fit, nnls_fit_batch, fit_per_line_nnls, FitPool, ComponentCache,
+    construct_linear_design, fit_pixel_chunked_nnls,
+    ElementLines, element_peak_xrf, element_peak_xrf_jac
 )
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
@@ -112,6 +121,46 @@ def test_fit():
             assert_equal(v['value'], result.values[k])
 
 
+def test_fit_with_jacobian():
+    param = copy.deepcopy(get_para())
+    param['user_peak2_delta_center'] = {'value': 1.0, 'min': 0, 'max': 2,
+                                        'bound_type': 'fixed'}
+    lines = ['user_peak1', 'user_peak2']
+    x = np.arange(100, 1300)
+    matv = construct_linear_model(x, param, lines, default_area=1e5)[1]
+    y = matv.dot([0.5, 1.5, 0.8, 1.2])
+    weights = 1 / np.sqrt(y + 1)
+
+    MS = ModelSpectrum(param, lines)
+    MS.assemble_models()
+    expected = MS.model_fit(x, y, weights=weights)
+    result = MS.model_fit(x, y, weights=weights, use_jacobian=True)
+    assert_true(result.chisqr <= expected.chisqr * (1 + 1e-6))
+    assert_almost_equal(result.values['user_peak1_area'], 0.5e5, decimal=2)
+    assert_almost_equal(result.values['user_peak2_area'], 1.5e5, decimal=2)
+    for k, v in six.iteritems(expected.values):
+        assert_almost_equal(result.values[k] / (abs(v) + 1),
+                            v / (abs(v) + 1), decimal=4)
+    assert_raises(ValueError, MS.model_fit, x, y, method='nelder',
+                  use_jacobian=True)
+
+    # the derivatives of an emission line
+    kwargs = dict(area=1e4, center=6.4, delta_center=0.01,
+                  delta_sigma=0.002, ratio=0.5, ratio_adjust=0.9,
+                  fwhm_offset=0.1, fwhm_fanoprime=1e-4, e_offset=0.01,
+                  e_linear=0.01, e_quadratic=1e-7, epsilon=2.96)
+    derivatives = element_peak_xrf_jac(x, **kwargs)
+    for name, value in six.iteritems(kwargs):
+        step = 1e-6 * (abs(value) or 1)
+        upper = dict(kwargs, **{name: value + step})
+        lower = dict(kwargs, **{name: value - step})
+        numerical = (element_peak_xrf(x, **upper) -
+                     element_peak_xrf(x, **lower)) / (2 * step)
+        scale = np.abs(numerical).max() + 1
+        assert_array_almost_equal(derivatives[name] / scale,
+                                  numerical / scale, decimal=5)
+
+
 def test_register():
     new_strategy = e_calibration
     register_strategy('e_calibration', new_strategy, overwrite=False)
@@ -248,3 +297,312 @@ def test_pixel_fit_multiprocess():
             continue
         # compare with default value 1e5, and get difference < 1%
         assert_true(abs(v[0, 0] * 0.01 - default_area) / default_area < 1e-2)
+
+
+def test_nnls_fit_batch():
+    rng = np.random.RandomState(5)
+    x = np.linspace(0, 1, 300)
+    # overlapping peaks on a background, so that some areas are bound
+    matv = np.exp(-(x[:, np.newaxis] - rng.rand(12)) ** 2 / 0.002)
+    matv[:, -1] = 1 + x
+    areas = rng.rand(40, 12) * (rng.rand(40, 12) > 0.3) * 100
+    spectra = np.dot(areas, matv.T) + rng.randn(40, 300)
+
+    results, residue = nnls_fit_batch(spectra, matv)
+    for y, r, e in zip(spectra, results, residue):
+        expected, expected_residue = nnls_fit(y, matv)
+        assert_array_almost_equal(r, expected, decimal=6)
+        assert_almost_equal(e, expected_residue)
+    assert_true(np.any(results == 0))
+
+    # weights, and several dimensions of spectra
+    weights = rng.rand(300) + 0.5
+    results, residue = nnls_fit_batch(spectra.reshape(4, 10, 300), matv,
+                                      weights=weights)
+    assert_equal(results.shape, (4, 10, 12))
+    assert_equal(residue.shape, (4, 10))
+    expected, expected_residue = nnls_fit(spectra[13], matv, weights=weights)
+    assert_array_almost_equal(results[1, 3], expected, decimal=6)
+    assert_almost_equal(residue[1, 3], expected_residue)
+
+    # linearly dependent columns
+    results = nnls_fit_batch(spectra, matv[:, [0, 1, 0]])[0]
+    assert_true(np.all(results >= 0))
+
+    param = get_para()
+    out = fit_per_line_nnls(spectra, matv, param, False)
+    assert_equal(out.shape, (40, 14))
+    assert_array_almost_equal(out[:, :12], nnls_fit_batch(spectra, matv)[0])
+    assert_array_equal(out[:, 12], 0)
+    assert_true(np.all(out[:, 13] <= 1))
+
+
+def test_linear_design():
+    param = get_para()
+    x = np.arange(2000)
+    energy = param['e_offset']['value'] + param['e_linear']['value'] * x
+    lines = ['user_peak1']
+    elist, matv, area_v = construct_linear_model(x, param, lines,
+                                                 default_area=1e5)
+    names, design, area = construct_linear_design(x, param, lines,
+                                                  escape_ratio=0.1,
+                                                  default_area=1e5)
+    assert_equal(names, elist + ['background_{}'.format(i)
+                                 for i in range(4)])
+    assert_equal(design.shape, (2000, 7))
+    for name in names:
+        assert_almost_equal(area[name], 1e5)
+
+    # the escape peak is added to each column
+    for i in range(3):
+        escape = design[:, i] - matv[:, i]
+        assert_almost_equal(energy[np.argmax(escape)],
+                            energy[np.argmax(matv[:, i])] - 1.73998,
+                            decimal=1)
+        inside = energy + 1.73998 <= energy[-1]
+        assert_almost_equal(np.sum(escape) / np.sum(matv[inside, i]), 0.1,
+                            decimal=3)
+
+    # non-negative background, of given area
+    assert_true(np.all(design[:, 3:] >= 0))
+    assert_array_almost_equal(np.sum(design[:, 3:], axis=0) / 1e5,
+                              np.ones(4))
+
+    # a map is fitted at once, without snip
+    rng = np.random.RandomState(3)
+    coefs = rng.rand(2, 5, design.shape[1])
+    data = np.dot(coefs, design.T)
+    results = fit_pixel_multiprocess_nnls(data, design, param,
+                                          use_snip=False)
+    assert_array_almost_equal(results[..., :-2], coefs)
+
+    names, design, area = construct_linear_design(x, param, lines,
+                                                  background_order=None,
+                                                  default_area=1e5)
+    assert_equal(names, elist)
+    assert_array_equal(design, matv)
+
+    # a background needs several energies, and escape peaks an increasing
+    # energy
+    assert_raises(ValueError, construct_linear_design, x[:1], param, lines)
+    param = copy.deepcopy(param)
+    param['e_quadratic']['value'] = -1e-5
+    assert_raises(ValueError, construct_linear_design, x, param, lines,
+                  escape_ratio=0.1)
+
+
+@skip_if(xraylib is None, 'xraylib is not installed')
+def test_linear_design_pileup():
+    param = get_para()
+    x = np.arange(2000)
+    lines = ['Fe_K']
+    pileup = ['Fe_Ka1-Fe_Ka1']
+    elist, matv, area_v = construct_linear_model(x, param,
+                                                 lines + pileup)
+    names, design, area = construct_linear_design(x, param, lines,
+                                                  pileup_lines=pileup)
+    assert_equal(names, elist + ['background_{}'.format(i)
+                                 for i in range(4)])
+    assert_array_almost_equal(design[:, :len(elist)], matv)
+
+
+def test_fit_pool():
+    rng = np.random.RandomState(3)
+    x = np.linspace(0, 1, 200)
+    matv = np.exp(-(x[:, np.newaxis] - rng.rand(6)) ** 2 / 0.002)
+    exp_data = np.dot(rng.rand(5, 4, 6) * 100, matv.T) + 1
+    param = get_para()
+    expected = np.array([fit_per_line_nnls(row, matv, param, False)
+                         for row in exp_data])
+
+    tmpdir = tempfile.mkdtemp()
+    rows = []
+    try:
+        with FitPool(processes=2) as pool:
+            results = pool.fit(exp_data, matv, param, chunk_size=2,
+                               callback=lambda start, stop:
+                               rows.extend(range(start, stop)))
+            assert_array_almost_equal(results, expected)
+            assert_equal(sorted(rows), list(range(5)))
+
+            # memory maps are read and written in place by the workers
+            filename = os.path.join(tmpdir, 'data.npy')
+            np.save(filename, exp_data)
+            out = np.lib.format.open_memmap(
+                os.path.join(tmpdir, 'out.npy'), mode='w+', dtype=float,
+                shape=expected.shape)
+            results = pool.fit(np.load(filename, mmap_mode='r'), matv, param,
+                               out=out)
+            assert_true(results is out)
+            assert_array_almost_equal(out, expected)
+            assert_raises(ValueError, pool.fit, exp_data, matv, param,
+                          out=np.zeros(expected.shape))
+            del out, results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_fit_pixel_chunked():
+    rng = np.random.RandomState(4)
+    x = np.linspace(0, 1, 200)
+    matv = np.exp(-(x[:, np.newaxis] - rng.rand(6)) ** 2 / 0.002)
+    exp_data = np.dot(rng.rand(7, 3, 6) * 100, matv.T) + 1
+    param = get_para()
+    expected = np.array([fit_per_line_nnls(row, matv, param, False)
+                         for row in exp_data])
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with FitPool(processes=2) as pool:
+            # data read one tile at a time
+            filename = os.path.join(tmpdir, 'out.npy')
+            out = fit_pixel_chunked_nnls(exp_data, matv, param, filename,
+                                         tile_size=3, pool=pool)
+            assert_array_almost_equal(out, expected)
+            del out
+
+            # memory map read in place, with an interrupted fit
+            data_file = os.path.join(tmpdir, 'data.npy')
+            np.save(data_file, exp_data)
+            data = np.load(data_file, mmap_mode='r')
+            filename = os.path.join(tmpdir, 'mapped.npy')
+            out = fit_pixel_chunked_nnls(data, matv, param, filename,
+                                         tile_size=3, pool=pool)
+            assert_array_almost_equal(out, expected)
+            out[3:] = 0
+            del out
+            done = np.load(filename + '.progress.npy', mmap_mode='r+')
+            assert_array_equal(done, [True, True, True])
+            done[1:] = False
+            del done
+            # only the tiles which are not done are fitted again
+            out = fit_pixel_chunked_nnls(data, matv, param, filename,
+                                         tile_size=3, pool=pool)
+            assert_array_almost_equal(out, expected)
+            del out
+
+            assert_raises(ValueError, fit_pixel_chunked_nnls, data, matv,
+                          param, filename, tile_size=2, pool=pool)
+            del data
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_component_cache():
+    param = get_para()
+    x = np.arange(2000)
+    lines = ['user_peak1', 'user_peak2']
+    expected = construct_linear_model(x, param, lines)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = ComponentCache(maxsize=3, directory=tmpdir)
+        for misses in (4, 4):
+            elist, matv, area = construct_linear_model(x, param, lines,
+                                                       cache=cache)
+            assert_equal(elist, expected[0])
+            assert_array_almost_equal(matv, expected[1])
+            assert_equal(area, expected[2])
+            # the second time, all the spectra come from the cache
+            assert_equal(cache.misses, misses)
+        assert_equal(len(cache), 3)
+
+        # only the component whose parameters changed is evaluated again
+        changed = copy.deepcopy(param)
+        changed['user_peak2_delta_center'] = {'value': 0.1, 'min': 0,
+                                              'max': 0.2,
+                                              'bound_type': 'fixed'}
+        matv = construct_linear_model(x, changed, lines, cache=cache)[1]
+        assert_equal(cache.misses, 5)
+        assert_array_almost_equal(
+            matv, construct_linear_model(x, changed, lines)[1])
+        assert_array_almost_equal(matv[:, [0, 2, 3]],
+                                  expected[1][:, [0, 2, 3]])
+        assert_true(np.any(matv[:, 1] != expected[1][:, 1]))
+
+        # a global parameter changes all of them
+        changed['e_offset']['value'] += 0.01
+        construct_linear_model(x, changed, lines, cache=cache)
+        assert_equal(cache.misses, 9)
+
+        # spectra saved on disk are found by a new cache
+        cache = ComponentCache(directory=tmpdir)
+        matv = construct_linear_model(x, param, lines, cache=cache)[1]
+        assert_equal(cache.misses, 0)
+        assert_array_almost_equal(matv, expected[1])
+        key = list(cache._spectra)[0]
+        assert_true(not cache.get(key)[1].flags.writeable)
+
+        # but not by a cache of another version
+        cache = ComponentCache(directory=tmpdir)
+        cache.version = cache.version + ('other',)
+        construct_linear_model(x, param, lines, cache=cache)
+        assert_equal(cache.misses, 4)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_element_lines():
+    param = copy.deepcopy(get_para())
+    param['user_peak2_delta_center'] = {'value': 0.5, 'min': 0, 'max': 1,
+                                        'bound_type': 'fixed'}
+    param['user_peak2_area'] = {'value': 50, 'min': 0, 'max': 1000,
+                                'bound_type': 'none'}
+    x = np.arange(2000)
+    lines = ['user_peak1', 'user_peak2']
+    compiled = ElementLines(param, lines, default_area=100)
+    assert_equal(compiled.elemental_lines, lines)
+    assert_equal(compiled.names, ['user_peak1_', 'user_peak2_'])
+    assert_array_equal(compiled.area, [100, 50])
+    assert_array_equal(compiled.delta_center, [0, 0.5])
+
+    # the same spectra as the lmfit models
+    MS = ModelSpectrum(param, lines)
+    spectra = compiled.spectra(x)
+    assert_equal(spectra.shape, (len(x), 2))
+    for i, line in enumerate(lines):
+        model = MS.setup_element_model(line, default_area=100)
+        assert_array_almost_equal(
+            spectra[:, i], model.eval(x=x, params=model.make_params()))
+    assert_array_almost_equal(compiled(x), spectra.sum(axis=1))
+
+    area = np.array([2., 3.])
+    assert_array_almost_equal(compiled.spectra(x, area),
+                              spectra * area / compiled.area)
+    assert_equal(ElementLines(param, []).spectra(x).shape, (len(x), 0))
+
+
+@skip_if(xraylib is None, 'xraylib is not installed')
+def test_element_lines_overrides():
+    param = copy.deepcopy(get_para())
+
+    def hint(value, bound_type, low=0, high=1e9):
+        return {'value': value, 'min': low, 'max': high,
+                'bound_type': bound_type}
+
+    # values of single lines, and out of their bounds, are evaluated as
+    # lmfit does before a fit, without the expressions tying the lines
+    param.update({
+        'Fe_ka1_delta_center': hint(0.05, 'lohi', -0.1, 0.1),
+        'Fe_ka1_area': hint(8e4, 'lohi', 1e5),
+        'Fe_ka2_delta_sigma': hint(0.01, 'lohi', 0, 0.1),
+        'Fe_kb1_area': hint(2e3, 'lohi'),
+        'Ce_la2_ratio_adjust': hint(1.5, 'lohi', 0, 2),
+        'Ce_lb1_area': hint(3e4, 'lo'),
+        'Pt_ma1_area': hint(-5, 'lohi'),
+        'Pt_ma1_delta_center': hint(0.03, 'hi', 0, 0.01),
+        'pileup_Si_Ka1_Si_Ka1_delta_sigma': hint(0.02, 'lo'),
+    })
+    x = np.arange(2000)
+    lines = ['Fe_K', 'Ce_L', 'Pt_M', 'Si_Ka1-Si_Ka1', 'user_peak1']
+    compiled = ElementLines(param, lines)
+    assert_equal(compiled.elemental_lines, lines)
+    spectra = compiled.spectra(x)
+    MS = ModelSpectrum(param, lines)
+    for i, line in enumerate(lines):
+        model = MS.setup_element_model(line)
+        p = model.make_params()
+        assert_array_almost_equal(spectra[:, i],
+                                  model.eval(x=x, params=p))
+        area = [v.value for k, v in six.iteritems(p) if 'area' in k][-1]
+        assert_almost_equal(compiled.area[i], area)
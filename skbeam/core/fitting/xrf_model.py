@@ -42,19 +42,30 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
+import atexit
 import copy
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+import hashlib
 import logging
+import mmap
+import os
+import shutil
+import tempfile
 
 import numpy as np
 
-from scipy.optimize import nnls
+from scipy.optimize import leastsq, nnls
+from scipy.special import comb
 import six
 from lmfit import Model
 import multiprocessing
 
-from ..constants import XrfElement as Element
-from ..fitting.lineshapes import gaussian
+from ... import __version__
+from ..constants import get_xrf_element
+from ..constants.xrf import xraylib
+from ..fitting.lineshapes import (gaussian, gaussian_jac, elastic,
+                                  elastic_jac, compton, compton_jac,
+                                  _energy_jac, _sigma_jac)
 from ..fitting.models import (ComptonModel, ElasticModel,
                                         _gen_class_docs)
 from .base import parameter_data as sfb_pd
@@ -150,6 +161,221 @@ def element_peak_xrf(x, area, center,
                     delta_sigma+get_sigma(center)) * ratio * ratio_adjust
 
 
+def element_peak_xrf_jac(x, area, center,
+                         delta_center, delta_sigma,
+                         ratio, ratio_adjust,
+                         fwhm_offset, fwhm_fanoprime,
+                         e_offset, e_linear, e_quadratic,
+                         epsilon=2.96):
+    """
+    Partial derivatives of `element_peak_xrf`.
+
+    The arguments are broadcast against each other as in
+    `element_peak_xrf`.
+
+    Returns
+    -------
+    dict :
+        derivative with respect to each parameter
+    """
+    energy = e_offset + x * e_linear + x**2 * e_quadratic
+    temp_val = 2 * np.sqrt(2 * np.log(2))
+    sigma = np.sqrt((fwhm_offset/temp_val)**2 + center*epsilon*fwhm_fanoprime)
+
+    scale = ratio * ratio_adjust
+    peak = gaussian_jac(energy, area, center+delta_center,
+                        delta_sigma+sigma)
+    d_sigma = peak['sigma'] * scale
+    result = _sigma_jac(fwhm_offset, fwhm_fanoprime, center, epsilon,
+                        d_sigma)
+    result['center'] = peak['center'] * scale + result.pop('energy')
+    result['area'] = peak['area'] * scale
+    result['delta_center'] = peak['center'] * scale
+    result['delta_sigma'] = d_sigma
+    result['ratio'] = area * peak['area'] * ratio_adjust
+    result['ratio_adjust'] = area * peak['area'] * ratio
+    result.update(_energy_jac(x, peak['x'] * scale))
+    return result
+
+
+# analytic derivatives of the functions of the models of a spectrum
+_JACOBIANS = {element_peak_xrf: element_peak_xrf_jac,
+              compton: compton_jac,
+              elastic: elastic_jac}
+
+
+def _tied_to(params, name):
+    """Parameter which `name` is tied to by its expression, if any"""
+    while params[name].expr is not None:
+        expr = params[name].expr.strip()
+        if expr not in params:
+            raise ValueError("no derivative for the expression {0!r} of "
+                             "parameter {1}".format(expr, name))
+        name = expr
+    return name
+
+
+def _funcargs(component, params, x):
+    """Arguments of the function of a component of an lmfit model"""
+    code = component.func.__code__
+    args = {}
+    for arg in code.co_varnames[:code.co_argcount]:
+        if arg == 'x':
+            args[arg] = x
+        elif component.prefix + arg in params:
+            args[arg] = params[component.prefix + arg].value
+        elif arg in component.opts:
+            args[arg] = component.opts[arg]
+    return args
+
+
+def _model_jacobian(model, params, x, names):
+    """
+    Derivatives of an lmfit model of a spectrum.
+
+    Parameters
+    ----------
+    model : lmfit.Model
+        compton, elastic or element model, or a sum of them
+    params : lmfit.Parameters
+        the values of the parameters
+    x : array
+        channel numbers
+    names : list
+        the parameters to take the derivatives with respect to; the
+        parameters tied to them by their expression contribute as well
+
+    Returns
+    -------
+    array :
+        shape (len(x), len(names))
+    """
+    column = dict((name, i) for i, name in enumerate(names))
+    jac = np.zeros((len(x), len(names)))
+    for component in model.components or [model]:
+        if component.func not in _JACOBIANS:
+            raise ValueError("no derivative for the model function "
+                             "{0}".format(component.func.__name__))
+        derivatives = _JACOBIANS[component.func](
+            **_funcargs(component, params, x))
+        for arg, derivative in six.iteritems(derivatives):
+            name = component.prefix + arg
+            if name not in params:
+                continue
+            name = _tied_to(params, name)
+            if name in column:
+                jac[:, column[name]] += derivative
+    return jac
+
+
+def _finite(bound):
+    """The bound of a parameter, None if it is unbounded"""
+    if bound is None or not np.isfinite(bound):
+        return None
+    return bound
+
+
+def _to_internal(value, lower, upper):
+    """Unbounded variable from the value of a bounded parameter
+
+    This is the transformation of MINUIT, which lmfit also uses.
+    """
+    if lower is not None and upper is not None:
+        value = min(max(value, lower), upper)
+        return np.arcsin(2 * (value - lower) / (upper - lower) - 1)
+    if lower is not None:
+        return np.sqrt((max(value, lower) - lower + 1) ** 2 - 1)
+    if upper is not None:
+        return np.sqrt((upper - min(value, upper) + 1) ** 2 - 1)
+    return value
+
+
+def _from_internal(var, lower, upper):
+    """Value of a bounded parameter from its unbounded variable, and the
+    derivative of the value with respect to the variable"""
+    if lower is not None and upper is not None:
+        return (lower + (np.sin(var) + 1) * (upper - lower) / 2,
+                np.cos(var) * (upper - lower) / 2)
+    if lower is not None:
+        return (lower - 1 + np.sqrt(var ** 2 + 1),
+                var / np.sqrt(var ** 2 + 1))
+    if upper is not None:
+        return (upper + 1 - np.sqrt(var ** 2 + 1),
+                -var / np.sqrt(var ** 2 + 1))
+    return var, 1.
+
+
+def _fit_with_jacobian(model, params, x, data, weights=None, **kwargs):
+    """
+    Least squares fit of an lmfit model of a spectrum, with its Jacobian.
+
+    The parameters are varied as in lmfit, through the transformation
+    which keeps them within their bounds.  Only the public interface of
+    lmfit is used: the parameters tied to others must have the name of
+    a parameter as expression.
+
+    Parameters
+    ----------
+    model : lmfit.Model
+        compton, elastic or element model, or a sum of them
+    params : lmfit.Parameters
+        initial values, which are updated in place
+    x : array
+        channel numbers
+    data : array
+        spectrum
+    weights : array, optional
+        weight of each channel in the residual
+    kwargs : dict
+        options of scipy.optimize.leastsq, such as maxfev
+
+    Returns
+    -------
+    params : lmfit.Parameters
+        the fitted values
+    """
+    x = np.asarray(x)
+    tied = dict((name, _tied_to(params, name)) for name in params
+                if params[name].expr is not None)
+    names = [name for name in params
+             if params[name].vary and name not in tied]
+    bounds = [(_finite(params[name].min), _finite(params[name].max))
+              for name in names]
+    gradient = np.ones(len(names))
+
+    def set_values(fvars):
+        for i, (name, val, (lower, upper)) in enumerate(zip(names, fvars,
+                                                            bounds)):
+            params[name].value, gradient[i] = _from_internal(val, lower,
+                                                             upper)
+        for name, target in six.iteritems(tied):
+            params[name].value = params[target].value
+
+    def residual(fvars):
+        set_values(fvars)
+        diff = model.eval(params, x=x) - data
+        if weights is not None:
+            diff *= weights
+        return np.asarray(diff).ravel()
+
+    def jacobian(fvars):
+        set_values(fvars)
+        jac = _model_jacobian(model, params, x, names)
+        if weights is not None:
+            jac *= np.asarray(weights)[:, np.newaxis]
+        # derivatives with respect to the variables seen by leastsq
+        return jac * gradient
+
+    start = [_to_internal(params[name].value, lower, upper)
+             for name, (lower, upper) in zip(names, bounds)]
+    lskws = dict(xtol=1.e-7, ftol=1.e-7, gtol=1.e-7,
+                 maxfev=2000 * (len(names) + 1))
+    lskws.update(kwargs)
+    best = leastsq(residual, start, Dfun=jacobian, **lskws)[0]
+    set_values(np.atleast_1d(best))
+    return params
+
+
 class ElementModel(Model):
 
     __doc__ = _gen_class_docs(element_peak_xrf)
@@ -605,7 +831,7 @@ class ModelSpectrum(object):
 
         if elemental_line in K_LINE:
             element = elemental_line.split('_')[0]
-            e = Element(element)
+            e = get_xrf_element(element)
             if e.cs(incident_energy)['ka1'] == 0:
                 logger.debug('%s Ka emission line is not activated '
                              'at this energy %f', element, incident_energy)
@@ -690,7 +916,7 @@ class ModelSpectrum(object):
 
         elif elemental_line in L_LINE:
             element = elemental_line.split('_')[0]
-            e = Element(element)
+            e = get_xrf_element(element)
             if e.cs(incident_energy)['la1'] == 0:
                 logger.debug('{0} La1 emission line is not activated '
                              'at this energy {1}'.format(element, incident_energy))
@@ -762,7 +988,7 @@ class ModelSpectrum(object):
 
         elif elemental_line in M_LINE:
             element = elemental_line.split('_')[0]
-            e = Element(element)
+            e = get_xrf_element(element)
             if e.cs(incident_energy)['ma1'] == 0:
                 logger.debug('{0} ma1 emission line is not activated '
                              'at this energy {1}'.format(element, incident_energy))
@@ -952,7 +1178,7 @@ class ModelSpectrum(object):
             self.mod += self.setup_element_model(element)
 
     def model_fit(self, channel_number, spectrum, weights=None,
-                  method='leastsq', **kwargs):
+                  method='leastsq', use_jacobian=False, **kwargs):
         """
         Parameters
         ----------
@@ -964,6 +1190,10 @@ class ModelSpectrum(object):
             weight for fitting
         method : str
             default as leastsq
+        use_jacobian : bool, optional
+            fit with the analytic derivatives of the model instead of
+            finite differences, only with the leastsq method.  lmfit then
+            starts from the solution, to give the same result object.
         kwargs : dict
             fitting criteria, such as max number of iteration
 
@@ -973,11 +1203,207 @@ class ModelSpectrum(object):
         """
 
         pars = self.mod.make_params()
+        if use_jacobian:
+            if method != 'leastsq':
+                raise ValueError("the Jacobian is only used by the leastsq "
+                                 "method, not {0}".format(method))
+            pars = _fit_with_jacobian(self.mod, pars, channel_number,
+                                      spectrum, weights=weights, **kwargs)
         result = self.mod.fit(spectrum, pars, x=channel_number, weights=weights,
                               method=method, fit_kws=kwargs)
         return result
 
 
+def _hint_value(params, name, default, lower=None):
+    """Value which lmfit evaluates parameter `name` at, within its bounds"""
+    value, upper = default, None
+    if name in params:
+        hint = params[name]
+        value = hint['value']
+        if hint['bound_type'] in ('lohi', 'lo'):
+            lower = hint['min']
+        if hint['bound_type'] in ('lohi', 'hi'):
+            upper = hint['max']
+    if lower is not None:
+        value = max(value, lower)
+    if upper is not None:
+        value = min(value, upper)
+    return value
+
+
+class ElementLines(object):
+    """
+    Emission lines of the elements of a spectrum, as flat arrays.
+
+    All the emission lines of the elements, pileup peaks and user peaks
+    activated at the incident energy are laid out one after the other,
+    so that they are evaluated together by a single, broadcasted call to
+    `element_peak_xrf` instead of one lmfit model per line.  The values
+    are those of the parameter hints of
+    `ModelSpectrum.setup_element_model`, which lmfit evaluates the models
+    with before a fit: every line takes its own values, within its own
+    bounds, and the expressions tying them to the primary line (e.g. ka1)
+    are only applied by the fit.  The lmfit models are still needed to
+    fit them.
+
+    Parameters
+    ----------
+    params : dict
+        fitting values and their bounds
+    elemental_lines : list
+        e.g., ['Na_K', 'Pt_M', 'Si_Ka1-Si_Ka1', 'user_peak1']
+    default_area : float, optional
+        area of the lines which have no area in `params`
+
+    Attributes
+    ----------
+    elemental_lines : list
+        the elemental lines which are activated, in the input order
+    area : array
+        area of each of the elemental lines, that of its last emission
+        line as in `construct_linear_model`
+    line_area : array
+        area of each emission line
+    names : list
+        parameter prefix of each emission line, e.g. 'Fe_ka1_'
+    index : array
+        index in `elemental_lines` of each emission line
+    center, delta_center, delta_sigma, ratio, ratio_adjust : array
+        parameters of each emission line
+    calibration : dict
+        energy calibration, peak width and epsilon shared by all the lines
+    """
+    def __init__(self, params, elemental_lines, default_area=1e5):
+        self.incident_energy = params['coherent_sct_energy']['value']
+        self.calibration = dict(
+            (name, _hint_value(params, name, None))
+            for name in ('e_offset', 'e_linear', 'e_quadratic',
+                         'fwhm_offset', 'fwhm_fanoprime'))
+        self.calibration['epsilon'] = params['non_fitting_values']['epsilon']
+
+        self.elemental_lines = []
+        self.names = []
+        area, index, values, line_area = [], [], [], []
+        for elemental_line in elemental_lines:
+            lines = self._lines(params, elemental_line, default_area)
+            if lines is None:
+                logger.debug('%s is not activated at this energy %f',
+                             elemental_line, self.incident_energy)
+                continue
+            for name, line_values in lines:
+                self.names.append(name)
+                index.append(len(self.elemental_lines))
+                line_area.append(line_values[0])
+                values.append(line_values[1:])
+            area.append(line_area[-1])
+            self.elemental_lines.append(elemental_line)
+
+        self.area = np.array(area, dtype=float)
+        self.line_area = np.array(line_area, dtype=float)
+        self.index = np.array(index, dtype=int)
+        values = np.array(values, dtype=float).reshape(-1, 5)
+        (self.center, self.delta_center, self.delta_sigma,
+         self.ratio, self.ratio_adjust) = values.T
+
+    def _lines(self, params, elemental_line, default_area):
+        """The (name, values) of the lines of elemental_line"""
+        if elemental_line in K_LINE + L_LINE + M_LINE:
+            element, series = elemental_line.split('_')
+            series = series.lower()
+            primary = series + 'a1'
+            e = get_xrf_element(element)
+            cs = e.cs(self.incident_energy)
+            if cs[primary] == 0:
+                return None
+            # as in setup_element_model, only the area of ka1 is positive
+            lines = [(element + '_' + name + '_', energy,
+                      cs[name] / cs[primary], 0 if name == 'ka1' else None)
+                     for name, energy in e.emission_line.all
+                     if series in name and cs[name] != 0]
+        elif 'user' in elemental_line.lower():
+            # the position of a user peak is only given by delta_center
+            lines = [(elemental_line + '_', 5, 1.0, 0)]
+        else:
+            line1, line2 = elemental_line.split('-')
+            lines = [('pileup_' + elemental_line.replace('-', '_') + '_',
+                      get_line_energy(line1) + get_line_energy(line2), 1.0,
+                      0)]
+
+        result = []
+        for name, energy, ratio, lower in lines:
+            # as in setup_element_model, the area given to a line is also
+            # the default of the next ones
+            if name + 'area' in params:
+                default_area = params[name + 'area']['value']
+            result.append((name, (
+                _hint_value(params, name + 'area', default_area, lower),
+                energy,
+                _hint_value(params, name + 'delta_center', 0),
+                _hint_value(params, name + 'delta_sigma', 0),
+                ratio,
+                _hint_value(params, name + 'ratio_adjust', 1))))
+        return result
+
+    def __len__(self):
+        return len(self.names)
+
+    def line_spectra(self, x, area=None):
+        """
+        Spectrum of each emission line.
+
+        Parameters
+        ----------
+        x : array
+            channel numbers
+        area : array, optional
+            area of each of the elemental lines, defaults to `self.area`.
+            The emission lines of an elemental line keep the ratios of
+            their `line_area`.
+
+        Returns
+        -------
+        array :
+            shape (len(x), len(self)), one column per emission line
+        """
+        line_area = self.line_area
+        if area is not None:
+            area = np.asarray(area, dtype=float)
+            scale = area / np.where(self.area == 0, 1, self.area)
+            line_area = np.where(self.area == 0, area,
+                                 scale)[self.index] * line_area
+        x = np.asarray(x, dtype=float)[:, np.newaxis]
+        return element_peak_xrf(x, line_area, self.center, self.delta_center,
+                                self.delta_sigma, self.ratio,
+                                self.ratio_adjust, **self.calibration)
+
+    def spectra(self, x, area=None):
+        """
+        Spectrum of each elemental line, summed over its emission lines.
+
+        Parameters
+        ----------
+        x : array
+            channel numbers
+        area : array, optional
+            area of each of the elemental lines, defaults to `self.area`
+
+        Returns
+        -------
+        array :
+            shape (len(x), len(self.elemental_lines)), the columns of the
+            matrix of the linear model
+        """
+        if not len(self):
+            return np.zeros((len(x), 0))
+        # the lines of an elemental line are contiguous
+        starts = np.r_[0, np.flatnonzero(np.diff(self.index)) + 1]
+        return np.add.reduceat(self.line_spectra(x, area), starts, axis=1)
+
+    def __call__(self, x, area=None):
+        """Sum of the spectra of all the elemental lines"""
+        return self.line_spectra(x, area).sum(axis=1)
+
+
 def get_line_energy(elemental_line):
     """Return the energy of the first line in K, L or M series.
 
@@ -996,7 +1422,7 @@ def get_line_energy(elemental_line):
     """
     name, line = elemental_line.split('_')
     line = line.lower()
-    e = Element(name)
+    e = get_xrf_element(name)
     if 'k' in line:
         e_cen = e.emission_line[line]
     elif 'l' in line:
@@ -1067,9 +1493,123 @@ def compute_escape_peak(spectrum, ratio, params,
     return result
 
 
+class ComponentCache(object):
+    """Cache of the spectra of the components of the linear model
+
+    Used by `construct_linear_model`, the spectrum of each component is
+    stored under the subset of the fitting parameters it depends on,
+    so that only the components whose parameters changed are evaluated
+    again.  The least recently used spectra are dropped beyond `maxsize`.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        maximum number of spectra kept in memory, defaults to 256
+    directory : str, optional
+        directory in which the spectra are also saved, and looked up when
+        they are not in memory, so that they persist between sessions
+
+    Attributes
+    ----------
+    hits, misses : int
+        number of spectra found, and not found, in the cache
+    version : tuple
+        format of the cache and versions of scikit-beam and xraylib, part
+        of the key of the spectra saved in `directory`, so that those
+        saved by other versions are not used
+    """
+    version = (1, __version__, getattr(xraylib, '__version__', None))
+
+    def __init__(self, maxsize=256, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._spectra = OrderedDict()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename(self, key):
+        digest = hashlib.sha1(
+            repr((self.version, key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.npz')
+
+    def get(self, key):
+        """The (area, spectrum) of a component, KeyError if not cached
+
+        None stands for a line which is not activated.
+        """
+        if key in self._spectra:
+            value = self._spectra.pop(key)
+        elif (self.directory is not None and
+              os.path.exists(self._filename(key))):
+            with np.load(self._filename(key)) as stored:
+                value = None
+                if stored['activated']:
+                    value = float(stored['area']), stored['spectrum']
+                    value[1].flags.writeable = False
+        else:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        # most recently used last
+        self._spectra.pop(key, None)
+        self._spectra[key] = value
+        while len(self._spectra) > self.maxsize:
+            self._spectra.popitem(last=False)
+
+    def put(self, key, value):
+        """Store the (area, spectrum) of a component, or None"""
+        if value is not None:
+            value[1].flags.writeable = False
+        self._remember(key, value)
+        if self.directory is not None:
+            area, spectrum = value if value is not None else (0, [])
+            np.savez(self._filename(key), activated=value is not None,
+                     area=area, spectrum=spectrum)
+
+    def clear(self):
+        """Drop the spectra kept in memory"""
+        self._spectra.clear()
+
+    def __len__(self):
+        return len(self._spectra)
+
+
+# parameters shared by all the components of the linear model
+_GLOBAL_PARAMS = ('e_offset', 'e_linear', 'e_quadratic', 'fwhm_offset',
+                  'fwhm_fanoprime', 'coherent_sct_energy')
+
+
+def _param_key(params, names=(), prefix=None):
+    """Hashable value of the parameters given by name or by prefix"""
+    key = []
+    for name in sorted(params):
+        if name in names or (prefix is not None and name.startswith(prefix)):
+            value = params[name]
+            if isinstance(value, dict):
+                value = tuple((field, repr(value.get(field))) for field in
+                              ('value', 'bound_type', 'min', 'max'))
+            key.append((name, value))
+    return tuple(key)
+
+
+def _line_prefix(elemental_line):
+    """Prefix of the parameters of an elemental line"""
+    if elemental_line in K_LINE + L_LINE + M_LINE:
+        return elemental_line.split('_')[0] + '_'
+    elif 'user' in elemental_line.lower():
+        return elemental_line + '_'
+    return 'pileup_' + elemental_line.replace('-', '_') + '_'
+
+
 def construct_linear_model(channel_number, params,
                            elemental_lines,
-                           default_area=100):
+                           default_area=100, cache=None):
     """
     Create spectrum with parameters given from params.
 
@@ -1085,6 +1625,9 @@ def construct_linear_model(channel_number, params,
             lines of Platinum
     default_area : float
         value for the initial area of a given element
+    cache : ComponentCache, optional
+        cache of the spectra of the lines, compton and elastic peaks,
+        in which they are looked up before being evaluated
 
     Returns
     -------
@@ -1095,35 +1638,84 @@ def construct_linear_model(channel_number, params,
     element_area : dict
         area of the given elements
     """
-    MS = ModelSpectrum(params, elemental_lines)
+    if cache is None:
+        # only used for this call
+        cache = ComponentCache(maxsize=0)
+    channel_number = np.asarray(channel_number)
+    shared = (hashlib.sha1(channel_number.tobytes()).hexdigest(),
+              channel_number.dtype.str, channel_number.shape,
+              repr(default_area), _param_key(params, _GLOBAL_PARAMS),
+              repr(params['non_fitting_values']['epsilon']))
+
+    # only built if the compton or elastic peak is not in the cache
+    model_spectrum = []
+
+    def component(key, evaluate):
+        try:
+            return cache.get(key)
+        except KeyError:
+            pass
+        if not model_spectrum:
+            model_spectrum.append(ModelSpectrum(params, elemental_lines))
+        value = evaluate(model_spectrum[0])
+        cache.put(key, value)
+        return value
+
+    def compton_spectrum(MS):
+        p = MS.compton.make_params()
+        return (p['compton_amplitude'].value,
+                MS.compton.eval(x=channel_number, params=p))
+
+    def elastic_spectrum(MS):
+        p = MS.elastic.make_params()
+        return (p['elastic_coherent_sct_amplitude'].value,
+                MS.elastic.eval(x=channel_number, params=p))
+
+    element_values = {}
+    missing = OrderedDict()
+    for elemental_line in elemental_lines:
+        key = (elemental_line, shared,
+               _param_key(params, prefix=_line_prefix(elemental_line)))
+        try:
+            element_values[elemental_line] = cache.get(key)
+        except KeyError:
+            missing[elemental_line] = key
+
+    if missing:
+        # the lines which are not in the cache are evaluated at once
+        lines = ElementLines(params, missing, default_area=default_area)
+        spectra = lines.spectra(channel_number)
+        for elemental_line, key in six.iteritems(missing):
+            value = None
+            if elemental_line in lines.elemental_lines:
+                i = lines.elemental_lines.index(elemental_line)
+                value = (float(lines.area[i]),
+                         np.ascontiguousarray(spectra[:, i]))
+            cache.put(key, value)
+            element_values[elemental_line] = value
 
     selected_elements = []
     matv = []
     element_area = {}
 
     for elemental_line in elemental_lines:
-        e_model = MS.setup_element_model(elemental_line,
-                                         default_area=default_area)
-        if e_model:
-            p = e_model.make_params()
-            for k, v in six.iteritems(p):
-                if 'area' in k:
-                    element_area.update({elemental_line: v.value})
-
-            y_temp = e_model.eval(x=channel_number, params=p)
-            matv.append(y_temp)
+        value = element_values[elemental_line]
+        if value is not None:
+            element_area.update({elemental_line: value[0]})
+            matv.append(value[1])
             selected_elements.append(elemental_line)
 
-    p = MS.compton.make_params()
-    y_temp = MS.compton.eval(x=channel_number, params=p)
+    key = ('compton', shared, _param_key(params, prefix='compton_'))
+    area, y_temp = component(key, compton_spectrum)
     matv.append(y_temp)
-    element_area.update({'compton': p['compton_amplitude'].value})
+    element_area.update({'compton': area})
     selected_elements.append('compton')
 
-    p = MS.elastic.make_params()
-    y_temp = MS.elastic.eval(x=channel_number, params=p)
+    key = ('elastic', shared,
+           _param_key(params, names=('coherent_sct_amplitude',)))
+    area, y_temp = component(key, elastic_spectrum)
     matv.append(y_temp)
-    element_area.update({'elastic': p['elastic_coherent_sct_amplitude'].value})
+    element_area.update({'elastic': area})
     selected_elements.append('elastic')
 
     matv = np.array(matv)
@@ -1131,6 +1723,113 @@ def construct_linear_model(channel_number, params,
     return selected_elements, matv, element_area
 
 
+def construct_linear_design(channel_number, params, elemental_lines,
+                            pileup_lines=(), escape_ratio=0,
+                            escape_e=1.73998, background_order=3,
+                            default_area=100, cache=None):
+    """
+    Create the matrix of a linear model which includes the escape peaks,
+    pileup lines and background.
+
+    The columns of `construct_linear_model` are extended, so that a map can
+    be fitted with a single `nnls_fit_batch` call (e.g. with
+    `fit_pixel_multiprocess_nnls` and ``use_snip=False``) instead of
+    removing the background of each spectrum with snip first:
+
+    - the escape peak of each component, i.e. the component shifted down
+      by `escape_e` and scaled by `escape_ratio`, is added to its column,
+      as the ratio is a property of the detector.
+    - a column is added for each of `pileup_lines`.
+    - ``background_order + 1`` columns of Bernstein polynomials of the
+      energy are added, named ``'background_0'``, ``'background_1'``...
+      As they are non-negative, so is any background fitted by nnls.
+
+    Parameters
+    ----------
+    channel_number : array
+        N.B. This is the raw independent variable, not energy.
+    params : dict
+        fitting parameters
+    elemental_lines : list
+            e.g., ['Na_K', Mg_K', 'Pt_M'] refers to the
+            K lines of Sodium, the K lines of Magnesium, and the M
+            lines of Platinum
+    pileup_lines : list, optional
+        pileup lines, e.g. ['Si_Ka1-Si_Ka1']
+    escape_ratio : float, optional
+        ratio of the escape peak to the full spectrum, e.g.
+        ``params['si_escape']['value']``. By default, 0 (no escape peak)
+    escape_e : float, optional
+        Units: keV
+        By default, 1.73998 (Ka1 line of Si)
+    background_order : int, optional
+        order of the polynomial background, by default 3.  None means
+        no background columns.
+    default_area : float
+        value for the initial area of a given element, and for the area
+        of each background column
+    cache : ComponentCache, optional
+        see `construct_linear_model`
+
+    Returns
+    -------
+    selected_elements : list
+        selected elements for given energy, followed by the background
+        columns
+    matv : array
+        matrix for linear fitting
+    element_area : dict
+        area of the given elements
+    """
+    channel_number = np.asarray(channel_number)
+    selected_elements, matv, element_area = construct_linear_model(
+        channel_number, params, list(elemental_lines) + list(pileup_lines),
+        default_area=default_area, cache=cache)
+
+    energy = (params['e_offset']['value'] +
+              params['e_linear']['value'] * channel_number +
+              params['e_quadratic']['value'] * channel_number**2)
+
+    if escape_ratio:
+        if len(energy) < 2 or np.any(np.diff(energy) <= 0):
+            raise ValueError("escape peaks need at least two channels, of "
+                             "energies increasing with the channels")
+        # the escape peak of the spectrum at energy e is the spectrum at
+        # energy e + escape_e, linearly interpolated between the channels
+        pos = np.interp(energy + escape_e, energy,
+                        np.arange(len(energy), dtype=float),
+                        left=-1, right=-1)
+        inside = pos >= 0
+        low = np.minimum(pos[inside].astype(int), len(energy) - 2)
+        frac = (pos[inside] - low)[:, np.newaxis]
+        matv = matv.copy()
+        matv[inside] += escape_ratio * ((1 - frac) * matv[low] +
+                                        frac * matv[low + 1])
+
+    if background_order is not None:
+        basis = _bernstein_basis(energy, background_order)
+        basis *= default_area / np.sum(basis, axis=0)
+        matv = np.column_stack([matv, basis])
+        for i in range(background_order + 1):
+            name = 'background_{}'.format(i)
+            selected_elements.append(name)
+            element_area[name] = default_area
+
+    return selected_elements, matv, element_area
+
+
+def _bernstein_basis(x, order):
+    """Bernstein polynomials of `order` over the range of `x`, as columns"""
+    x = np.asarray(x, dtype=float)
+    if not len(x) or x.max() == x.min():
+        raise ValueError("a background needs channels of at least two "
+                         "energies")
+    t = (x - x.min()) / (x.max() - x.min())
+    k = np.arange(order + 1)
+    return (comb(order, k) * t[:, np.newaxis]**k *
+            (1 - t[:, np.newaxis])**(order - k))
+
+
 def nnls_fit(spectrum, expected_matrix, weights=None):
     """
     Non-negative least squares fitting.
@@ -1160,6 +1859,168 @@ def nnls_fit(spectrum, expected_matrix, weights=None):
     return nnls(expected_matrix, spectrum)
 
 
+def nnls_fit_batch(spectra, expected_matrix, weights=None, max_iter=None):
+    """
+    Non-negative least squares fitting of many spectra at once.
+
+    Gives the same results as `nnls_fit` applied to each spectrum, but the
+    problems are solved together on the Gram matrix of `expected_matrix`,
+    with an active set method vectorized over the spectra.
+
+    Parameters
+    ----------
+    spectra : array
+        spectra of experiment data, with energy as the last dimension
+    expected_matrix : array
+        2D matrix of activated element spectrum
+    weights : array, optional
+        for weighted nnls fitting, shared by all the spectra. Setting
+        weights as None means fitting without weights.
+    max_iter : int, optional
+        maximum number of steps of the active set method, by default 30
+        times the number of elements.  Spectra which have not converged
+        by then are fitted one at a time.
+
+    Returns
+    -------
+    results : array
+        weights of different element for each spectrum, shape
+        ``spectra.shape[:-1] + (num_elements,)``
+    residue : array
+        error of each spectrum
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    shape = spectra.shape[:-1]
+    spectra = spectra.reshape(-1, spectra.shape[-1])
+    expected_matrix = np.asarray(expected_matrix, dtype=float)
+    if weights is not None:
+        sqrt_weights = np.sqrt(weights)
+        expected_matrix = expected_matrix * sqrt_weights[:, np.newaxis]
+        spectra = spectra * sqrt_weights
+
+    gram = np.dot(expected_matrix.T, expected_matrix)
+    results, converged = _nnls_gram(gram, np.dot(spectra, expected_matrix),
+                                    max_iter=max_iter)
+    for i in np.flatnonzero(~converged):
+        results[i] = nnls(expected_matrix, spectra[i])[0]
+    residue = np.sqrt(np.sum(
+        (spectra - np.dot(results, expected_matrix.T)) ** 2, axis=1))
+    return (results.reshape(shape + (gram.shape[0],)),
+            residue.reshape(shape))
+
+
+def _nnls_gram(gram, proj, max_iter=None):
+    """Solve min ||A x - y|| with x >= 0 for many y, given A.T A and y A
+
+    This is the active set method of Lawson and Hanson, run for all the
+    problems at once: the problems with the same passive (i.e. unbound)
+    variables are solved together at each step.
+
+    Parameters
+    ----------
+    gram : array
+        A.T A, shape (num_elements, num_elements)
+    proj : array
+        y A for each problem, shape (num_problems, num_elements)
+    max_iter : int, optional
+        see `nnls_fit_batch`
+
+    Returns
+    -------
+    x : array
+        solutions, shape (num_problems, num_elements)
+    converged : array
+        whether each problem converged
+    """
+    num, size = proj.shape
+    if max_iter is None:
+        max_iter = 30 * size
+    eps = np.finfo(float).eps
+    # tolerance on the gradient, relative to the scale of each problem
+    tol = 10 * eps * size * np.maximum(np.abs(proj).max(axis=1), eps)
+
+    # start from the unconstrained solution, clipped
+    x = np.maximum(_solve_passive(gram, proj,
+                                  np.ones((num, size), dtype=bool)), 0)
+    passive = x > 0
+    todo = np.arange(num)
+    for _ in range(max_iter):
+        if not len(todo):
+            break
+        xt, pt = x[todo], passive[todo]
+        z = _solve_passive(gram, proj[todo], pt)
+
+        # inner loop: move towards z until a variable reaches zero, and
+        # make it active
+        infeasible = np.any(pt & (z <= 0), axis=1)
+        if infeasible.any():
+            xi, pi, zi = xt[infeasible], pt[infeasible], z[infeasible]
+            step = pi & (zi <= 0)
+            ratio = np.full(xi.shape, np.inf)
+            # variables already at zero (x = z = 0) stop the move at once
+            ratio[step] = np.divide(xi[step], xi[step] - zi[step],
+                                    out=np.zeros(step.sum()),
+                                    where=xi[step] > 0)
+            alpha = ratio.min(axis=1)[:, np.newaxis]
+            xi += alpha * (zi - xi)
+            pi &= xi > eps * np.abs(xi).max(axis=1)[:, np.newaxis]
+            xi[~pi] = 0
+            x[todo[infeasible]] = xi
+            passive[todo[infeasible]] = pi
+
+        # outer loop: optimal on the passive set, free the variable with the
+        # largest gradient if any
+        feasible = ~infeasible
+        rows = todo[feasible]
+        x[rows] = z[feasible]
+        grad = proj[rows] - np.dot(x[rows], gram)
+        grad[passive[rows]] = -np.inf
+        best = grad.argmax(axis=1)
+        grow = grad[np.arange(len(rows)), best] > tol[rows]
+        passive[rows[grow], best[grow]] = True
+        converged = np.zeros(num, dtype=bool)
+        converged[rows[~grow]] = True
+        todo = todo[~converged[todo]]
+
+    converged = np.ones(num, dtype=bool)
+    converged[todo] = False
+    return x, converged
+
+
+def _solve_passive(gram, proj, passive):
+    """Least squares solutions restricted to the passive variables
+
+    The reduced normal equations of all the problems are solved as one
+    stack, with the rows and columns of the bound variables replaced by
+    identity.  If some of them are singular, the problems with the same
+    passive variables are solved together by least squares instead.
+    """
+    pair = passive[:, :, np.newaxis] & passive[:, np.newaxis, :]
+    systems = np.where(pair, gram, 0)
+    idx = np.arange(gram.shape[0])
+    systems[:, idx, idx] += ~passive
+    try:
+        return np.linalg.solve(systems, np.where(passive, proj, 0)[..., None]
+                               )[..., 0]
+    except np.linalg.LinAlgError:
+        pass
+
+    z = np.zeros(proj.shape)
+    # group the problems by passive variables
+    order = np.lexsort(passive.T)
+    ordered = passive[order]
+    bounds = np.flatnonzero(np.any(ordered[1:] != ordered[:-1], axis=1)) + 1
+    rcond = np.finfo(float).eps * gram.shape[0]
+    for rows in np.split(order, bounds):
+        idx = np.flatnonzero(passive[rows[0]])
+        if not len(idx):
+            continue
+        sub = proj[np.ix_(rows, idx)]
+        z[np.ix_(rows, idx)] = np.linalg.lstsq(
+            gram[np.ix_(idx, idx)], sub.T, rcond=rcond)[0].T
+    return z
+
+
 def linear_spectrum_fitting(x, y, params,
                             elemental_lines=None,
                             weights=None):
@@ -1275,7 +2136,7 @@ def _get_activated_line(incident_energy, elemental_line):
     line_list = []
     if elemental_line in K_LINE:
         element = elemental_line.split('_')[0]
-        e = Element(element)
+        e = get_xrf_element(element)
         if e.cs(incident_energy)['ka1'] == 0:
             return
         for num, item in enumerate(e.emission_line.all[:4]):
@@ -1287,7 +2148,7 @@ def _get_activated_line(incident_energy, elemental_line):
 
     elif elemental_line in L_LINE:
         element = elemental_line.split('_')[0]
-        e = Element(element)
+        e = get_xrf_element(element)
         if e.cs(incident_energy)['la1'] == 0:
             return
         for num, item in enumerate(e.emission_line.all[4:-4]):
@@ -1299,7 +2160,7 @@ def _get_activated_line(incident_energy, elemental_line):
 
     elif elemental_line in M_LINE:
         element = elemental_line.split('_')[0]
-        e = Element(element)
+        e = get_xrf_element(element)
         if e.cs(incident_energy)['ma1'] == 0:
             return
         for num, item in enumerate(e.emission_line.all[-4:]):
@@ -1330,43 +2191,206 @@ def fit_per_line_nnls(data, matv, param, use_snip):
         fitting values for all the elements at a given row. Background is
         calculated as a summed value. Also residual is included.
     """
-    out = []
-    bg_sum = 0
-    for y in data:
-        if use_snip:
-            bg = snip_method(y,
-                             param['e_offset']['value'],
-                             param['e_linear']['value'],
-                             param['e_quadratic']['value'],
-                             width=param['non_fitting_values']['background_width'])
-            bg_sum = np.sum(bg)
-            result, res = nnls_fit(y - bg, matv, weights=None)
-        else:
-            result, res = nnls_fit(y - bg, matv, weights=None)
+    data = np.asarray(data, dtype=float)
+    if use_snip:
+        # background of all the spectra of the row at once
+        bg = snip_method(data,
+                         param['e_offset']['value'],
+                         param['e_linear']['value'],
+                         param['e_quadratic']['value'],
+                         width=param['non_fitting_values']['background_width'])
+    else:
+        bg = np.zeros_like(data)
+    # all the spectra of the row are fitted at once
+    result, res = nnls_fit_batch(data - bg, matv)
+
+    sst = np.sum((data - np.mean(data, axis=-1)[:, np.newaxis])**2, axis=-1)
+    r2 = 1 - res/sst
+    return np.column_stack([result, np.sum(bg, axis=-1), r2])
+
+
+def _snip_param(param):
+    """The fitting parameters used by `fit_per_line_nnls`"""
+    keys = ('e_offset', 'e_linear', 'e_quadratic')
+    snip = dict((key, {'value': param[key]['value']}) for key in keys)
+    snip['non_fitting_values'] = {
+        'background_width': param['non_fitting_values']['background_width']}
+    return snip
+
 
-        sst = np.sum((y-np.mean(y))**2)
-        r2 = 1 - res/sst
-        result = list(result) + [bg_sum, r2]
-        out.append(result)
-    return np.array(out)
+# array stored in a file, which the workers of a FitPool map
+_mapped_array = namedtuple('_mapped_array',
+                           ['filename', 'dtype', 'shape', 'offset'])
 
+# description of a fit run by a FitPool, sent with each chunk of rows
+_fit_job = namedtuple('_fit_job', ['data', 'matv', 'out', 'param',
+                                   'use_snip'])
 
-def _log_and_fit(row_num, *args):
-    """Wrapper around fit_per_line_nnls to log the row num that is being used
+
+def _as_mapped(array):
+    """Describe an array if it is a whole, C contiguous memory map"""
+    if (isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap)
+            and array.flags.c_contiguous):
+        return _mapped_array(array.filename, array.dtype.str, array.shape,
+                             array.offset)
+    return None
+
+
+def _open_mapped(mapped, mode):
+    return np.memmap(mapped.filename, dtype=np.dtype(mapped.dtype),
+                     mode=mode, offset=mapped.offset, shape=mapped.shape)
+
+
+def _fit_rows(job, start, stop):
+    """Fit rows start:stop of a job, in a worker of a FitPool"""
+    # mapping the files is cheap compared to the fit, and keeping them
+    # mapped would hold on to them once the job is done
+    data = _open_mapped(job.data, 'r')[start:stop]
+    result = fit_per_line_nnls(data.reshape(-1, data.shape[-1]),
+                               _open_mapped(job.matv, 'r'), job.param,
+                               job.use_snip)
+    out = _open_mapped(job.out, 'r+')
+    out[start:stop] = result.reshape(data.shape[:-1] + result.shape[-1:])
+    return start, stop
+
+
+def _fit_rows_star(args):
+    return _fit_rows(*args)
+
+
+class FitPool(object):
+    """Persistent pool of processes fitting XRF maps row by row
+
+    The experiment data, the matrix of the model and the results are shared
+    with the workers through memory maps: memory maps given by the caller
+    are used in place, other arrays are copied once per fit into files
+    of a temporary directory, in shared memory (/dev/shm) where available.
+    Each task then only carries the indices of the rows to fit, and
+    the workers write the results straight into the output.
 
     Parameters
     ----------
-    row_num : int
-        The row number that is being computed
-    args
-        The arguments to `fit_per_line_nnls`
+    processes : int, optional
+        number of worker processes, defaults to the number of cpus
+
+    Examples
+    --------
+    >>> with FitPool() as pool:
+    ...     for exp_data in maps:
+    ...         results = pool.fit(exp_data, matv, param, use_snip=True)
     """
-    logger.info('Row number at {}'.format(row_num))
-    return fit_per_line_nnls(*args)
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes)
+
+    def fit(self, exp_data, matv, param, use_snip=False, chunk_size=1,
+            out=None, callback=None, rows=None):
+        """Fit each pixel of a map with `fit_per_line_nnls`
+
+        Parameters
+        ----------
+        exp_data : array
+            3D data of experiment spectrum,
+            with x,y positions as the first 2-dim, and energy as the third
+            one.  A memory map (e.g. from ``np.load(..., mmap_mode='r')``)
+            is read in place by the workers.
+        matv : array
+            matrix for regression analysis
+        param : dict
+            fitting parameters
+        use_snip : bool, optional
+            use snip algorithm to remove background or not
+        chunk_size : int, optional
+            number of rows fitted by each task, defaults to 1
+        out : memmap, optional
+            memory map of shape ``exp_data.shape[:2] + (matv.shape[1] + 2,)``
+            and type float64 (e.g. from ``np.lib.format.open_memmap``) into
+            which the workers write the results, so that they are never
+            all held in memory
+        callback : callable, optional
+            called as ``callback(start, stop)`` as each chunk of rows
+            start:stop is fitted
+        rows : tuple, optional
+            ``(start, stop)``, to only fit rows start:stop of the map.  The
+            other rows of the results are left untouched.
+
+        Returns
+        -------
+        array
+            Fitting values for all the elements, `out` if it is given
+        """
+        if self._pool is None:
+            raise RuntimeError("The pool is closed")
+        shape = exp_data.shape[:2] + (matv.shape[1] + 2,)
+        if out is not None and _as_mapped(out) is None:
+            raise ValueError("out must be a whole, C contiguous memory map")
+        if out is not None and (out.shape != shape or out.dtype != float):
+            raise ValueError("out must be a float64 array of shape "
+                             "{0}".format(shape))
+        shm = '/dev/shm'
+        tmpdir = tempfile.mkdtemp(dir=shm if os.path.isdir(shm) else None)
+        try:
+            def mapped(array, name):
+                described = _as_mapped(array)
+                if described is None:
+                    filename = os.path.join(tmpdir, name + '.npy')
+                    np.save(filename, np.ascontiguousarray(array))
+                    described = _as_mapped(np.load(filename, mmap_mode='r'))
+                return described
+
+            result = out
+            if result is None:
+                result = np.lib.format.open_memmap(
+                    os.path.join(tmpdir, 'out.npy'), mode='w+', dtype=float,
+                    shape=shape)
+            job = _fit_job(mapped(exp_data, 'data'),
+                           mapped(np.asarray(matv, dtype=float), 'matv'),
+                           _as_mapped(result), _snip_param(param), use_snip)
+            first, last = (0, shape[0]) if rows is None else rows
+            tasks = [(job, start, min(start + chunk_size, last))
+                     for start in range(first, last, chunk_size)]
+            done = 0
+            for start, stop in self._pool.imap_unordered(_fit_rows_star,
+                                                         tasks):
+                done += stop - start
+                logger.info('Fitted rows {0} to {1}, {2} of {3} rows done'
+                            ''.format(start, stop - 1, done, last - first))
+                if callback is not None:
+                    callback(start, stop)
+            if out is None:
+                result = np.array(result)
+            return result
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def close(self):
+        """Stop the worker processes"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_pool = []
+
+
+def _get_default_pool():
+    if not _default_pool:
+        _default_pool.append(FitPool())
+        atexit.register(_default_pool[0].close)
+    return _default_pool[0]
 
 
 def fit_pixel_multiprocess_nnls(exp_data, matv, param,
-                                use_snip=False):
+                                use_snip=False, chunk_size=1, pool=None):
     """
     Multiprocess fit of experiment data.
 
@@ -1381,27 +2405,101 @@ def fit_pixel_multiprocess_nnls(exp_data, matv, param,
         fitting parameters
     use_snip : bool, optional
         use snip algorithm to remove background or not
+    chunk_size : int, optional
+        number of rows fitted by each task, defaults to 1
+    pool : FitPool, optional
+        pool of processes to use, by default a pool with a process per cpu
+        which is kept for the next calls
 
     Returns
     -------
     array
         Fitting values for all the elements
     """
-    num_processors_to_use = multiprocessing.cpu_count()
+    if pool is None:
+        pool = _get_default_pool()
+    return pool.fit(exp_data, matv, param, use_snip=use_snip,
+                    chunk_size=chunk_size)
 
-    logger.info('cpu count: {}'.format(num_processors_to_use))
-    pool = multiprocessing.Pool(num_processors_to_use)
 
-    result_pool = [
-        pool.apply_async(_log_and_fit, (n, data, matv,param, use_snip))
-        for n, data in enumerate(exp_data)]
+def fit_pixel_chunked_nnls(exp_data, matv, param, filename, use_snip=False,
+                           tile_size=64, chunk_size=1, pool=None):
+    """
+    Fit a map which does not fit in memory, tile by tile, into a file.
 
-    results = [r.get() for r in result_pool]
+    The map is fitted by tiles of `tile_size` rows, whose results are
+    written into a memory map saved in `filename`, so that neither the
+    experiment data nor the results are ever all held in memory.  The
+    tiles already fitted are recorded in ``filename + '.progress.npy'``:
+    if the fit is interrupted, calling this function again with the same
+    arguments only fits the remaining tiles.
 
-    pool.terminate()
-    pool.join()
+    Parameters
+    ----------
+    exp_data : array
+        3D data of experiment spectrum,
+        with x,y positions as the first 2-dim, and energy as the third one.
+        A memory map (e.g. from ``np.load(..., mmap_mode='r')``) is read
+        in place by the workers.  Any other object supporting slicing
+        along the rows, such as a h5py dataset, is read one tile at a time.
+    matv : array
+        matrix for regression analysis
+    param : dict
+        fitting parameters
+    filename : str
+        name of the .npy file for the results, of shape
+        ``exp_data.shape[:2] + (matv.shape[1] + 2,)``, see
+        `fit_pixel_multiprocess_nnls`
+    use_snip : bool, optional
+        use snip algorithm to remove background or not
+    tile_size : int, optional
+        number of rows of each tile, defaults to 64
+    chunk_size : int, optional
+        number of rows fitted by each task, defaults to 1
+    pool : FitPool, optional
+        pool of processes to use, by default a pool with a process per cpu
+        which is kept for the next calls
 
-    return np.array(results)
+    Returns
+    -------
+    memmap
+        Fitting values for all the elements
+    """
+    if pool is None:
+        pool = _get_default_pool()
+    shape = tuple(exp_data.shape[:2]) + (matv.shape[1] + 2,)
+    num_tiles = -(-shape[0] // tile_size)
+    progress = filename + '.progress.npy'
+    if os.path.exists(filename) and os.path.exists(progress):
+        out = np.lib.format.open_memmap(filename, mode='r+')
+        done = np.lib.format.open_memmap(progress, mode='r+')
+        if (out.shape != shape or out.dtype != float or
+                done.shape != (num_tiles,)):
+            raise ValueError("{0} is not the result of a fit of the same "
+                             "shape and tile size".format(filename))
+    else:
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=float,
+                                        shape=shape)
+        done = np.lib.format.open_memmap(progress, mode='w+', dtype=bool,
+                                         shape=(num_tiles,))
+
+    in_place = _as_mapped(exp_data) is not None
+    for tile in np.flatnonzero(~done):
+        start = tile * tile_size
+        stop = min(start + tile_size, shape[0])
+        if in_place:
+            pool.fit(exp_data, matv, param, use_snip=use_snip,
+                     chunk_size=chunk_size, out=out, rows=(start, stop))
+        else:
+            out[start:stop] = pool.fit(np.asarray(exp_data[start:stop]),
+                                       matv, param, use_snip=use_snip,
+                                       chunk_size=chunk_size)
+        # the tile is only marked as done once its results are on disk
+        out.flush()
+        done[tile] = True
+        done.flush()
+        logger.info('Fitted tile {0} of {1}'.format(tile + 1, num_tiles))
+    return out
 
 
 def calculate_area(e_select, matv, results,
@@ -1466,7 +2564,7 @@ def get_relative_cs_ratio(elemental_line, energy):
         calculated ratio
     """
     name, line = elemental_line.split('_')
-    e = Element(name)
+    e = get_xrf_element(name)
     transition_lines = TRANSITIONS_LOOKUP[line.upper()]
 
     sum_v = 0
@@ -41,7 +41,8 @@ calculations.
 """
 from __future__ import absolute_import, division, print_function
 import numpy as np
-from .utils import verbosedict
+from .utils import verbosedict, _grid3d_bounds
+from .accumulators.binned_statistic import RadialBinnedStatistic
 from collections import namedtuple
 import time
 
@@ -57,7 +58,7 @@ logger = logging.getLogger(__name__)
 
 def process_to_q(setting_angles, detector_size, pixel_size,
                  calibrated_center, dist_sample, wavelength, ub,
-                 frame_mode=None):
+                 frame_mode=None, dtype=np.float64, out=None):
     """
     This will compute the hkl values for all pixels in a shape specified by
     detector_size.
@@ -102,12 +103,24 @@ def process_to_q(setting_angles, detector_size, pixel_size,
         See the `process_to_q.frame_mode` attribute for an exact list of
         valid options.
 
+    dtype : {np.float64, np.float32}, optional
+        type of the output, the computation is always done in double
+        precision.  Defaults to np.float64
+
+    out : ndarray, optional
+        C contiguous float64 or float32 array of the shape of the output,
+        in which the result is written.  `dtype` is ignored if it is given.
+
     Returns
     -------
     hkl : ndarray
         (Qx, Qy, Qz) - HKL values
         shape is [num_images * num_rows * num_columns][3]
 
+    See Also
+    --------
+    iter_process_to_q : the same conversion, a few images at a time
+
     Notes
     -----
     Six angles of an image: (delta, theta, chi, phi, mu, gamma )
@@ -154,6 +167,9 @@ def process_to_q(setting_angles, detector_size, pixel_size,
         raise ValueError('It is expected that there should be six angles in '
                          'the setting_angles parameter. You provided {0}'
                          ' angles.'.format(setting_angles.shape[1]))
+    if out is None and np.dtype(dtype) != np.float64:
+        out = np.empty((len(setting_angles) * int(np.prod(detector_size)), 3),
+                       dtype=dtype)
     # *********** Converting to Q   **************
 
     # starting time for the process
@@ -167,7 +183,8 @@ def process_to_q(setting_angles, detector_size, pixel_size,
                         ccd_cen=(calibrated_center),
                         dist=dist_sample,
                         wavelength=wavelength,
-                        UBinv=np.matrix(ub).I)
+                        UBinv=np.matrix(ub).I,
+                        out=out)
 
     # ending time for the process
     t2 = time.time()
@@ -181,6 +198,165 @@ def process_to_q(setting_angles, detector_size, pixel_size,
 process_to_q.frame_mode = ['theta', 'phi', 'cart', 'hkl']
 
 
+def iter_process_to_q(setting_angles, detector_size, pixel_size,
+                      calibrated_center, dist_sample, wavelength, ub,
+                      frame_mode=None, chunk_size=1, dtype=np.float64,
+                      reuse=False):
+    """
+    Compute the hkl values of the pixels of a series of images, a few
+    images at a time.
+
+    The conversion of each chunk of images runs without the GIL, and only
+    the q values of one chunk are held at a time, so that they can be
+    processed (e.g. gridded) as they come.
+
+    Parameters
+    ----------
+    setting_angles, detector_size, pixel_size, calibrated_center, \
+    dist_sample, wavelength, ub, frame_mode, dtype :
+        see `process_to_q`
+    chunk_size : int, optional
+        number of images converted at a time, defaults to 1
+    reuse : bool, optional
+        If True, the q values of all the chunks are written in the same
+        array, which is only valid until the next chunk is requested.
+        Defaults to False.
+
+    Yields
+    ------
+    hkl : ndarray
+        (Qx, Qy, Qz) - HKL values of a chunk of images
+        shape is [chunk_size * num_rows * num_columns][3]
+    """
+    setting_angles = np.atleast_2d(setting_angles)
+    npix = int(np.prod(detector_size))
+    buffer = None
+    if reuse:
+        buffer = np.empty((min(chunk_size, len(setting_angles)) * npix, 3),
+                          dtype=dtype)
+    for start in range(0, len(setting_angles), chunk_size):
+        angles = setting_angles[start:start + chunk_size]
+        out = None if buffer is None else buffer[:len(angles) * npix]
+        yield process_to_q(angles, detector_size, pixel_size,
+                           calibrated_center, dist_sample, wavelength, ub,
+                           frame_mode=frame_mode, dtype=dtype, out=out)
+
+
+def process_grid(setting_angles, img_stack, detector_size, pixel_size,
+                 calibrated_center, dist_sample, wavelength, ub,
+                 frame_mode=None, nx=None, ny=None, nz=None,
+                 xmin=None, xmax=None, ymin=None, ymax=None,
+                 zmin=None, zmax=None, binary_mask=None, chunk_size=16,
+                 low_memory=None, mode='nearest'):
+    """
+    Grid a stack of images in reciprocal space, converting them to q a few
+    images at a time.
+
+    This gives the same result as `skbeam.core.utils.grid3d` applied to the
+    output of `process_to_q`, without ever holding the q values of all of
+    the images: each chunk of images is converted to q and added to the
+    running totals of the gridder.  If any of the grid bounds is not given,
+    the q values are computed in a first pass to find it.
+
+    Parameters
+    ----------
+    setting_angles : ndarray
+        six angles of all the images, see `process_to_q`
+    img_stack : array_like
+        Intensity array of the images, dimensions are
+        [num_img][num_rows][num_cols].  Only ``chunk_size`` images are
+        read at a time, so this can be a memory-mapped array or a
+        lazily-loaded dataset.
+    detector_size, pixel_size, calibrated_center, dist_sample, wavelength, \
+    ub, frame_mode :
+        see `process_to_q`
+    nx, ny, nz, xmin, xmax, ymin, ymax, zmin, zmax : optional
+        grid definition, see `skbeam.core.utils.grid3d`
+    binary_mask : ndarray, optional
+        Pixels with a value of 0 are not gridded.  Either a single image
+        or the same shape as `img_stack`.
+    chunk_size : int, optional
+        number of images converted to q at a time, defaults to 16
+    low_memory : bool, optional
+        gridding strategy, see `skbeam.core.utils.grid3d`
+    mode : {'nearest', 'cic'}, optional
+        deposition of the data points, see `skbeam.core.utils.grid3d`
+
+    Returns
+    -------
+    mean : ndarray
+        intensity grid
+    occupancy : ndarray
+        The number of data points that fell in the grid.
+    std_err : ndarray
+        standard error of the value in the grid box
+    bounds : list
+        tuple of (min, max, step) for x, y, z in order: [x_bounds,
+        y_bounds, z_bounds]
+    """
+    try:
+        from ..ext import ctrans
+    except ImportError:
+        raise NotImplementedError(
+            "ctrans is not available on your platform. See"
+            "https://github.com/scikit-beam/scikit-beam/issues/418"
+            "to follow updates to this problem.")
+
+    setting_angles = np.atleast_2d(setting_angles)
+    nimages = len(setting_angles)
+    if len(img_stack) != nimages:
+        raise ValueError("There are {0} images but {1} sets of setting "
+                         "angles".format(len(img_stack), nimages))
+    chunks = [slice(start, start + chunk_size)
+              for start in range(0, nimages, chunk_size)]
+
+    def chunks_to_q():
+        # the q values of a chunk are dropped once it is gridded
+        return iter_process_to_q(setting_angles, detector_size, pixel_size,
+                                 calibrated_center, dist_sample, wavelength,
+                                 ub, frame_mode=frame_mode,
+                                 chunk_size=chunk_size, reuse=True)
+
+    lower = (xmin, ymin, zmin)
+    upper = (xmax, ymax, zmax)
+    qmin = np.full(3, np.inf)
+    qmax = np.full(3, -np.inf)
+    if None in lower + upper:
+        # find the extent of the q values
+        for q in chunks_to_q():
+            qmin = np.minimum(qmin, q.min(axis=0))
+            qmax = np.maximum(qmax, q.max(axis=0))
+    qmin, qmax, dqn, bounds = _grid3d_bounds(qmin, qmax, (nx, ny, nz),
+                                             lower, upper)
+
+    if mode not in ('nearest', 'cic'):
+        raise ValueError("mode must be 'nearest' or 'cic', not {0}"
+                         "".format(mode))
+    t1 = time.time()
+    total = np.zeros(dqn)
+    total2 = np.zeros(dqn)
+    occupancy = np.zeros(dqn, dtype=float if mode == 'cic' else np.uint)
+    std_err = np.zeros(dqn)
+    for chunk, q in zip(chunks, chunks_to_q()):
+        mask = None
+        if binary_mask is not None:
+            # a single image mask is applied to every image by the gridder
+            mask = np.asarray(binary_mask)
+            if mask.ndim == 3:
+                mask = mask[chunk]
+            mask = np.ravel(mask)
+        total, total2, occupancy, std_err = ctrans.grid3d(
+            q, qmin, qmax, dqn, gridout=total,
+            grid2out=total2, nout=occupancy,
+            intensity=np.ravel(img_stack[chunk]), mask=mask,
+            low_memory=-1 if low_memory is None else int(low_memory),
+            cic=int(mode == 'cic'))
+    mean = total / occupancy
+    logger.info("Gridding {0} images took {1} seconds."
+                "".format(nimages, time.time() - t1))
+    return mean, occupancy, std_err, bounds
+
+
 def hkl_to_q(hkl_arr):
     """
     This module compute the reciprocal space (q) values from known HKL array
@@ -221,12 +397,152 @@ def calibrated_pixels_to_q(detector_size, pyfai_kwargs):
     -------
     q_val : ndarray
         Reciprocal values for each pixel shape is [num_rows * num_columns]
+
+    See Also
+    --------
+    CalibratedGeometry : keeps the geometry and its maps between calls
     """
-    if geo is None:
-        raise RuntimeError("You must have pyFAI installed to use this "
-                           "function.")
-    a = geo.Geometry(**pyfai_kwargs)
-    return a.qArray(detector_size)
+    # the maps of a CalibratedGeometry are read-only, as they are shared
+    return CalibratedGeometry(detector_size, pyfai_kwargs).q.copy()
+
+
+class CalibratedGeometry(object):
+    """A pyFAI calibrated geometry, with its per-pixel maps cached
+
+    The pyFAI geometry is built once, and the q, chi, two theta and radius
+    maps of the detector are computed on first use and kept until the
+    geometry changes.  The same applies to the radial integrators built on
+    the q map, so that processing a series of frames only costs the
+    integration itself.
+
+    Parameters
+    ----------
+    detector_size : tuple
+        2 element tuple defining the number of pixels in the detector. Order is
+        (num_columns, num_rows)
+    pyfai_kwargs: dict
+        The dictionary of pyfai geometry kwargs, given by pyFAI's calibration
+        Ex: dist, poni1, poni2, rot1, rot2, rot3, splineFile, wavelength,
+        detector, pixel1, pixel2
+
+    Examples
+    --------
+    >>> geometry = CalibratedGeometry((2048, 2048), poni)
+    >>> integrator = geometry.radial_integrator(bins=1000)
+    >>> for frame in frames:
+    ...     profile = integrator(frame)
+    >>> geometry.update(dist=poni['dist'] + 0.001)  # invalidates the maps
+    True
+    """
+    def __init__(self, detector_size, pyfai_kwargs):
+        if geo is None:
+            raise RuntimeError("You must have pyFAI installed to use this "
+                               "function.")
+        self.detector_size = tuple(detector_size)
+        self.pyfai_kwargs = {}
+        self.geometry = None
+        self.update(**pyfai_kwargs)
+
+    def update(self, **pyfai_kwargs):
+        """Change some parameters of the geometry
+
+        The cached maps and integrators are only dropped if one of the
+        parameters actually changes value.
+
+        Parameters
+        ----------
+        pyfai_kwargs :
+            pyFAI geometry kwargs to change, see `CalibratedGeometry`
+
+        Returns
+        -------
+        changed : bool
+            whether the geometry changed
+        """
+        changed = dict((key, value) for key, value in pyfai_kwargs.items()
+                       if key not in self.pyfai_kwargs or
+                       not _same_value(self.pyfai_kwargs[key], value))
+        if not changed and self.geometry is not None:
+            return False
+        self.pyfai_kwargs.update(changed)
+        self.geometry = geo.Geometry(**self.pyfai_kwargs)
+        self._maps = {}
+        self._integrators = {}
+        return True
+
+    def _map(self, name):
+        if name not in self._maps:
+            values = getattr(self.geometry, name)(self.detector_size)
+            # shared by all the users of the geometry
+            values.flags.writeable = False
+            self._maps[name] = values
+        return self._maps[name]
+
+    @property
+    def q(self):
+        """Scattering vector of each pixel, in inverse nm"""
+        return self._map('qArray')
+
+    @property
+    def chi(self):
+        """Azimuthal angle of each pixel, in radians"""
+        return self._map('chiArray')
+
+    @property
+    def two_theta(self):
+        """Scattering angle of each pixel, in radians"""
+        return self._map('twoThetaArray')
+
+    @property
+    def r(self):
+        """Distance of each pixel to the point of normal incidence, in m"""
+        return self._map('rArray')
+
+    def radial_integrator(self, bins=10, range=None, mask=None,
+                          statistic='mean', sparse=True, split_pixels=False):
+        """Integrator of frames over the q map of the detector
+
+        Integrators are cached by their parameters, and identity of the
+        mask, until the geometry changes.
+
+        Parameters
+        ----------
+        bins, range, mask, statistic, sparse, split_pixels :
+            see `skbeam.core.accumulators.binned_statistic.
+            RadialBinnedStatistic`
+
+        Returns
+        -------
+        RadialBinnedStatistic
+            callable on frames of shape `detector_size`, with bin edges in
+            q
+        """
+        key = (_hashable(bins), _hashable(range), statistic, sparse,
+               split_pixels, id(mask))
+        cached = self._integrators.get(key)
+        # keeping the mask alive in the cache keeps its id unique
+        if cached is None or cached[0] is not mask:
+            integrator = RadialBinnedStatistic(
+                self.detector_size, bins=bins, range=range, mask=mask,
+                r_map=self.q, statistic=statistic, sparse=sparse,
+                split_pixels=split_pixels)
+            cached = self._integrators[key] = mask, integrator
+        return cached[1]
+
+
+def _same_value(old, new):
+    if old is new:
+        return True
+    try:
+        return bool(np.array_equal(old, new))
+    except Exception:
+        return False
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_hashable(v) for v in value)
+    return value
 
 
 gisaxs_output = namedtuple(
@@ -301,45 +617,195 @@ def gisaxs(incident_beam, reflected_beam, pixel_size, detector_size,
        angle X-ray scattering analysis of supported islands," J. Appl.
        Cryst., vol 35, p 406-421, 2002.
     """
-    inc_x, inc_y = incident_beam
-    refl_x, refl_y = reflected_beam
-
-    # convert pixel_size to meters
-    pixel_size = np.asarray(pixel_size) * 10 ** (-6)
-
-    # tilt angle
-    tilt_angle = np.arctan2((refl_x - inc_x) * pixel_size[0],
-                            (refl_y - inc_y) * pixel_size[1])
-    # incident angle
-    alpha_i = np.arctan2((refl_y - inc_y) * pixel_size[1],
-                         dist_sample) / 2.
-
-    y, x = np.indices(detector_size)
-    # exit angle
-    alpha_f = np.arctan2((y - inc_y) * pixel_size[1],
-                         dist_sample) - alpha_i
-    # out of plane angle
-    two_theta = np.arctan2((x - inc_x) * pixel_size[0],
-                           dist_sample)
-    theta_f = two_theta / 2 - theta_i
-    # wave number
-    wave_number = 2*np.pi/wavelength
-
-    # x component
-    qx = (np.cos(alpha_f) * np.cos(2*theta_f) -
-          np.cos(alpha_i) * np.cos(2*theta_i)) * wave_number
-
-    # y component
-    # the variables post-fixed with an underscore are intermediate steps
-    qy_ = (np.cos(alpha_f) * np.sin(2*theta_f) -
-           np.cos(alpha_i) * np.sin(2*theta_i))
-    qz_ = np.sin(alpha_f) + np.sin(alpha_i)
-    qy = (qz_ * np.sin(tilt_angle) + qy_ * np.cos(tilt_angle)) * wave_number
-
-    # z component
-    qz = (qz_ * np.cos(tilt_angle) - qy_ * np.sin(tilt_angle)) * wave_number
-
-    # q parallel
-    qr = np.sqrt(qx**2 + qy**2)
-
-    return gisaxs_output(alpha_i, theta_f, alpha_f, tilt_angle, qx, qy, qz, qr)
+    geometry = GISAXSGeometry(incident_beam, pixel_size, detector_size,
+                              dist_sample, wavelength)
+    return geometry(reflected_beam, theta_i=theta_i)
+
+
+class GISAXSGeometry(object):
+    """Grazing-incidence geometry of a detector, for many incident angles
+
+    The exit and out of plane angles of the pixels only depend on the
+    position of the incident beam on the detector, so they are computed
+    once.  Each incident angle (i.e. position of the reflected beam) then
+    only costs the evaluation of the q components, which is done in place
+    in arrays of `dtype`.  The exit angle only varies along the first axis
+    of the detector and the out of plane angle along the second one, so the
+    trigonometric functions are evaluated on these axes only.
+
+    Parameters
+    ----------
+    incident_beam : tuple
+        x and y co-ordinates of the incident beam in pixels
+    pixel_size : tuple
+        pixel_size in um
+    detector_size: tuple
+        2 element tuple defining no. of pixels(size) in the
+        detector X and Y direction
+    dist_sample : float
+       sample to detector distance, in meters
+    wavelength : float
+        wavelength of the x-ray beam in Angstroms
+    dtype : dtype, optional
+        floating point type of the angle and q maps, defaults to float64
+
+    See Also
+    --------
+    gisaxs : the same computation for a single incident angle
+
+    Examples
+    --------
+    >>> geometry = GISAXSGeometry((10, 10), (75, 75), (100, 120), 1.5, 1.0,
+    ...                           dtype=np.float32)
+    >>> out = geometry((10, 40))
+    >>> out = geometry((10, 42), out=out)  # reuse the arrays
+    >>> scan = geometry.batch([(10, 40), (10, 42), (10, 44)])
+    >>> scan.qz.shape
+    (3, 100, 120)
+    """
+    def __init__(self, incident_beam, pixel_size, detector_size, dist_sample,
+                 wavelength, dtype=np.float64):
+        self.incident_beam = tuple(incident_beam)
+        # convert pixel_size to meters
+        self.pixel_size = np.asarray(pixel_size) * 10 ** (-6)
+        self.detector_size = tuple(detector_size)
+        self.dist_sample = dist_sample
+        self.wavelength = wavelength
+        self.dtype = np.dtype(dtype)
+        # wave number
+        self.wave_number = 2 * np.pi / wavelength
+
+        inc_x, inc_y = self.incident_beam
+        y = np.arange(self.detector_size[0])
+        x = np.arange(self.detector_size[1])
+        # exit angle for a zero incident angle, along the first axis
+        self._gamma = np.arctan2((y - inc_y) * self.pixel_size[1],
+                                 dist_sample)
+        # scattering angle out of plane, along the second axis
+        self._two_theta = np.arctan2((x - inc_x) * self.pixel_size[0],
+                                     dist_sample)
+
+    def angles(self, reflected_beam):
+        """Incident and tilt angles for a position of the reflected beam
+
+        Parameters
+        ----------
+        reflected_beam : tuple
+            x and y co-ordinates of the reflected beam in pixels
+
+        Returns
+        -------
+        alpha_i, tilt_angle : float
+        """
+        inc_x, inc_y = self.incident_beam
+        refl_x, refl_y = reflected_beam
+        tilt_angle = np.arctan2((refl_x - inc_x) * self.pixel_size[0],
+                                (refl_y - inc_y) * self.pixel_size[1])
+        alpha_i = np.arctan2((refl_y - inc_y) * self.pixel_size[1],
+                             self.dist_sample) / 2.
+        return alpha_i, tilt_angle
+
+    def __call__(self, reflected_beam, theta_i=0.0, out=None):
+        """Compute the angle and q maps for one incident angle
+
+        Parameters
+        ----------
+        reflected_beam : tuple
+            x and y co-ordinates of the reflected beam in pixels
+        theta_i : float, optional
+            out of plane angle, default 0.0
+        out : gisaxs_output, optional
+            result of a previous call, whose arrays are overwritten
+
+        Returns
+        -------
+        namedtuple
+            `gisaxs_output` object, see `gisaxs`
+        """
+        alpha_i, tilt_angle = self.angles(reflected_beam)
+        if out is None:
+            maps = [np.empty(self.detector_size, dtype=self.dtype)
+                    for _ in range(6)]
+        else:
+            maps = out[1:3] + out[4:]
+        self._fill(alpha_i, tilt_angle, theta_i, *maps)
+        theta_f, alpha_f, qx, qy, qz, qr = maps
+        return gisaxs_output(alpha_i, theta_f, alpha_f, tilt_angle,
+                             qx, qy, qz, qr)
+
+    def batch(self, reflected_beams, theta_i=0.0):
+        """Compute the angle and q maps for a series of incident angles
+
+        Parameters
+        ----------
+        reflected_beams : array_like
+            x and y co-ordinates of the reflected beam in pixels, Nx2
+        theta_i : float or array_like, optional
+            out of plane angle(s), default 0.0
+
+        Returns
+        -------
+        namedtuple
+            `gisaxs_output` object, see `gisaxs`, with the angles as arrays
+            of shape (N,) and the maps stacked along a first axis of
+            length N
+        """
+        reflected_beams = np.asarray(reflected_beams, dtype=float)
+        num = len(reflected_beams)
+        theta_i = np.broadcast_to(theta_i, (num,))
+        alpha_i, tilt_angle = self.angles(reflected_beams.T)
+        maps = [np.empty((num,) + self.detector_size, dtype=self.dtype)
+                for _ in range(6)]
+        for i in range(num):
+            self._fill(alpha_i[i], tilt_angle[i], theta_i[i],
+                       *[m[i] for m in maps])
+        theta_f, alpha_f, qx, qy, qz, qr = maps
+        return gisaxs_output(alpha_i, theta_f, alpha_f, tilt_angle,
+                             qx, qy, qz, qr)
+
+    def _fill(self, alpha_i, tilt_angle, theta_i, theta_f, alpha_f,
+              qx, qy, qz, qr):
+        dtype = self.dtype
+        wave_number = self.wave_number
+        # the angles only vary along one axis of the detector, so their
+        # functions are evaluated in double precision on that axis only
+        # exit angle, along the first axis
+        alpha_f_ = self._gamma - alpha_i
+        alpha_f[...] = alpha_f_[:, np.newaxis]
+        # out of plane angle, along the second axis
+        theta_f_ = self._two_theta / 2 - theta_i
+        theta_f[...] = theta_f_
+
+        # x component, written with 1 - cos(a) = 2 sin(a / 2)**2 so that
+        # the difference of cosines close to one does not cancel out,
+        # which matters at small angles and in single precision
+        vers_alpha_f = (2 * np.sin(alpha_f_ / 2) ** 2).astype(dtype)
+        vers_theta_f = (2 * np.sin(theta_f_) ** 2).astype(dtype)
+        vers_alpha_i = 2 * np.sin(alpha_i / 2) ** 2
+        vers_theta_i = 2 * np.sin(theta_i) ** 2
+        np.multiply(vers_alpha_f[:, np.newaxis], vers_theta_f, out=qx)
+        qx -= vers_alpha_f[:, np.newaxis]
+        qx -= vers_theta_f
+        qx += vers_alpha_i + vers_theta_i - vers_alpha_i * vers_theta_i
+        qx *= wave_number
+
+        # the variables post-fixed with an underscore are intermediate
+        # steps, qy_ is stored in qr until q parallel is computed
+        qy_ = np.multiply(np.cos(alpha_f_).astype(dtype)[:, np.newaxis],
+                          np.sin(2 * theta_f_).astype(dtype), out=qr)
+        qy_ -= np.cos(alpha_i) * np.sin(2 * theta_i)
+        qz_ = (np.sin(alpha_f_) + np.sin(alpha_i)).astype(dtype)
+        qz_ = qz_[:, np.newaxis]
+
+        # y component
+        np.multiply(qy_, np.cos(tilt_angle), out=qy)
+        qy += qz_ * np.sin(tilt_angle)
+        qy *= wave_number
+
+        # z component
+        np.multiply(qy_, -np.sin(tilt_angle), out=qz)
+        qz += qz_ * np.cos(tilt_angle)
+        qz *= wave_number
+
+        # q parallel
+        np.hypot(qx, qy, out=qr)
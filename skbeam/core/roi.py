@@ -406,7 +406,8 @@ def mean_intensity(images, labeled_array, index=None):
 
 
 def circular_average(image, calibrated_center, threshold=0, nx=100,
-                     pixel_size=(1, 1), min_x=None, max_x=None, mask=None):
+                     pixel_size=(1, 1), min_x=None, max_x=None, mask=None,
+                     split_pixels=False):
     """Circular average of the the image data
     The circular average is also known as the radial integration
 
@@ -433,6 +434,12 @@ def circular_average(image, calibrated_center, threshold=0, nx=100,
         Right edge of last bin defaults to maximum value of x
     mask : mask for 2D data. Assumes 1 is non masked and 0 masked.
         None defaults to no mask.
+    split_pixels : bool, optional
+        If True, share each pixel between the bins overlapped by its
+        footprint, in proportion to the overlap, instead of assigning it
+        wholly to the bin of its center.  The number of pixels in each bin
+        compared to `threshold` is then fractional.
+        default is False
 
     Returns
     -------
@@ -449,15 +456,34 @@ def circular_average(image, calibrated_center, threshold=0, nx=100,
     """
     radial_val = utils.radial_grid(calibrated_center, image.shape, pixel_size)
 
-    if mask is not None:
-        w = np.where(mask == 1)
-        radial_val = radial_val[w]
-        image = image[w]
-
-    bin_edges, sums, counts = utils.bin_1D(np.ravel(radial_val),
-                                           np.ravel(image), nx,
-                                           min_x=min_x,
-                                           max_x=max_x)
+    if split_pixels:
+        r_min, r_max = utils.radial_extent(calibrated_center, image.shape,
+                                           pixel_size)
+        if mask is not None:
+            mask = mask == 1
+            radial_val = radial_val[mask]
+        # same default bins as bin_1D
+        if min_x is None:
+            min_x = np.min(radial_val)
+        if max_x is None:
+            max_x = np.max(radial_val)
+        if nx is None:
+            nx = int(max_x - min_x)
+        bin_edges = np.linspace(min_x, max_x, nx + 1)
+        weights = utils.split_pixel_weights(r_min, r_max, bin_edges,
+                                            mask=mask)
+        sums = weights.dot(np.ravel(image))
+        counts = np.asarray(weights.sum(axis=1)).ravel()
+    else:
+        if mask is not None:
+            w = np.where(mask == 1)
+            radial_val = radial_val[w]
+            image = image[w]
+
+        bin_edges, sums, counts = utils.bin_1D(np.ravel(radial_val),
+                                               np.ravel(image), nx,
+                                               min_x=min_x,
+                                               max_x=max_x)
     th_mask = counts > threshold
     ring_averages = sums[th_mask] / counts[th_mask]
 
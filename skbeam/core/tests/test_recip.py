@@ -36,9 +36,12 @@ from __future__ import absolute_import, division, print_function
 import numpy as np
 import numpy.testing as npt
 from numpy.testing import assert_array_almost_equal
-from nose.tools import raises
+from nose.tools import raises, assert_equal, assert_raises
 
 from skbeam.core import recip
+from skbeam.core.accumulators.binned_statistic import RadialBinnedStatistic
+from skbeam.core.utils import grid3d
+from skbeam.testing.decorators import skip_if
 
 
 def test_process_to_q():
@@ -88,6 +91,38 @@ def test_process_to_q():
         recip.process_to_q(frame_mode=passes, **pdict)
 
 
+def test_process_to_q_out():
+    detector_size = (24, 32)
+    pdict = dict(detector_size=detector_size,
+                 pixel_size=(0.0135 * 8, 0.0135 * 8),
+                 calibrated_center=(12., 16.),
+                 dist_sample=355.0,
+                 wavelength=12398.4 / 640,
+                 ub=np.array([[-0.01231028454, 0.7405370482, 0.06323870032],
+                              [0.4450897473, 0.04166852402, -0.9509449389],
+                              [-0.7449130975, 0.01265920962, -0.5692399963]]))
+    setting_angles = np.array([[40., 15., 30., 25., 10., 5.],
+                               [42., 16., 30., 25., 10., 5.],
+                               [44., 17., 30., 25., 10., 5.]])
+    hkl = recip.process_to_q(setting_angles, **pdict)
+
+    single = recip.process_to_q(setting_angles, dtype=np.float32, **pdict)
+    assert_equal(single.dtype, np.float32)
+    npt.assert_array_almost_equal(single, hkl, decimal=6)
+    out = np.empty_like(hkl)
+    assert recip.process_to_q(setting_angles, out=out, **pdict) is out
+    npt.assert_array_equal(out, hkl)
+    assert_raises(ValueError, recip.process_to_q, setting_angles,
+                  out=np.empty((10, 3)), **pdict)
+
+    npix = detector_size[0] * detector_size[1]
+    for reuse in (False, True):
+        chunks = recip.iter_process_to_q(setting_angles, chunk_size=2,
+                                         reuse=reuse, **pdict)
+        for start, q in zip((0, 2), chunks):
+            npt.assert_array_equal(q, hkl[start * npix:(start + 2) * npix])
+
+
 @raises(KeyError)
 def _process_to_q_exception(param_dict, frame_mode):
     recip.process_to_q(frame_mode=frame_mode, **param_dict)
@@ -159,6 +194,105 @@ def test_gisaxs():
     assert_array_almost_equal(alpha_f_target, g_output.alpha_f[:, 1])
 
 
+def test_gisaxs_geometry():
+    args = ((10., 5.), (75., 75.), (40, 30), 1.5, 1.2)
+    beams = [(12., 25.), (11., 28.), (10., 31.)]
+    theta_i = [0., 0.01, -0.02]
+    geometry = recip.GISAXSGeometry(*args)
+    scan = geometry.batch(beams, theta_i)
+    out = None
+    for i, (beam, theta) in enumerate(zip(beams, theta_i)):
+        ref = recip.gisaxs(args[0], beam, *args[1:], theta_i=theta)
+        res = geometry(beam, theta_i=theta, out=out)
+        if out is not None:
+            # the arrays of the previous call are reused
+            assert res.qx is out.qx
+        out = res
+        for r, b, e in zip(res, scan, ref):
+            npt.assert_array_almost_equal(r, e)
+            npt.assert_array_almost_equal(b[i], e)
+
+    single = recip.GISAXSGeometry(*args, dtype=np.float32)(beams[1], 0.01)
+    for r, e in zip(single[4:], geometry(beams[1], 0.01)[4:]):
+        assert_equal(r.dtype, np.float32)
+        npt.assert_allclose(r, e, rtol=0, atol=1e-5 * np.abs(e).max())
+
+
+def test_process_grid():
+    detector_size = (32, 24)
+    pdict = dict(detector_size=detector_size,
+                 pixel_size=(0.0135 * 8, 0.0135 * 8),
+                 calibrated_center=(16., 12.),
+                 dist_sample=355.0,
+                 wavelength=12398.4 / 640,
+                 ub=np.array([[-0.01231028454, 0.7405370482, 0.06323870032],
+                              [0.4450897473, 0.04166852402, -0.9509449389],
+                              [-0.7449130975, 0.01265920962, -0.5692399963]]))
+    setting_angles = np.array([[40., 15., 30., 25., 10., 5.],
+                               [42., 16., 30., 25., 10., 5.],
+                               [44., 17., 30., 25., 10., 5.],
+                               [46., 18., 30., 25., 10., 5.],
+                               [48., 19., 30., 25., 10., 5.]])
+    images = np.random.random((5, detector_size[1], detector_size[0]))
+    mask = np.random.randint(2, size=images.shape[1:]).astype(bool)
+    hkl = recip.process_to_q(setting_angles, **pdict)
+
+    grid = {'nx': 8, 'ny': 9, 'nz': 10}
+    for binary_mask in (None, mask, np.array([mask] * 5)):
+        ref = grid3d(hkl, images, binary_mask=binary_mask, **grid)
+        res = recip.process_grid(setting_angles, images,
+                                 binary_mask=binary_mask, chunk_size=2,
+                                 **dict(pdict, **grid))
+        for r, e in zip(res, ref):
+            npt.assert_array_almost_equal(r, e)
+
+    # given bounds
+    grid.update(xmin=-0.2, xmax=0.1, ymin=0., ymax=0.5, zmin=-0.4, zmax=0.)
+    ref = grid3d(hkl, images, **grid)
+    res = recip.process_grid(setting_angles, images, chunk_size=3,
+                             **dict(pdict, **grid))
+    for r, e in zip(res, ref):
+        npt.assert_array_almost_equal(r, e)
+
+    # cloud-in-cell deposition, accumulated over the chunks
+    ref = grid3d(hkl, images, mode='cic', **grid)
+    res = recip.process_grid(setting_angles, images, chunk_size=2,
+                             mode='cic', **dict(pdict, **grid))
+    for r, e in zip(res, ref):
+        npt.assert_array_almost_equal(r, e)
+
+
+@skip_if(recip.geo is None, 'pyFAI is not installed')
+def test_calibrated_geometry():
+    detector_size = (100, 110)
+    pyfai_kwargs = dict(dist=.23, poni1=.0105, poni2=.0095, pixel1=.0002,
+                        pixel2=.0002, wavelength=1.43e-11)
+    geometry = recip.CalibratedGeometry(detector_size, pyfai_kwargs)
+    ref = recip.geo.Geometry(**pyfai_kwargs)
+    npt.assert_array_almost_equal(geometry.q, ref.qArray(detector_size))
+    npt.assert_array_almost_equal(geometry.chi, ref.chiArray(detector_size))
+    q = geometry.q
+    assert q is geometry.q
+
+    img = np.random.random(detector_size)
+    integrator = geometry.radial_integrator(bins=20)
+    assert integrator is geometry.radial_integrator(bins=20)
+    expected = RadialBinnedStatistic(detector_size, bins=20, r_map=q)
+    npt.assert_array_almost_equal(integrator(img), expected(img))
+
+    # setting the same value keeps the maps, a new one drops them
+    assert not geometry.update(dist=.23)
+    assert geometry.q is q
+    assert geometry.update(dist=.25)
+    assert geometry.radial_integrator(bins=20) is not integrator
+    q = recip.calibrated_pixels_to_q(detector_size,
+                                     dict(pyfai_kwargs, dist=.25))
+    npt.assert_array_almost_equal(geometry.q, q)
+    # unlike the shared maps, the result can be changed in place
+    assert not geometry.q.flags.writeable
+    q *= 10
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
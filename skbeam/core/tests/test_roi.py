@@ -335,6 +335,31 @@ def test_circular_average():
                               0.,  0.,  0.])
 
 
+def test_circular_average_split_pixels():
+    image = np.ones((12, 12))
+    calib_center = (5.2, 4.7)
+    mask = np.ones_like(image)
+    mask[4:6, 2:3] = 0
+
+    bin_cen, ring_avg = roi.circular_average(image, calib_center, nx=6,
+                                             mask=mask, split_pixels=True)
+    assert_array_almost_equal(ring_avg, np.ones(6))
+    assert_array_almost_equal(bin_cen, roi.circular_average(
+        image, calib_center, nx=6, mask=mask)[0])
+
+    # the whole image ends up in the bins
+    image = np.random.random((12, 12))
+    r_max = utils.radial_extent(calib_center, image.shape)[1].max()
+    bin_cen, ring_avg = roi.circular_average(image, calib_center, nx=10,
+                                             min_x=0, max_x=r_max,
+                                             split_pixels=True)
+    weights = utils.split_pixel_weights(
+        *utils.radial_extent(calib_center, image.shape),
+        bins=np.linspace(0, r_max, 11))
+    assert_almost_equal(np.sum(ring_avg * weights.sum(axis=1).A1),
+                        image.sum())
+
+
 def test_kymograph():
     calib_center = (25, 25)
     inner_radius = 5
@@ -41,7 +41,7 @@ import sys
 import numpy.testing as npt
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_almost_equal)
-from nose.tools import assert_equal, assert_true, raises
+from nose.tools import assert_equal, assert_true, raises, assert_raises
 
 from skbeam.testing.decorators import known_fail_if
 
@@ -257,6 +257,98 @@ def test_process_grid_std_err():
                                    np.std(np.arange(1, 101)) / np.sqrt(100)))
 
 
+def test_grid3d_mask():
+    q = np.random.random((5 * 12, 3))
+    img_stack = np.random.random((5, 3, 4))
+    mask = np.random.randint(2, size=(3, 4))
+    grid = dict(nx=4, ny=5, nz=6, xmin=0, xmax=1, ymin=0, ymax=1, zmin=0,
+                zmax=1)
+    keep = np.tile(mask.ravel(), 5) != 0
+    ref = core.grid3d(q[keep], img_stack.ravel()[keep], **grid)
+    for binary_mask in (mask, mask.astype(bool), np.array([mask] * 5)):
+        for low_memory in (None, True, False):
+            res = core.grid3d(q, img_stack, binary_mask=binary_mask,
+                              low_memory=low_memory, **grid)
+            for r, e in zip(res, ref):
+                assert_array_almost_equal(r, e)
+    assert_raises(ValueError, core.grid3d, q, img_stack,
+                  binary_mask=np.ones((2, 2)), **grid)
+
+
+def test_grid3d_low_memory():
+    q = np.random.random((100000, 3)) * 1.2 - 0.1
+    intensity = np.random.random(100000)
+    intensity[::1000] = np.nan
+    grid = dict(nx=13, ny=17, nz=11, xmin=0, xmax=1, ymin=0, ymax=1,
+                zmin=0, zmax=1)
+    ref = core.grid3d(q, intensity, low_memory=False, **grid)
+    res = core.grid3d(q, intensity, low_memory=True, **grid)
+    for r, e in zip(res, ref):
+        assert_array_almost_equal(r, e)
+    # compare with a plain histogram of the points which are not NaN
+    keep = ~np.isnan(intensity)
+    counts = np.histogramdd(q[keep], bins=(13, 17, 11),
+                            range=((0, 1), (0, 1), (0, 1)))[0]
+    assert_array_equal(res[1], counts)
+
+
+def test_grid3d_cic():
+    grid = dict(nx=5, ny=4, nz=3, xmin=0, xmax=1, ymin=0, ymax=1,
+                zmin=0, zmax=1)
+    # points at the voxel centers are deposited as in nearest mode
+    centers = [(np.arange(n) + .5) / n for n in (5, 4, 3)]
+    q = np.array([c.ravel() for c in np.meshgrid(*centers, indexing='ij')]).T
+    intensity = np.random.random(len(q))
+    ref = core.grid3d(q, intensity, **grid)
+    res = core.grid3d(q, intensity, mode='cic', **grid)
+    for r, e in zip(res[:3], ref[:3]):
+        assert_array_almost_equal(r, e)
+
+    q = np.random.random((20000, 3)) * 1.2 - 0.1
+    inside = np.all((q >= 0) & (q < 1), axis=1)
+    # the weights of each point sum to one, and a constant is preserved
+    mean, occupancy, std_err, _ = core.grid3d(q, np.full(len(q), 2.),
+                                              mode='cic', **grid)
+    assert_almost_equal(occupancy.sum(), inside.sum())
+    assert_array_almost_equal(mean, 2)
+    assert_array_almost_equal(std_err, 0)
+    # a point between two voxel centers is split linearly between them
+    line = dict(nx=2, ny=1, nz=1, xmin=0, xmax=1, ymin=0, ymax=1,
+                zmin=0, zmax=1)
+    occupancy = core.grid3d(np.array([[.375, .5, .5]]), np.ones(1),
+                            mode='cic', **line)[1]
+    assert_array_almost_equal(occupancy.ravel(), [.75, .25])
+    # both strategies of the gridder agree
+    for r, e in zip(core.grid3d(q, q[:, 0], mode='cic', low_memory=True,
+                                **grid),
+                    core.grid3d(q, q[:, 0], mode='cic', low_memory=False,
+                                **grid)):
+        assert_array_almost_equal(r, e)
+
+    assert_raises(ValueError, core.grid3d, q, q[:, 0], mode='linear', **grid)
+
+
+def test_grid_slice():
+    q = np.random.random((20000, 3))
+    intensity = np.random.random(len(q))
+    grid = dict(nx=6, ny=7, xmin=0, xmax=1, ymin=0, ymax=1)
+    res = core.grid_slice(q, intensity, 2, .5, .2, mode='nearest', **grid)
+    ref = core.grid3d(q, intensity, nz=1, zmin=.4, zmax=.6, **grid)
+    for r, e in zip(res[:3], ref[:3]):
+        assert_equal(r.shape, (6, 7))
+        assert_array_almost_equal(r, e[:, :, 0])
+    sub = np.abs(q[:, 2] - .5) < .1
+    assert_almost_equal(res[1].sum(), sub.sum())
+
+    mean, occupancy = core.grid_slice(q, intensity, 0, .5, .2,
+                                      ny=6, nz=7)[:2]
+    assert_equal(mean.shape, (6, 7))
+    assert_almost_equal(occupancy.sum(), (np.abs(q[:, 0] - .5) < .1).sum())
+
+    assert_raises(ValueError, core.grid_slice, q, intensity, 1, .5, .2,
+                  ny=4)
+
+
 def test_bin_edge2center():
     test_edges = np.arange(11)
     centers = core.bin_edges_to_centers(test_edges)
@@ -545,6 +637,43 @@ def test_radial_grid():
     assert_equal(a[3, 4], 1)
 
 
+def test_radial_extent():
+    r_min, r_max = core.radial_extent((3, 3), (7, 7))
+    r = core.radial_grid((3, 3), (7, 7))
+    assert_equal(r_min[3, 3], 0)
+    assert_equal(r_max[3, 3], np.hypot(.5, .5))
+    assert_equal(r_min[3, 5], 1.5)
+    assert_equal(r_max[3, 5], np.hypot(2.5, .5))
+    assert_true(np.all(r_min <= r) and np.all(r <= r_max))
+
+    # interpolated at the corners, the extent of a linear ramp is exact
+    lower, upper = core.pixel_extent(np.arange(12.).reshape(3, 4))
+    assert_array_almost_equal(lower, np.arange(12.).reshape(3, 4) - 2.5)
+    assert_array_almost_equal(upper, np.arange(12.).reshape(3, 4) + 2.5)
+
+
+def test_split_pixel_weights():
+    lower = np.array([0., 0.5, 2., 2.5, 3.5, -1.])
+    upper = np.array([1., 1.5, 2., 4.5, 4., -.5])
+    weights = core.split_pixel_weights(lower, upper, [0, 1, 2, 3, 4])
+    assert_equal(weights.shape, (4, 6))
+    assert_array_almost_equal(weights.toarray(),
+                              [[1, .5, 0, 0, 0, 0],
+                               [0, .5, 0, 0, 0, 0],
+                               [0, 0, 1, .25, 0, 0],
+                               [0, 0, 0, .5, 1, 0]])
+
+    weights = core.split_pixel_weights(lower, upper, [0, 1, 2, 3, 4],
+                                       mask=[1, 0, 1, 1, 1, 1])
+    assert_array_almost_equal(weights.sum(axis=1).A1, [1, 0, 1.25, 1.5])
+
+    # the weights of pixels well within the bins add up to one
+    r_min, r_max = core.radial_extent((20.3, 15.6), (40, 50))
+    weights = core.split_pixel_weights(r_min, r_max, np.linspace(0, 40, 81))
+    inside = (r_max < 40).ravel()
+    assert_array_almost_equal(weights.sum(axis=0).A1[inside], 1)
+
+
 def test_geometric_series():
     time_series = core.geometric_series(common_ratio=5, number_of_images=150)
 
@@ -568,6 +697,28 @@ def test_bin_grid():
     assert_array_almost_equal(y, x, decimal=2)
 
 
+def test_bin_grid_split_pixels():
+    r_array = core.radial_grid((20.3, 15.6), (40, 50))
+    img = np.ones(r_array.shape)
+    bins = np.linspace(2, 20, 37)
+    mask = np.ones(img.shape, dtype=bool)
+    mask[:5] = False
+
+    x, y = core.bin_grid(img, r_array, (1, 1), bins=bins, mask=mask,
+                         split_pixels=True)
+    assert_array_almost_equal(x, core.bin_edges_to_centers(bins))
+    assert_array_almost_equal(y, 1)
+
+    # the total intensity is conserved, only split between bins
+    x, y = core.bin_grid(img, r_array, (1, 1), statistic='sum',
+                         bins=np.linspace(0, 50, 101), split_pixels=True)
+    assert_almost_equal(y.sum(), img.sum())
+
+    with assert_raises(ValueError):
+        core.bin_grid(img, r_array, (1, 1), statistic='median',
+                      split_pixels=True)
+
+
 if __name__ == '__main__':
     import nose
 
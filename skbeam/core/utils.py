@@ -50,6 +50,7 @@ import numpy as np
 from itertools import tee
 
 import logging
+import scipy.sparse
 import scipy.stats as sts
 
 logger = logging.getLogger(__name__)
@@ -625,6 +626,151 @@ def radial_grid(center, shape, pixel_size=None):
     return np.sqrt(X * X + Y * Y)
 
 
+def radial_extent(center, shape, pixel_size=None):
+    """Radial extent of the footprint of each pixel relative to some center
+
+    The footprint of a pixel is the rectangle defined by its four corners.
+
+    Parameters
+    ----------
+    center : tuple
+        point in image where r=0; may be a float giving subpixel precision.
+        Order is (rr, cc).
+    shape : tuple
+        Image shape which is used to determine the maximum extent of output
+        pixel coordinates.
+        Order is (rr, cc).
+    pixel_size : sequence, optional
+        The physical size of the pixels.
+        len(pixel_size) should be the same as len(shape)
+        defaults to (1,1)
+
+    Returns
+    -------
+    r_min : array
+        The smallest distance from `center` of any point of each pixel,
+        zero for the pixel containing `center`
+    r_max : array
+        The largest distance from `center` of any point of each pixel
+        Shape of the return values is equal to the `shape` input parameter
+
+    See Also
+    --------
+    radial_grid : The distance of the center of each pixel from `center`
+    split_pixel_weights : Distribute pixels over bins given their extent
+    """
+
+    if pixel_size is None:
+        pixel_size = (1, 1)
+
+    X, Y = np.meshgrid(np.abs(pixel_size[1] * (np.arange(shape[1]) -
+                                               center[1])),
+                       np.abs(pixel_size[0] * (np.arange(shape[0]) -
+                                               center[0])))
+    half_x = np.abs(pixel_size[1]) / 2
+    half_y = np.abs(pixel_size[0]) / 2
+    r_min = np.hypot(np.maximum(X - half_x, 0), np.maximum(Y - half_y, 0))
+    r_max = np.hypot(X + half_x, Y + half_y)
+    return r_min, r_max
+
+
+def pixel_extent(values):
+    """Range of a smoothly varying quantity over the footprint of each pixel
+
+    The quantity (for example a tilt corrected radius) is interpolated at
+    the four corners of each pixel from its values at the pixel centers,
+    extrapolating linearly at the edges of the image.
+
+    Parameters
+    ----------
+    values : array
+        2D array of the quantity at the center of each pixel
+
+    Returns
+    -------
+    lower : array
+        The smallest value at the corners of each pixel
+    upper : array
+        The largest value at the corners of each pixel
+        Shape of the return values is equal to the shape of `values`
+    """
+    values = np.asarray(values, dtype=float)
+    padded = np.pad(values, 1, mode='reflect', reflect_type='odd')
+    corners = (padded[:-1, :-1] + padded[1:, :-1] +
+               padded[:-1, 1:] + padded[1:, 1:]) / 4
+    corners = np.array([corners[:-1, :-1], corners[1:, :-1],
+                        corners[:-1, 1:], corners[1:, 1:]])
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+def split_pixel_weights(lower, upper, bins, mask=None):
+    """Weights distributing each pixel over bins (pixel splitting)
+
+    Each pixel covers the range [`lower`, `upper`] and is shared between the
+    bins it overlaps, in proportion to the overlap.  Pixels with an empty
+    range go wholly to the bin containing them.  The parts of pixels that
+    fall outside of the bins are ignored.
+
+    Parameters
+    ----------
+    lower : array
+        Lower end of the range covered by each pixel, see `radial_extent`
+        and `pixel_extent`
+    upper : array
+        Upper end of the range covered by each pixel, same shape as `lower`
+    bins : array
+        The bin edges, monotonically increasing
+    mask : array, optional
+        array of zero/non-zero values, same shape as `lower`.
+        zero values will be ignored.
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        ``(len(bins) - 1, lower.size)`` matrix of the fraction of each
+        (flattened) pixel falling in each bin.  The sum of an image in each
+        bin is ``weights.dot(image.ravel())``, and the (fractional) number
+        of pixels in each bin is ``weights.sum(axis=1)``.
+    """
+    bins = np.asarray(bins, dtype=float)
+    nbins = len(bins) - 1
+    lower = np.ravel(lower).astype(float)
+    upper = np.ravel(upper).astype(float)
+    pixels = np.arange(lower.size)
+
+    keep = (upper >= bins[0]) & (lower <= bins[-1])
+    if mask is not None:
+        keep &= np.ravel(mask) != 0
+    pixels, lower, upper = pixels[keep], lower[keep], upper[keep]
+
+    # range of bins overlapped by each pixel
+    first = np.clip(np.searchsorted(bins, lower, side='right') - 1,
+                    0, nbins - 1)
+    last = np.clip(np.searchsorted(bins, upper, side='left') - 1,
+                   0, nbins - 1)
+    last = np.maximum(first, last)
+    nspan = last - first + 1
+
+    # one entry per (bin, pixel) pair
+    offset = np.arange(nspan.sum()) - np.repeat(np.cumsum(nspan) - nspan,
+                                                nspan)
+    rows = np.repeat(first, nspan) + offset
+    cols = np.repeat(pixels, nspan)
+    lower = np.repeat(lower, nspan)
+    upper = np.repeat(upper, nspan)
+    overlap = (np.minimum(upper, bins[rows + 1]) -
+               np.maximum(lower, bins[rows]))
+    width = upper - lower
+    data = np.ones(len(rows))
+    split = width > 0
+    data[split] = np.clip(overlap[split], 0, None) / width[split]
+
+    nonzero = data > 0
+    return scipy.sparse.csr_matrix(
+        (data[nonzero], (rows[nonzero], cols[nonzero])),
+        shape=(nbins, len(keep)))
+
+
 def angle_grid(center, shape, pixel_size=None):
     """
     Make a grid of angular positions.
@@ -823,11 +969,45 @@ def bin_edges(range_min=None, range_max=None, nbins=None, step=None):
         return range_max - np.arange(nbins + 1)[::-1] * step
 
 
+def _grid3d_bounds(qmin, qmax, n, lower, upper):
+    """
+    Grid bounds for `grid3d`: the number of voxels `n` and the `lower` and
+    `upper` bounds along x, y, z default to `_defaults` and to the extent
+    `qmin`, `qmax` of the data.
+
+    Returns
+    -------
+    qmin, qmax : ndarray
+        lower and upper bounds
+    dqn : list
+        number of voxels
+    bounds : ndarray
+        (min, max, step) for x, y, z, see `grid3d`
+    """
+    qmin = np.array(qmin, dtype=float)
+    qmax = np.array(qmax, dtype=float)
+    dqn = [_defaults['nx'], _defaults['ny'], _defaults['nz']]
+
+    # pad the upper edge by just enough to ensure that all of the
+    # points are in-bounds with the binning rules: lo <= val < hi
+    qmax += np.spacing(qmax)
+
+    # check for non-default input
+    for target, input_vals in ((dqn, n), (qmin, lower), (qmax, upper)):
+        for j, in_val in enumerate(input_vals):
+            if in_val is not None:
+                target[j] = in_val
+
+    # format bounds
+    bounds = np.array([qmin, qmax, dqn]).T
+    return qmin, qmax, dqn, bounds
+
+
 def grid3d(q, img_stack,
            nx=None, ny=None, nz=None,
            xmin=None, xmax=None, ymin=None,
            ymax=None, zmin=None, zmax=None,
-           binary_mask=None):
+           binary_mask=None, low_memory=None, mode='nearest'):
     """Grid irregularly spaced data points onto a regular grid via histogramming
 
     This function will process the set of reciprocal space values (q), the
@@ -865,6 +1045,21 @@ def grid3d(q, img_stack,
         Binary mask can be two different shapes.
         - 1: 2-D with binary_mask.shape == np.asarray(img_stack[0]).shape
         - 2: 3-D with binary_mask.shape == np.asarray(img_stack).shape
+    low_memory : bool, optional
+        If True, sort the data points by slabs of the grid and let each
+        thread fill whole slabs, which needs two indices per data point.
+        If False, let each thread fill its own copy of the grid and sum
+        them, which needs three values per voxel and per thread.  By
+        default, the option needing less memory is used.
+    mode : {'nearest', 'cic'}, optional
+        How the data points are deposited on the grid:
+
+          * 'nearest' : each data point is added to the voxel it falls in.
+          * 'cic' : cloud-in-cell, each data point is shared between the
+            eight voxels whose centers surround it, with trilinear
+            weights.  There is no interpolation along axes with a single
+            voxel, which gives bilinear in-plane maps (see `grid_slice`).
+            This always uses the low memory strategy.
 
     Returns
     -------
@@ -872,10 +1067,12 @@ def grid3d(q, img_stack,
         intensity grid.  The values in this grid are the
         mean of the values that fill with in the grid.
     occupancy : ndarray
-        The number of data points that fell in the grid.
+        The number of data points that fell in the grid.  In 'cic' mode,
+        the total weight of the data points in the grid.
     std_err : ndarray
         This is the standard error of the value in the
-        grid box.
+        grid box.  In 'cic' mode, the variance is weighted and divided by
+        the occupancy.
     bounds : list
         tuple of (min, max, step) for x, y, z in order: [x_bounds,
         y_bounds, z_bounds]
@@ -890,21 +1087,20 @@ def grid3d(q, img_stack,
             "to follow updates to this problem.")
 
     # validate input
+    if mode not in ('nearest', 'cic'):
+        raise ValueError("mode must be 'nearest' or 'cic', not {0}"
+                         "".format(mode))
     img_stack = np.asarray(img_stack)
     # todo determine if we're going to support masked arrays
     # todo masked arrays seemed to have been punted to `process_to_q`
 
     # check to see if the binary mask and the image stack are identical shapes
-    if binary_mask is None or binary_mask.shape == img_stack.shape:
+    # or if the mask is a single image. The gridder applies a single image
+    # mask to every image of the stack.
+    if (binary_mask is None or binary_mask.shape == img_stack.shape or
+            binary_mask.shape == img_stack[0].shape):
         # do a dance :)
         pass
-    elif binary_mask.shape == img_stack[0].shape:
-        # this is still a valid mask, so make it the same dimensions
-        # as img_stack.
-        # should probably change this to use something similar to:
-        # todo http://stackoverflow.com/questions/5564098/
-        binary_mask = np.tile(np.ravel(binary_mask), img_stack.shape[0])
-
     else:
         raise ValueError("The binary mask must be the same shape as the"
                          "img_stack ({0}) or a single image in the image "
@@ -921,31 +1117,14 @@ def grid3d(q, img_stack,
         raise ValueError("The shape of q must be an Nx3 array, not {0}X{1}"
                          " which you provided.".format(*q.shape))
 
-    # set defaults for qmin, qmax, dq
-    qmin = np.min(q, axis=0)
-    qmax = np.max(q, axis=0)
-    dqn = [_defaults['nx'], _defaults['ny'], _defaults['nz']]
-
-    # pad the upper edge by just enough to ensure that all of the
-    # points are in-bounds with the binning rules: lo <= val < hi
-    qmax += np.spacing(qmax)
+    qmin, qmax, dqn, bounds = _grid3d_bounds(
+        np.min(q, axis=0), np.max(q, axis=0), (nx, ny, nz),
+        (xmin, ymin, zmin), (xmax, ymax, zmax))
 
-    # check for non-default input
-    for target, input_vals in ((dqn, (nx, ny, nz)),
-                               (qmin, (xmin, ymin, zmin)),
-                               (qmax, (xmax, ymax, zmax))):
-        for j, in_val in enumerate(input_vals):
-            if in_val is not None:
-                target[j] = in_val
-
-    # format bounds
-    bounds = np.array([qmin, qmax, dqn]).T
-
-    # creating (Qx, Qy, Qz, I) Nx4 array - HKL values and Intensity
-    # getting the intensity value for each pixel
-    q = np.insert(q, 3, np.ravel(img_stack), axis=1)
+    # the positions, intensities and mask are passed as they are, without
+    # building a (Qx, Qy, Qz, I) Nx4 copy
     if binary_mask is not None:
-        q = q[np.ravel(binary_mask)]
+        binary_mask = np.ravel(binary_mask)
 
     # 3D grid of the data set
     # starting time for gridding
@@ -953,7 +1132,10 @@ def grid3d(q, img_stack,
 
     # call the c library
 
-    total, total2, occupancy, std_err = ctrans.grid3d(q, qmin, qmax, dqn)
+    total, total2, occupancy, std_err = ctrans.grid3d(
+        q, qmin, qmax, dqn, intensity=np.ravel(img_stack), mask=binary_mask,
+        low_memory=-1 if low_memory is None else int(low_memory),
+        cic=int(mode == 'cic'))
     mean = total / occupancy
 
     # ending time for the gridding
@@ -971,6 +1153,55 @@ def grid3d(q, img_stack,
     return mean, occupancy, std_err, bounds
 
 
+def grid_slice(q, img_stack, axis, center, thickness, binary_mask=None,
+               mode='cic', **kwargs):
+    """Grid the data points of a slab of reciprocal space onto a 2D map
+
+    The slab is perpendicular to `axis`, and the data points it contains
+    are gridded in-plane by `grid3d`, with a single voxel across the slab.
+
+    Parameters
+    ----------
+    q : ndarray
+        (Qx, Qy, Qz) - HKL values - Nx3 array
+    img_stack : ndarray
+        Intensity array of the images, see `grid3d`
+    axis : int
+        normal of the slab: 0, 1 or 2 for x, y or z
+    center : float
+        position of the slab along `axis`
+    thickness : float
+        thickness of the slab
+    binary_mask : ndarray, optional
+        see `grid3d`
+    mode : {'cic', 'nearest'}, optional
+        deposition of the data points, see `grid3d`.  Defaults to 'cic',
+        i.e. bilinear interpolation in the plane of the slab.
+    kwargs :
+        number of voxels and bounds along the two other axes, with the
+        names of `grid3d` (e.g. `nx`, `ymin`, `ymax` for a slab normal to
+        z)
+
+    Returns
+    -------
+    mean, occupancy, std_err : ndarray
+        2D maps, see `grid3d`
+    bounds : list
+        see `grid3d`
+    """
+    name = 'xyz'[axis]
+    normal = ('n' + name, name + 'min', name + 'max')
+    if any(k in kwargs for k in normal):
+        raise ValueError("The extent along the slab normal is given by "
+                         "center and thickness, not by {0}".format(normal))
+    kwargs.update(zip(normal, (1, center - thickness / 2.,
+                               center + thickness / 2.)))
+    mean, occupancy, std_err, bounds = grid3d(
+        q, img_stack, binary_mask=binary_mask, mode=mode, **kwargs)
+    return (np.take(mean, 0, axis=axis), np.take(occupancy, 0, axis=axis),
+            np.take(std_err, 0, axis=axis), bounds)
+
+
 def bin_edges_to_centers(input_edges):
     """
     Helper function for turning a array of bin edges into
@@ -1224,7 +1455,7 @@ def geometric_series(common_ratio, number_of_images, first_term=1):
 
 
 def bin_grid(image, r_array, pixel_sizes, statistic='mean', mask=None,
-             bins=None):
+             bins=None, split_pixels=False):
     """
     Bin and integrate an image, given the radial array of pixels
 
@@ -1243,6 +1474,12 @@ def bin_grid(image, r_array, pixel_sizes, statistic='mean', mask=None,
     bins: array, optional
         The bins to use in the integration, if none given the function will
         give its best assessment based on the pixel_size and r_array
+    split_pixels: bool, optional
+        If True, share each pixel between the bins overlapped by its
+        footprint, in proportion to the overlap, instead of assigning it
+        wholly to the bin of its center.  Only the 'mean', 'sum' and
+        'count' statistics are available.  The weights can be computed once
+        with `split_pixel_weights` to integrate many images.
 
     Returns
     -------
@@ -1255,6 +1492,7 @@ def bin_grid(image, r_array, pixel_sizes, statistic='mean', mask=None,
     --------
     circular_average : circularly average an image, assuming linear radial
         spacing (less general)
+    split_pixel_weights : Distribute pixels over bins given their extent
 
     """
     if mask is None:
@@ -1264,6 +1502,26 @@ def bin_grid(image, r_array, pixel_sizes, statistic='mean', mask=None,
         bins = np.arange(np.min(r_array) - res * .5,
                          np.max(r_array) + res * .5, res)
 
+    if split_pixels:
+        if statistic not in ('mean', 'sum', 'count'):
+            raise ValueError("Pixel splitting only supports the 'mean', "
+                             "'sum' and 'count' statistics, not "
+                             "{0!r}".format(statistic))
+        if np.isscalar(bins):
+            bins = np.linspace(np.min(r_array[mask]),
+                               np.max(r_array[mask]), bins + 1)
+        lower, upper = pixel_extent(r_array)
+        weights = split_pixel_weights(lower, upper, bins, mask=mask)
+        count = np.asarray(weights.sum(axis=1)).ravel()
+        if statistic == 'count':
+            int_stat = count
+        else:
+            int_stat = weights.dot(np.ravel(image))
+        if statistic == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                int_stat = int_stat / count
+        return bin_edges_to_centers(bins), int_stat
+
     int_stat, bin_edge, bin_num = sts.binned_statistic(r_array[mask],
                                                        image[mask],
                                                        statistic=statistic,
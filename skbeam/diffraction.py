@@ -58,6 +58,7 @@ from skbeam.core.utils import bin_1D
 from skbeam.core.utils import bin_edges
 from skbeam.core.utils import bin_edges_to_centers
 from skbeam.core.utils import grid3d
+from skbeam.core.utils import grid_slice
 from skbeam.core.utils import q_to_d
 from skbeam.core.utils import d_to_q
 from skbeam.core.utils import q_to_twotheta
@@ -85,7 +86,8 @@ __all__ = [
 
 
     # core
-    'bin_1D', 'bin_edges', 'bin_edges_to_centers', 'grid3d', 'q_to_d',
+    'bin_1D', 'bin_edges', 'bin_edges_to_centers', 'grid3d', 'grid_slice',
+    'q_to_d',
     'd_to_q', 'q_to_twotheta', 'twotheta_to_q', 'angle_grid',
     'radial_grid',
 
@@ -41,7 +41,8 @@ This module creates a namespace for X-Ray Fluorescence
 from skbeam.core.fitting import (Lorentzian2Model, ComptonModel, ElasticModel)
 
 # import Element objects
-from skbeam.core.constants import XrfElement, emission_line_search
+from skbeam.core.constants import (XrfElement, emission_line_search,
+                                   get_xrf_element, EmissionLineIndex)
 
 # import background subtraction
 from skbeam.core.fitting.background import snip_method
@@ -55,7 +56,8 @@ __all__ = [
     'Lorentzian2Model', 'ComptonModel', 'ElasticModel',
 
     # import Element objects
-    'XrfElement', 'emission_line_search',
+    'XrfElement', 'emission_line_search', 'get_xrf_element',
+    'EmissionLineIndex',
 
     # import background subtraction
     'snip_method',
@@ -45,7 +45,7 @@
 #else
 
 #define omp_get_thread_num() 0
-#define omp_get_max_threads() 0
+#define omp_get_max_threads() 1
 #define omp_get_num_threads() 1
 
 #endif
@@ -69,6 +69,7 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
   PyArrayObject *ubinv = NULL;
   PyObject *_ubinv = NULL;
   PyArrayObject *qOut = NULL;
+  PyObject *_qOut = NULL;
   CCD ccd;
   npy_intp dims[2];
   npy_intp nimages;
@@ -79,15 +80,15 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
   double lambda;
 
   double *anglesp = NULL;
-  double *qOutp = NULL;
+  void *qOutp = NULL;
+  int single;
   double *ubinvp = NULL;
-  double *delgam = NULL;
 
   static char *kwlist[] = { "angles", "mode", "ccd_size", "ccd_pixsize",
 			                      "ccd_cen", "dist", "wavelength",
-			                      "UBinv", NULL };
+			                      "UBinv", "out", NULL };
 
-  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "Oi(ii)(dd)(dd)ddO", kwlist,
+  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "Oi(ii)(dd)(dd)ddO|O", kwlist,
 				                          &_angles,
 				                          &mode,
 				                          &ccd.xSize, &ccd.ySize,
@@ -95,7 +96,8 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
 				                          &ccd.xCen, &ccd.yCen,
 				                          &ccd.dist,
 				                          &lambda,
-				                          &_ubinv)){
+				                          &_ubinv,
+				                          &_qOut)){
 
     return NULL;
   }
@@ -119,25 +121,40 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
   dims[0] = nimages * ccd.size;
   dims[1] = 3;
 
-  qOut = (PyArrayObject*)PyArray_SimpleNew(2, dims, NPY_DOUBLE);
-  if(!qOut){
-    goto cleanup;
+  if(_qOut && (_qOut != Py_None)){
+    // Write into the array given by the caller, in double or single precision
+    if(!PyArray_Check(_qOut) || (PyArray_NDIM((PyArrayObject*)_qOut) != 2) ||
+       (PyArray_DIM((PyArrayObject*)_qOut, 0) != dims[0]) ||
+       (PyArray_DIM((PyArrayObject*)_qOut, 1) != 3)){
+      PyErr_Format(PyExc_ValueError, "out must be an array of shape (%ld, 3)",
+                   (long)dims[0]);
+      goto cleanup;
+    }
+    if(!PyArray_ISCARRAY((PyArrayObject*)_qOut) ||
+       ((PyArray_TYPE((PyArrayObject*)_qOut) != NPY_DOUBLE) &&
+        (PyArray_TYPE((PyArrayObject*)_qOut) != NPY_FLOAT))){
+      PyErr_SetString(PyExc_ValueError, "out must be a writeable, C contiguous "
+                      "float64 or float32 array");
+      goto cleanup;
+    }
+    qOut = (PyArrayObject*)_qOut;
+    Py_INCREF(qOut);
+  } else {
+    qOut = (PyArrayObject*)PyArray_SimpleNew(2, dims, NPY_DOUBLE);
+    if(!qOut){
+      goto cleanup;
+    }
   }
 
   anglesp = (double *)PyArray_DATA(angles);
-  qOutp = (double *)PyArray_DATA(qOut);
-
-  // Now create the arrays for delta-gamma pairs
-  delgam = (double*)malloc(nimages * ccd.size * sizeof(double) * 2);
-  if(!delgam){
-    goto cleanup;
-  }
+  qOutp = PyArray_DATA(qOut);
+  single = (PyArray_TYPE(qOut) == NPY_FLOAT);
 
   // Ok now we don't touch Python Object ... Release the GIL
   Py_BEGIN_ALLOW_THREADS
 
-  retval = processImages(delgam, anglesp, qOutp, lambda, mode, (unsigned long)nimages,
-                         ubinvp, &ccd);
+  retval = processImages(anglesp, qOutp, single, lambda, mode,
+                         (unsigned long)nimages, ubinvp, &ccd);
 
   // Now we have finished with the magic ... Obtain the GIL
   Py_END_ALLOW_THREADS
@@ -149,23 +166,23 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
 
   Py_XDECREF(ubinv);
   Py_XDECREF(angles);
-  if(delgam) free(delgam);
   return Py_BuildValue("N", qOut);
 
  cleanup:
   Py_XDECREF(ubinv);
   Py_XDECREF(angles);
   Py_XDECREF(qOut);
-  if(delgam) free(delgam);
   return NULL;
 }
 
-int processImages(double *delgam, double *anglesp, double *qOutp, double lambda,
+int processImages(double *anglesp, void *qOutp, int single, double lambda,
                   int mode, unsigned long nimages, double *ubinvp, CCD *ccd){
 
   int retval = 0;
-  unsigned long i;
+  long i, n, nrows;
   double UBI[3][3];
+  double *delta = NULL, *gamma = NULL;
+  double *frames = NULL, *gamTrig = NULL;
 
   // Permute the UB matrix into the orientation
   // for the calculations
@@ -177,83 +194,138 @@ int processImages(double *delgam, double *anglesp, double *qOutp, double lambda,
     ubinvp+=3;
   }
 
-#pragma omp parallel for shared(anglesp, qOutp, delgam, mode)
-  for(i=0;i<nimages;i++){
-    // Calculate pointer offsets
+  // The delta and gamma offsets of the pixels only depend on their row and
+  // column, and the rotation to the output frame only depends on the image
+
+  delta = (double *)malloc(sizeof(double) * ccd->ySize);
+  gamma = (double *)malloc(sizeof(double) * ccd->xSize);
+  frames = (double *)malloc(sizeof(double) * 9 * nimages);
+  gamTrig = (double *)malloc(sizeof(double) * 2 * ccd->xSize * nimages);
+  if(!delta || !gamma || !frames || !gamTrig){
+    retval = 1;
+    goto cleanup;
+  }
 
+  calcDeltaGamma(delta, gamma, ccd);
+
+  for(i=0;i<(long)nimages;i++){
     double *_anglesp = anglesp + (i * 6);
-    double *_qOutp = qOutp + (i * ccd->size * 3);
-    double *_delgam = delgam + (i * ccd->size * 2);
-
-    // For each image process
-    calcDeltaGamma(_delgam, ccd, _anglesp[0], _anglesp[5]);
-    calcQTheta(_delgam, _anglesp[1], _anglesp[4], _qOutp,
-	       ccd->size, lambda);
-    if(mode > 1){
-      calcQPhiFromQTheta(_qOutp, ccd->size, _anglesp[2], _anglesp[3]);
+    double *_gamTrig = gamTrig + (i * ccd->xSize * 2);
+    int j;
+
+    calcFrameMatrix((double (*)[3])(frames + (i * 9)), mode, _anglesp[2],
+                    _anglesp[3], UBI);
+    for(j=0;j<ccd->xSize;j++){
+      _gamTrig[2 * j] = sin(_anglesp[5] - gamma[j]);
+      _gamTrig[2 * j + 1] = cos(_anglesp[5] - gamma[j]);
     }
-    if(mode == 4){
-      calcHKLFromQPhi(_qOutp, ccd->size, UBI);
+  }
+
+  // Rows of all the images are shared between the threads, so that a single
+  // image is processed in parallel too
+
+  nrows = (long)nimages * ccd->ySize;
+
+#pragma omp parallel for schedule(static)
+  for(n=0;n<nrows;n++){
+    long image = n / ccd->ySize;
+    int row = n % ccd->ySize;
+    double *_anglesp = anglesp + (image * 6);
+    double (*mat)[3] = (double (*)[3])(frames + (image * 9));
+    double *_gamTrig = gamTrig + (image * ccd->xSize * 2);
+    double q[3], terms[6];
+    int j, k;
+
+    calcQThetaTerms(terms, _anglesp[0] - delta[row], _anglesp[1],
+                    _anglesp[4], lambda);
+    for(j=0;j<ccd->xSize;j++){
+      calcQTheta(q, _gamTrig[2 * j], _gamTrig[2 * j + 1], terms);
+      matmulti(q, mat);
+      if(single){
+        float *_qOutp = (float *)qOutp + ((n * ccd->xSize + j) * 3);
+        for(k=0;k<3;k++){
+          _qOutp[k] = (float)q[k];
+        }
+      } else {
+        double *_qOutp = (double *)qOutp + ((n * ccd->xSize + j) * 3);
+        for(k=0;k<3;k++){
+          _qOutp[k] = q[k];
+        }
+      }
     }
   }
 
+ cleanup:
+  if(delta) free(delta);
+  if(gamma) free(gamma);
+  if(frames) free(frames);
+  if(gamTrig) free(gamTrig);
   return retval;
 }
 
-int calcDeltaGamma(double *delgam, CCD *ccd, double delCen, double gamCen){
-  // Calculate Delta Gamma Values for CCD
+int calcDeltaGamma(double *delta, double *gamma, CCD *ccd){
+  // Calculate the Delta and Gamma offsets of the rows and columns of the CCD
   int i,j;
-  double *delgamp = delgam;
   double xPix, yPix;
 
   xPix = ccd->xPixSize / ccd->dist;
   yPix = ccd->yPixSize / ccd->dist;
 
   for(j=0;j<ccd->ySize;j++){
-    for(i=0;i<ccd->xSize;i++){
-      *(delgamp++) = delCen - atan( ((double)j - ccd->yCen) * yPix);
-      *(delgamp++) = gamCen - atan( ((double)i - ccd->xCen) * xPix);
-    }
+    delta[j] = atan(((double)j - ccd->yCen) * yPix);
+  }
+  for(i=0;i<ccd->xSize;i++){
+    gamma[i] = atan(((double)i - ccd->xCen) * xPix);
   }
 
   return true;
 }
 
-int calcQTheta(double* diffAngles, double theta, double mu, double *qTheta, int n, double lambda){
-  // Calculate Q in the Theta frame
-  // angles -> Six cicle detector angles [delta gamma]
+int calcQThetaTerms(double *terms, double del, double theta, double mu,
+                    double lambda){
+  // Terms of Q in the Theta frame which are common to a row of pixels
+  // del    -> Delta value of the row
   // theta  -> Theta value at this detector setting
   // mu     -> Mu value at this detector setting
-  // qTheta -> Q Values
-  // n      -> Number of values to convert
-  int i;
-  double *angles;
-  double *qt;
   double kl;
-  double del, gam;
 
-  angles = diffAngles;
-  qt = qTheta;
   kl = 2 * M_PI / lambda;
-  for(i=0;i<n;i++){
-    del = *(angles++);
-    gam = *(angles++);
-    *qt = (-1.0 * sin(gam) * kl) - (sin(mu) * kl);
+  terms[0] = kl;
+  terms[1] = -1.0 * sin(mu) * kl;
+  terms[2] = cos(del - theta) * kl;
+  terms[3] = -1.0 * cos(theta) * cos(mu) * kl;
+  terms[4] = sin(del - theta) * kl;
+  terms[5] = sin(theta) * cos(mu) * kl;
 
-    qt++;
-    *qt = (cos(del - theta) * cos(gam) * kl) - (cos(theta) * cos(mu) * kl);
-
-    qt++;
-    *qt = (sin(del - theta) * cos(gam) * kl) + (sin(theta) * cos(mu) * kl);
+  return true;
+}
 
-    qt++;
-  }
+int calcQTheta(double *qTheta, double sinGam, double cosGam, double *terms){
+  // Calculate Q in the Theta frame
+  // sinGam, cosGam -> sine and cosine of the Gamma value of the pixel
+  // terms  -> see calcQThetaTerms
+  // qTheta -> Q Value
+  qTheta[0] = (-1.0 * sinGam * terms[0]) + terms[1];
+  qTheta[1] = (terms[2] * cosGam) + terms[3];
+  qTheta[2] = (terms[4] * cosGam) + terms[5];
 
   return true;
 }
 
-int calcQPhiFromQTheta(double *qTheta, int n, double chi, double phi){
+int calcFrameMatrix(double mat[][3], int mode, double chi, double phi,
+                    double ubi[][3]){
+  // Matrix from the Theta frame to the frame of the mode
   double r[3][3];
+  int i, j, k;
+
+  if(mode < 2){
+    for(i=0;i<3;i++){
+      for(j=0;j<3;j++){
+        mat[i][j] = (i == j) ? 1.0 : 0.0;
+      }
+    }
+    return true;
+  }
 
   r[0][0] = cos(chi);
   r[0][1] = 0.0;
@@ -265,78 +337,137 @@ int calcQPhiFromQTheta(double *qTheta, int n, double chi, double phi){
   r[2][1] = -1.0 * sin(phi);
   r[2][2] = cos(phi) * cos(chi);
 
-  matmulti(qTheta, n, r);
+  if(mode != 4){
+    for(i=0;i<3;i++){
+      for(j=0;j<3;j++){
+        mat[i][j] = r[i][j];
+      }
+    }
+    return true;
+  }
 
-  return true;
-}
+  // HKL from the Phi frame
+  for(i=0;i<3;i++){
+    for(j=0;j<3;j++){
+      mat[i][j] = 0.0;
+      for(k=0;k<3;k++){
+        mat[i][j] += ubi[i][k] * r[k][j];
+      }
+    }
+  }
 
-int calcHKLFromQPhi(double *qPhi, int n, double mat[][3]){
-  matmulti(qPhi, n, mat);
   return true;
 }
 
-int matmulti(double *val, int n, double mat[][3]){
-  double *v;
+int matmulti(double *v, double mat[][3]){
   double qp[3];
-  int i,j,k;
+  int j,k;
 
-  v = val;
-
-  for(i=0;i<n;i++){
-    for(k=0;k<3;k++){
-      qp[k] = 0.0;
-      for(j=0;j<3;j++){
-	qp[k] += mat[k][j] * v[j];
-      }
-    }
-    for(k=0;k<3;k++){
-      v[k] = qp[k];
+  for(k=0;k<3;k++){
+    qp[k] = 0.0;
+    for(j=0;j<3;j++){
+      qp[k] += mat[k][j] * v[j];
     }
-    v += 3;
+  }
+  for(k=0;k<3;k++){
+    v[k] = qp[k];
   }
 
   return true;
 }
 
-
 static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs){
   PyArrayObject *gridout = NULL, *grid2out = NULL, *Nout = NULL, *stderror = NULL;
-  PyArrayObject *gridI = NULL;
+  PyArrayObject *gridI = NULL, *intensity = NULL, *mask = NULL;
   PyObject *_dout = NULL, *_d2out = NULL, *_nout = NULL;
+  PyObject *_intensity = NULL, *_mask = NULL;
   PyObject *_I;
 
   npy_intp data_size;
+  npy_intp mask_size = 0;
   npy_intp dims[3];
 
   double grid_start[3];
   double grid_stop[3];
   unsigned long grid_nsteps[3];
 
+  double *qp, *ip;
+  unsigned long qstride, istride;
+  npy_bool *maskp = NULL;
+
   int ignore_nan = 0; 
+  int low_memory = -1;
+  int cic = 0;
 
   int retval;
 
   static char *kwlist[] = { "data", "xrange", "yrange", "zrange", "ignore_nan", 
-                            "gridout", "grid2out", "nout", NULL }; 
+                            "gridout", "grid2out", "nout", "intensity", "mask",
+                            "low_memory", "cic", NULL }; 
 
-  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "O(ddd)(ddd)(lll)|dOOO", kwlist, 
+  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "O(ddd)(ddd)(lll)|iOOOOOii", kwlist, 
 				  &_I,
 				  &grid_start[0], &grid_start[1], &grid_start[2],
 				  &grid_stop[0], &grid_stop[1], &grid_stop[2],
 				  &grid_nsteps[0], &grid_nsteps[1], &grid_nsteps[2],
-          &ignore_nan, &_dout, &_d2out, &_nout)){
+          &ignore_nan, &_dout, &_d2out, &_nout, &_intensity, &_mask,
+          &low_memory, &cic)){
     return NULL;
   }
 
-  gridI = (PyArrayObject*)PyArray_FROMANY(_I, NPY_DOUBLE, 0, 0, NPY_ARRAY_IN_ARRAY);
+  gridI = (PyArrayObject*)PyArray_FROMANY(_I, NPY_DOUBLE, 2, 2, NPY_ARRAY_IN_ARRAY);
   if(!gridI){
     goto error;
   }
 
   data_size = PyArray_DIM(gridI, 0);
-  if(PyArray_DIM(gridI, 1) != 4){
-    PyErr_SetString(PyExc_ValueError, "Dimension 1 of array must be 4");
-    goto error;
+  qp = (double *)PyArray_DATA(gridI);
+
+  if((_intensity == NULL) || (_intensity == Py_None)){
+    // The intensity is the last column of the data
+    if(PyArray_DIM(gridI, 1) != 4){
+      PyErr_SetString(PyExc_ValueError, "Dimension 1 of array must be 4");
+      goto error;
+    }
+    qstride = 4;
+    ip = qp + 3;
+    istride = 4;
+  } else {
+    // The data only holds the positions
+    if(PyArray_DIM(gridI, 1) != 3){
+      PyErr_SetString(PyExc_ValueError, 
+                      "Dimension 1 of array must be 3 when the intensity is given");
+      goto error;
+    }
+    intensity = (PyArrayObject*)PyArray_FROMANY(_intensity, NPY_DOUBLE, 1, 1,
+                                                NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    if(!intensity){
+      goto error;
+    }
+    if(PyArray_DIM(intensity, 0) != data_size){
+      PyErr_SetString(PyExc_ValueError, 
+                      "The intensity must have one value per row of data");
+      goto error;
+    }
+    qstride = 3;
+    ip = (double *)PyArray_DATA(intensity);
+    istride = 1;
+  }
+
+  if((_mask != NULL) && (_mask != Py_None)){
+    // The mask is repeated over the data, e.g. one mask for every image
+    mask = (PyArrayObject*)PyArray_FROMANY(_mask, NPY_BOOL, 1, 1,
+                                           NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    if(!mask){
+      goto error;
+    }
+    mask_size = PyArray_DIM(mask, 0);
+    if((mask_size == 0) || (data_size % mask_size)){
+      PyErr_SetString(PyExc_ValueError, 
+                      "The length of the data must be a multiple of the length of the mask");
+      goto error;
+    }
+    maskp = (npy_bool *)PyArray_DATA(mask);
   }
 
   dims[0] = grid_nsteps[0];
@@ -361,10 +492,12 @@ static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs){
     goto error;
   }
 
+  // With cloud-in-cell deposition the occupancy is a sum of weights
   if(_nout == NULL){
-    Nout = (PyArrayObject*)PyArray_ZEROS(3, dims, NPY_ULONG, 0);
+    Nout = (PyArrayObject*)PyArray_ZEROS(3, dims, cic ? NPY_DOUBLE : NPY_ULONG, 0);
   } else {
-    Nout = (PyArrayObject*)PyArray_FROMANY(_nout, NPY_ULONG, 0, 0, NPY_ARRAY_IN_ARRAY);
+    Nout = (PyArrayObject*)PyArray_FROMANY(_nout, cic ? NPY_DOUBLE : NPY_ULONG, 0, 0,
+                                           NPY_ARRAY_IN_ARRAY);
   }
   if(!Nout){
     goto error;
@@ -379,10 +512,12 @@ static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs){
   Py_BEGIN_ALLOW_THREADS
 
   retval = c_grid3d((double*)PyArray_DATA(gridout), (double *)PyArray_DATA(grid2out),
-                    (unsigned long*)PyArray_DATA(Nout),
-                    (double*)PyArray_DATA(stderror), (double*)PyArray_DATA(gridI),
+                    cic ? NULL : (unsigned long*)PyArray_DATA(Nout),
+                    cic ? (double*)PyArray_DATA(Nout) : NULL,
+                    (double*)PyArray_DATA(stderror), qp, qstride, ip, istride,
+                    maskp, (unsigned long)mask_size,
 		                grid_start, grid_stop, (unsigned long)data_size, grid_nsteps,
-                    ignore_nan);
+                    ignore_nan, low_memory);
 
   // Ok now get the GIL back
   Py_END_ALLOW_THREADS
@@ -394,10 +529,14 @@ static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs){
   }
 
   Py_XDECREF(gridI);
+  Py_XDECREF(intensity);
+  Py_XDECREF(mask);
   return Py_BuildValue("NNNN", gridout, grid2out, Nout, stderror);
 
 error:
   Py_XDECREF(gridI);
+  Py_XDECREF(intensity);
+  Py_XDECREF(mask);
   Py_XDECREF(gridout);
   Py_XDECREF(grid2out);
   Py_XDECREF(Nout);
@@ -405,25 +544,110 @@ error:
   return NULL;
 }
 
-int c_grid3d(double *dout, double *d2out, unsigned long *nout, double *stderror, double *data, 
-             double *grid_start, double *grid_stop, unsigned long max_data,
-             unsigned long *n_grid, int ignore_nan){
+/* Flat index of the voxel containing a point at position q, or -1 if the
+   point is outside of the grid or has a NaN value (unless ignore_nan) */
+static long grid_index(double *q, double value, double *grid_start, double *grid_len,
+                       unsigned long *n_grid, int ignore_nan){
+  double pos_double;
+  unsigned long grid_pos[3];
+  int k;
 
-  unsigned long i, j;
-  int n;
-  int retval = 0;
-  unsigned long grid_size = 0;
-  double grid_len[3];
+  // Check if we have a NaN
+  if((ignore_nan != 1) && isnan(value)){
+    return -1;
+  }
 
-  // Some useful quantities
+  for(k=0;k<3;k++){
+    // Calculate the relative position in the grid.
+    pos_double = (q[k] - grid_start[k]) / grid_len[k];
+    if(!((pos_double >= 0) && (pos_double < 1))){
+      return -1;
+    }
+    // Calculate the position in the grid
+    grid_pos[k] = (unsigned long)(pos_double * n_grid[k]);
+    if(grid_pos[k] >= n_grid[k]){
+      grid_pos[k] = n_grid[k] - 1;
+    }
+  }
 
-  grid_size = n_grid[0] * n_grid[1] * n_grid[2];
-  for(i=0;i<3; i++){
-    grid_len[i] = grid_stop[i] - grid_start[i];
+  return grid_pos[0] * (n_grid[1] * n_grid[2]) + grid_pos[1] * n_grid[2] + grid_pos[2];
+}
+
+/* Cloud-in-cell deposition: a point is shared between the (up to) eight
+   voxels whose centers surround it, with trilinear weights.  Returns the
+   flat index of the lowest of these voxels, or -1 as grid_index, and sets
+   the fraction of the point going to the upper voxel along each axis.
+   Points between the edge of the grid and the outer voxel centers go to
+   the outer voxels, and there is no interpolation along axes of a single
+   voxel (e.g. the normal of a 2D slice). */
+static long cic_corner(double *q, double value, double *grid_start, double *grid_len,
+                       unsigned long *n_grid, int ignore_nan, double *frac){
+  double pos_double, u;
+  long corner[3];
+  int k;
+
+  // Check if we have a NaN
+  if((ignore_nan != 1) && isnan(value)){
+    return -1;
+  }
+
+  for(k=0;k<3;k++){
+    pos_double = (q[k] - grid_start[k]) / grid_len[k];
+    if(!((pos_double >= 0) && (pos_double < 1))){
+      return -1;
+    }
+    // Position in units of voxels, relative to the first voxel center
+    u = pos_double * n_grid[k] - 0.5;
+    corner[k] = (long)floor(u);
+    frac[k] = u - corner[k];
+    if((n_grid[k] == 1) || (u < 0)){
+      corner[k] = 0;
+      frac[k] = 0.0;
+    } else if(corner[k] >= (long)n_grid[k] - 1){
+      corner[k] = n_grid[k] - 1;
+      frac[k] = 0.0;
+    }
+  }
+
+  return corner[0] * (n_grid[1] * n_grid[2]) + corner[1] * n_grid[2] + corner[2];
+}
+
+/* Add a point to the voxels around it (see cic_corner) */
+static void cic_deposit(double *dout, double *d2out, double *wout, long corner,
+                        double *frac, double value, unsigned long *n_grid){
+  int a, b, c;
+  double w;
+  long pos;
+
+  for(a=0;a<2;a++){
+    for(b=0;b<2;b++){
+      for(c=0;c<2;c++){
+        w = (a ? frac[0] : 1 - frac[0]) * (b ? frac[1] : 1 - frac[1]) *
+            (c ? frac[2] : 1 - frac[2]);
+        if(w == 0){
+          continue;
+        }
+        pos = corner + a * (n_grid[1] * n_grid[2]) + b * n_grid[2] + c;
+        dout[pos] += w * value;
+        d2out[pos] += w * value * value;
+        wout[pos] += w;
+      }
+    }
   }
+}
 
+/* Grid with one private copy of the grid per thread, summed at the end */
+static int grid3d_private(double *dout, double *d2out, unsigned long *nout,
+                          double *q, unsigned long qstride, double *intensity,
+                          unsigned long istride, npy_bool *mask, unsigned long mask_size,
+                          double *grid_start, double *grid_len, unsigned long max_data,
+                          unsigned long *n_grid, unsigned long grid_size, int ignore_nan){
+
+  unsigned long i, j;
+  int n;
+  int retval = 0;
   int max_threads = omp_get_max_threads();
-  int num_threads;
+  int num_threads = 1;
 
   gridderThreadData *threadData = malloc(sizeof(gridderThreadData) * max_threads);
   if(!threadData){
@@ -436,7 +660,7 @@ int c_grid3d(double *dout, double *d2out, unsigned long *nout, double *stderror,
     threadData[n].d2out = NULL;
   }
 
-#pragma omp parallel shared(data, num_threads, threadData, grid_start, grid_len)
+#pragma omp parallel shared(q, intensity, mask, num_threads, threadData, grid_start, grid_len) private(j)
   {
     int thread_num = omp_get_thread_num();
     num_threads = omp_get_num_threads();
@@ -449,6 +673,10 @@ int c_grid3d(double *dout, double *d2out, unsigned long *nout, double *stderror,
     _dout = (double *)malloc(sizeof(double) * grid_size);
     _nout = (unsigned long *)malloc(sizeof(unsigned long) * grid_size);
 
+    threadData[thread_num].dout = _dout;
+    threadData[thread_num].d2out = _d2out;
+    threadData[thread_num].nout = _nout;
+
     if((_d2out != NULL) && (_dout != NULL) && (_nout != NULL)){
 
       // Clear the arrays ....
@@ -460,45 +688,23 @@ int c_grid3d(double *dout, double *d2out, unsigned long *nout, double *stderror,
 
 #pragma omp for
       for(i=0;i<max_data;i++){
-
-        double pos_double[3];
-        unsigned long grid_pos[3];
-        double *data_ptr = data + (i * 4);
-
-        // Check if we have a NaN
-        
-        if((ignore_nan == 1) || !isnan(data_ptr[3])){   
-
-          // Calculate the relative position in the grid.
-          
-          pos_double[0] = (data_ptr[0] - grid_start[0]) / grid_len[0];
-          pos_double[1] = (data_ptr[1] - grid_start[1]) / grid_len[1];
-          pos_double[2] = (data_ptr[2] - grid_start[2]) / grid_len[2];
-
-          if((pos_double[0] >= 0) && (pos_double[0] < 1) &&
-            (pos_double[1] >= 0) && (pos_double[1] < 1) &&
-            (pos_double[2] >= 0) && (pos_double[2] < 1)){
-            
-            // Calculate the position in the grid
-            grid_pos[0] = (int)(pos_double[0] * n_grid[0]);
-            grid_pos[1] = (int)(pos_double[1] * n_grid[1]);
-            grid_pos[2] = (int)(pos_double[2] * n_grid[2]);
-            
-            unsigned long pos =  grid_pos[0] * (n_grid[1] * n_grid[2]);
-            pos += grid_pos[1] * n_grid[2];
-            pos += grid_pos[2];
-
-            // Store the answer
-            _dout[pos] += data_ptr[3];
-            _d2out[pos] += (data_ptr[3] * data_ptr[3]);
-            _nout[pos]++;
-          }
-        } 
+        double value = intensity[i * istride];
+        long pos;
+
+        // Skip masked points
+        if(mask && !mask[i % mask_size]){
+          continue;
+        }
+
+        pos = grid_index(q + (i * qstride), value, grid_start, grid_len,
+                         n_grid, ignore_nan);
+        if(pos >= 0){
+          // Store the answer
+          _dout[pos] += value;
+          _d2out[pos] += (value * value);
+          _nout[pos]++;
+        }
       }
-
-      threadData[thread_num].dout = _dout;
-      threadData[thread_num].d2out = _d2out;
-      threadData[thread_num].nout = _nout;
     } else {
       retval = 1;
     }
@@ -509,46 +715,254 @@ int c_grid3d(double *dout, double *d2out, unsigned long *nout, double *stderror,
     goto error;
   }
 
-  // Now gather the results
+  // Now gather the results into the outputs
 
-  for(n=1;n<num_threads;n++){
-    for(j=0;j<grid_size;j++){
-      threadData[0].nout[j] += threadData[n].nout[j];
-      threadData[0].dout[j] += threadData[n].dout[j];
-      threadData[0].d2out[j] += threadData[n].d2out[j];
+#pragma omp parallel for private(n)
+  for(j=0;j<grid_size;j++){
+    for(n=0;n<num_threads;n++){
+      dout[j] += threadData[n].dout[j];
+      d2out[j] += threadData[n].d2out[j];
+      nout[j] += threadData[n].nout[j];
     }
   }
-  
-  // Now copy the outputs to the arrays
 
-  for(j=0;j<grid_size;j++){
-    dout[j] += threadData[0].dout[j];
-    d2out[j] += threadData[0].d2out[j];
-    nout[j] += threadData[0].nout[j];
+error:
+
+  for(n=0;n<max_threads;n++){
+    if(threadData[n].d2out) free(threadData[n].d2out);
+    if(threadData[n].dout) free(threadData[n].dout);
+    if(threadData[n].nout) free(threadData[n].nout);
   }
 
-  // Calculate the stderror
+  free(threadData);
+  return retval;
+}
 
-  for(j=0;j<grid_size;j++){
-    if(threadData[0].nout[j] == 0){
-      stderror[j] = 0.0;
-    } else {
-      double var = (d2out[j] - pow(dout[j], 2) / nout[j]) / nout[j];
-      stderror[j] = pow(var, 0.5) / pow(nout[j], 0.5);
+/* Grid by slabs of the grid: the points are sorted by the slab they fall
+   in, then each thread adds the points of whole slabs straight into the
+   output.  The slabs are disjoint, so there is no need for private grids
+   nor for a reduction, at the price of two indices per point.
+
+   With cloud-in-cell deposition (wout is given instead of nout), points
+   are sorted by their lowest voxel and also reach into the next slab.
+   The slabs are then made larger than this reach and the even and the
+   odd slabs are added in turn. */
+static int grid3d_slabs(double *dout, double *d2out, unsigned long *nout, double *wout,
+                        double *q, unsigned long qstride, double *intensity,
+                        unsigned long istride, npy_bool *mask, unsigned long mask_size,
+                        double *grid_start, double *grid_len, unsigned long max_data,
+                        unsigned long *n_grid, unsigned long grid_size, int ignore_nan){
+
+  long i;
+  long t, n_slabs, n_chunks;
+  unsigned long slab_size, chunk_size;
+  unsigned long s;
+  long *bins = NULL;
+  unsigned long *order = NULL;
+  unsigned long *offsets = NULL;
+  unsigned long total;
+  unsigned long min_slab_size = 1;
+  int phase, n_phases = 1;
+  int retval = 1;
+
+  if(wout){
+    // a point reaches this far above its lowest voxel
+    min_slab_size = n_grid[1] * n_grid[2] + n_grid[2] + 2;
+    n_phases = 2;
+  }
+
+  // Several slabs per thread to balance the load, and data chunks
+  // counted and sorted independently
+
+  n_chunks = omp_get_max_threads();
+  n_slabs = 4 * n_chunks;
+  if((unsigned long)n_slabs > grid_size / min_slab_size){
+    n_slabs = grid_size / min_slab_size;
+  }
+  if(n_slabs < 1){
+    n_slabs = 1;
+  }
+  slab_size = (grid_size + n_slabs - 1) / n_slabs;
+  chunk_size = (max_data + n_chunks - 1) / n_chunks;
+
+  bins = (long *)malloc(sizeof(long) * max_data);
+  order = (unsigned long *)malloc(sizeof(unsigned long) * max_data);
+  offsets = (unsigned long *)calloc(n_chunks * n_slabs + 1, sizeof(unsigned long));
+  if(!bins || !order || !offsets){
+    goto error;
+  }
+
+  // Find the voxel of every point and count the points of each data chunk
+  // in each slab
+
+#pragma omp parallel for private(i, s) schedule(static, 1)
+  for(t=0;t<n_chunks;t++){
+    unsigned long *counts = offsets + (t * n_slabs);
+    unsigned long last = (t + 1) * chunk_size;
+    if(last > max_data){
+      last = max_data;
+    }
+    for(i=t*chunk_size;i<(long)last;i++){
+      double value = intensity[i * istride];
+      double frac[3];
+      if(mask && !mask[i % mask_size]){
+        bins[i] = -1;
+      } else if(wout){
+        bins[i] = cic_corner(q + (i * qstride), value, grid_start, grid_len,
+                             n_grid, ignore_nan, frac);
+      } else {
+        bins[i] = grid_index(q + (i * qstride), value, grid_start, grid_len,
+                             n_grid, ignore_nan);
+      }
+      if(bins[i] >= 0){
+        s = bins[i] / slab_size;
+        counts[s]++;
+      }
+    }
+  }
+
+  // Turn the counts into the start of each (slab, chunk) in the sorted
+  // points, slab by slab.  The start of slab s is offsets[s * n_chunks].
+
+  {
+    unsigned long *starts = (unsigned long *)malloc(sizeof(unsigned long) *
+                                                    (n_chunks * n_slabs + 1));
+    if(!starts){
+      goto error;
+    }
+    total = 0;
+    for(s=0;s<(unsigned long)n_slabs;s++){
+      for(t=0;t<n_chunks;t++){
+        starts[s * n_chunks + t] = total;
+        total += offsets[t * n_slabs + s];
+      }
+    }
+    starts[n_chunks * n_slabs] = total;
+    for(i=0;i<n_chunks * n_slabs + 1;i++){
+      offsets[i] = starts[i];
+    }
+    free(starts);
+  }
+
+  // Sort the points by slab
+
+#pragma omp parallel for private(i, s) schedule(static, 1)
+  for(t=0;t<n_chunks;t++){
+    unsigned long last = (t + 1) * chunk_size;
+    if(last > max_data){
+      last = max_data;
+    }
+    for(i=t*chunk_size;i<(long)last;i++){
+      if(bins[i] >= 0){
+        s = bins[i] / slab_size;
+        order[offsets[s * n_chunks + t]++] = i;
+      }
+    }
+  }
+
+  // Add up the slabs.  After sorting, the points of slab s run from
+  // the end of the last chunk of slab s - 1 to the end of its last chunk.
+
+  for(phase=0;phase<n_phases;phase++){
+#pragma omp parallel for private(i) schedule(dynamic)
+    for(t=phase;t<n_slabs;t+=n_phases){
+      unsigned long k;
+      unsigned long first = t ? offsets[t * n_chunks - 1] : 0;
+      unsigned long last = offsets[(t + 1) * n_chunks - 1];
+      for(k=first;k<last;k++){
+        unsigned long point = order[k];
+        double value = intensity[point * istride];
+        long pos = bins[point];
+        if(wout){
+          double frac[3];
+          cic_corner(q + (point * qstride), value, grid_start, grid_len,
+                     n_grid, ignore_nan, frac);
+          cic_deposit(dout, d2out, wout, pos, frac, value, n_grid);
+        } else {
+          dout[pos] += value;
+          d2out[pos] += (value * value);
+          nout[pos]++;
+        }
+      }
     }
   }
 
-  // Now free the memory.
+  retval = 0;
 
 error:
+  if(bins) free(bins);
+  if(order) free(order);
+  if(offsets) free(offsets);
+  return retval;
+}
 
-  for(n=0;n<max_threads;n++){
-    if(threadData[n].d2out) free(threadData[n].d2out);
-    if(threadData[n].dout) free(threadData[n].dout);
-    if(threadData[n].nout) free(threadData[n].nout);
+int c_grid3d(double *dout, double *d2out, unsigned long *nout, double *wout,
+             double *stderror,
+             double *q, unsigned long qstride, double *intensity, unsigned long istride,
+             npy_bool *mask, unsigned long mask_size,
+             double *grid_start, double *grid_stop, unsigned long max_data,
+             unsigned long *n_grid, int ignore_nan, int low_memory){
+
+  unsigned long i, j;
+  int retval = 0;
+  unsigned long grid_size = 0;
+  double grid_len[3];
+
+  // Some useful quantities
+
+  grid_size = n_grid[0] * n_grid[1] * n_grid[2];
+  for(i=0;i<3; i++){
+    grid_len[i] = grid_stop[i] - grid_start[i];
+  }
+  if(grid_size == 0){
+    return 0;
+  }
+
+  if(wout){
+    // cloud-in-cell deposition is only done by slabs
+    low_memory = 1;
+  } else if(low_memory < 0){
+    // Use the slabs when the private grids would take more memory
+    // than the indices of the points
+    low_memory = ((double)grid_size * omp_get_max_threads() *
+                  (2 * sizeof(double) + sizeof(unsigned long)) >
+                  (double)max_data * (sizeof(long) + sizeof(unsigned long)));
+  }
+
+  if(low_memory){
+    retval = grid3d_slabs(dout, d2out, nout, wout, q, qstride, intensity, istride,
+                          mask, mask_size, grid_start, grid_len, max_data,
+                          n_grid, grid_size, ignore_nan);
+  } else {
+    retval = grid3d_private(dout, d2out, nout, q, qstride, intensity, istride,
+                            mask, mask_size, grid_start, grid_len, max_data,
+                            n_grid, grid_size, ignore_nan);
+  }
+  if(retval){
+    return retval;
+  }
+
+  // Calculate the stderror from the accumulated totals, so that
+  // gridding in several calls gives the same result as a single one
+
+  // With cloud-in-cell deposition, the occupancy is the total weight of
+  // the points in the voxel and the variance is weighted accordingly.
+
+#pragma omp parallel for
+  for(j=0;j<grid_size;j++){
+    double n = wout ? wout[j] : (double)nout[j];
+    if(n == 0){
+      stderror[j] = 0.0;
+    } else {
+      double var = (d2out[j] - pow(dout[j], 2) / n) / n;
+      if(var < 0){
+        // round-off
+        var = 0.0;
+      }
+      stderror[j] = pow(var, 0.5) / pow(n, 0.5);
+    }
   }
 
-  free(threadData);
   return retval;
 }
 
@@ -61,19 +61,23 @@ typedef struct {
   unsigned long *nout;
 } gridderThreadData;
 
-int calcQTheta(double* diffAngles, double theta, double mu, 
-               double *qTheta, int n, double lambda);
-int calcQPhiFromQTheta(double *qTheta, int n, double chi, double phi);
-int calcDeltaGamma(double *delgam, CCD *ccd, double delCen, double gamCen);
-int matmulti(double *val, int n, double mat[][3]);
-int calcHKLFromQPhi(double *qPhi, int n, double mat[][3]);
+int calcQThetaTerms(double *terms, double del, double theta, double mu,
+                    double lambda);
+int calcQTheta(double *qTheta, double sinGam, double cosGam, double *terms);
+int calcFrameMatrix(double mat[][3], int mode, double chi, double phi,
+                    double ubi[][3]);
+int calcDeltaGamma(double *delta, double *gamma, CCD *ccd);
+int matmulti(double *v, double mat[][3]);
 
-int processImages(double *delgam, double *anglesp, double *qOutp, double lambda, 
+int processImages(double *anglesp, void *qOutp, int single, double lambda,
                   int mode, unsigned long nimages, double *ubinvp, CCD *ccd);
 
-int c_grid3d(double *dout, double *d2out, unsigned long *nout, double *sterr, double *data,
+int c_grid3d(double *dout, double *d2out, unsigned long *nout, double *wout,
+             double *sterr,
+             double *q, unsigned long qstride, double *intensity, unsigned long istride,
+             npy_bool *mask, unsigned long mask_size,
              double *grid_start, double *grid_stop, unsigned long max_data, 
-             unsigned long *n_grid, int ignore_nan);
+             unsigned long *n_grid, int ignore_nan, int low_memory);
 
 static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs);
 static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs);